@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from loguru import logger
+
+# logger
+logger.remove()
+logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
+
+# Metric name suffixes and whether a larger value is better
+HIGHER_IS_BETTER = ("_per_s",)
+LOWER_IS_BETTER = ("_ms", "_mb", "_s")
+# Changes smaller than this are noise whatever the tolerance says
+ABSOLUTE_SLACK = {"_ms": 2.0, "_mb": 5.0, "_s": 0.05, "_per_s": 0.0}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Offline end-to-end benchmarks of the loader, the PDF Lambda and the chat flow"
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=str,
+        default="loader,lambda,chat",
+        help="Comma separated scenarios to run",
+    )
+    parser.add_argument("--loader-records", type=int, default=5000)
+    parser.add_argument("--loader-concurrency", type=int, default=16)
+    parser.add_argument(
+        "--loader-rate", type=float, default=1000, help="Embedding requests per second"
+    )
+    parser.add_argument("--lambda-documents", type=int, default=4)
+    parser.add_argument("--lambda-pages", type=int, default=60)
+    parser.add_argument("--lambda-record-concurrency", type=int, default=4)
+    parser.add_argument(
+        "--lambda-extract-workers",
+        type=int,
+        default=0,
+        help="Extraction processes, 0 for the Lambda's default of one per CPU",
+    )
+    parser.add_argument("--chat-turns", type=int, default=200)
+    parser.add_argument("--chat-concurrency", type=int, default=4)
+    parser.add_argument("--chat-corpus", type=int, default=5000, help="Documents in the fake index")
+    parser.add_argument(
+        "--chat-stream",
+        type=int,
+        default=1,
+        help="1 to consume answers as streams, 0 for the blocking tool call",
+    )
+    parser.add_argument("--embedding-latency-ms", type=float, default=20)
+    parser.add_argument("--first-token-latency-ms", type=float, default=300)
+    parser.add_argument("--token-latency-ms", type=float, default=10)
+    parser.add_argument("--output-tokens", type=int, default=60)
+    parser.add_argument("--opensearch-latency-ms", type=float, default=5)
+    parser.add_argument("--s3-latency-ms", type=float, default=10)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare against this results file")
+    parser.add_argument(
+        "--save-baseline", type=str, default=None, help="Store the results as the new baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative change of a metric that counts as a regression",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the scenarios")
+    parser.add_argument("--run-scenario", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+# Scenario settings that change the numbers, a baseline only compares with
+# runs made with the same ones
+CONFIG_KEYS = (
+    "loader_records",
+    "loader_concurrency",
+    "loader_rate",
+    "lambda_documents",
+    "lambda_pages",
+    "lambda_record_concurrency",
+    "lambda_extract_workers",
+    "chat_turns",
+    "chat_concurrency",
+    "chat_corpus",
+    "chat_stream",
+    "embedding_latency_ms",
+    "first_token_latency_ms",
+    "token_latency_ms",
+    "output_tokens",
+    "opensearch_latency_ms",
+    "s3_latency_ms",
+)
+
+
+def run_scenario_in_process(args):
+    from benchmarks.scenarios import SCENARIOS
+
+    with tempfile.TemporaryDirectory(prefix=f"bench-{args.run_scenario}-") as workdir:
+        metrics = SCENARIOS[args.run_scenario](args, workdir)
+    with open(args.result, "w") as f:
+        json.dump(metrics, f)
+
+
+def run_scenario(name, args):
+    # A fresh interpreter per scenario keeps the fakes' patches and the peak
+    # memory of one scenario out of the others
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as result:
+        result_path = result.name
+    env = dict(os.environ)
+    if not args.verbose:
+        env.setdefault("LOG_LEVEL", "WARNING")
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        *sys.argv[1:],
+        "--run-scenario",
+        name,
+        "--result",
+        result_path,
+    ]
+    output = None if args.verbose else subprocess.DEVNULL
+    try:
+        started = time.perf_counter()
+        process = subprocess.run(
+            command,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stdout=output,
+            stderr=None if args.verbose else subprocess.PIPE,
+        )
+        if process.returncode != 0:
+            stderr = process.stderr.decode(errors="replace")[-4000:] if process.stderr else ""
+            raise RuntimeError(f"Scenario {name} failed with exit code {process.returncode}\n{stderr}")
+        with open(result_path) as f:
+            metrics = json.load(f)
+        logger.info(f"Scenario {name} finished in {time.perf_counter() - started:.1f}s")
+        return metrics
+    finally:
+        os.remove(result_path)
+
+
+def direction(metric):
+    if metric.endswith(HIGHER_IS_BETTER):
+        return 1
+    if metric.endswith(LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def slack(metric):
+    # Longest matching suffix, "_per_s" before "_s"
+    for suffix in sorted(ABSOLUTE_SLACK, key=len, reverse=True):
+        if metric.endswith(suffix):
+            return ABSOLUTE_SLACK[suffix]
+    return 0.0
+
+
+def compare(metrics, baseline, tolerance):
+    """Rows of (metric, value, baseline value, relative change, status).
+
+    Status is "regression" when a metric moved the wrong way by more than
+    `tolerance` and its absolute slack, "improved" the other way round.
+    """
+    rows = []
+    for metric, value in metrics.items():
+        previous = baseline.get(metric)
+        sign = direction(metric)
+        if previous is None or not sign:
+            rows.append((metric, value, previous, None, ""))
+            continue
+        change = (value - previous) / previous if previous else 0.0
+        status = "ok"
+        if abs(value - previous) > slack(metric) and abs(change) > tolerance:
+            status = "improved" if change * sign > 0 else "regression"
+        rows.append((metric, value, previous, change, status))
+    return rows
+
+
+def print_table(rows):
+    width = max(len(row[0]) for row in rows)
+    print(f"{'metric':<{width}}  {'value':>12}  {'baseline':>12}  {'change':>8}  status")
+    for metric, value, previous, change, status in rows:
+        previous = "" if previous is None else f"{previous:12g}"
+        change = "" if change is None else f"{change:+8.1%}"
+        print(f"{metric:<{width}}  {value:12g}  {previous:>12}  {change:>8}  {status}")
+
+
+def main():
+    args = parse_args()
+    if args.run_scenario:
+        run_scenario_in_process(args)
+        return
+
+    config = {key: getattr(args, key) for key in CONFIG_KEYS}
+    metrics = {}
+    for name in [name.strip() for name in args.scenarios.split(",") if name.strip()]:
+        logger.info(f"Running scenario {name}")
+        metrics.update(run_scenario(name, args))
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": config,
+        "metrics": metrics,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        changed = {
+            key: (stored["config"].get(key), value)
+            for key, value in config.items()
+            if stored["config"].get(key) != value
+        }
+        if changed:
+            logger.warning(f"Settings differ from the baseline, comparison is not meaningful: {changed}")
+        if stored["machine"] != results["machine"]:
+            logger.warning(f"Baseline was recorded on {stored['machine']}")
+        baseline = stored["metrics"]
+
+    rows = compare(metrics, baseline, args.tolerance)
+    print_table(rows)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Baseline saved to {args.save_baseline}")
+
+    regressions = [row[0] for row in rows if row[4] == "regression"]
+    if regressions:
+        logger.error(f"{len(regressions)} metrics regressed more than {args.tolerance:.0%}: {regressions}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
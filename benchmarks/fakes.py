@@ -0,0 +1,389 @@
+"""Deterministic in-process stand-ins for Bedrock, OpenSearch and S3.
+
+They implement just the calls the loader, the PDF Lambda and the chat flow
+make, with fixed configurable latencies, so benchmarks run offline and give
+the same work on every run.
+"""
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+from botocore.exceptions import ClientError
+from opensearchpy.serializer import JSONSerializer
+
+EMBEDDING_DIMENSION = 1536
+# Latin words and single CJK characters
+_TOKEN = re.compile(r"[\u4e00-\u9fff]|[a-z0-9]+")
+
+
+@functools.lru_cache(maxsize=65536)
+def token_vector(token, dimension=EMBEDDING_DIMENSION):
+    seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+
+
+def fake_embedding(text, dimension=EMBEDDING_DIMENSION):
+    """Sum of per-token random vectors, normalized.
+
+    Texts sharing words score closer, so the relevance gate and the context
+    packer see realistic score spreads.
+    """
+    vector = np.zeros(dimension, dtype=np.float32)
+    for token in _TOKEN.findall(text.lower()):
+        vector += token_vector(token, dimension)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+class FakeBedrockRuntime:
+    """bedrock-runtime client for Titan embeddings and Claude 3 messages.
+
+    Embedding calls take `embedding_latency` seconds. Claude calls wait
+    `first_token_latency` before the first token and `token_latency` per
+    token after it, streamed through `invoke_model_with_response_stream`.
+    Every answer is `output_tokens` tokens long.
+    """
+
+    def __init__(
+        self,
+        embedding_latency=0.02,
+        first_token_latency=0.3,
+        token_latency=0.01,
+        output_tokens=60,
+        dimension=EMBEDDING_DIMENSION,
+    ):
+        self.embedding_latency = embedding_latency
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.output_tokens = output_tokens
+        self.dimension = dimension
+        self._lock = threading.Lock()
+        self.calls = {"embedding": 0, "completion": 0}
+
+    def _count(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+
+    def _answer_tokens(self, body):
+        digest = hashlib.sha256(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+        return [f"{digest[i % 64]}{i} " for i in range(self.output_tokens)]
+
+    def invoke_model(self, body, modelId, accept=None, contentType=None, **kwargs):
+        request = json.loads(body)
+        if "inputText" in request:
+            self._count("embedding")
+            time.sleep(self.embedding_latency)
+            vector = fake_embedding(request["inputText"], self.dimension)
+            payload = {"embedding": vector.tolist(), "inputTextTokenCount": len(request["inputText"])}
+        else:
+            self._count("completion")
+            tokens = self._answer_tokens(request)
+            time.sleep(self.first_token_latency + self.token_latency * (len(tokens) - 1))
+            payload = {
+                "content": [{"type": "text", "text": "".join(tokens)}],
+                "stop_reason": "end_turn",
+            }
+        return {"body": io.BytesIO(json.dumps(payload).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, body, modelId, accept=None, contentType=None, **kwargs):
+        self._count("completion")
+        tokens = self._answer_tokens(json.loads(body))
+
+        def events():
+            def event(payload):
+                return {"chunk": {"bytes": json.dumps(payload).encode("utf-8")}}
+
+            yield event({"type": "message_start", "message": {"usage": {"input_tokens": 0}}})
+            for i, token in enumerate(tokens):
+                time.sleep(self.first_token_latency if i == 0 else self.token_latency)
+                yield event({"type": "content_block_delta", "delta": {"text": token}})
+            yield event({
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn"},
+                "usage": {"output_tokens": len(tokens)},
+            })
+            yield event({"type": "message_stop"})
+
+        return {"body": events()}
+
+
+class _FakeIndices:
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index):
+        return index in self.client.indexes
+
+    def create(self, index, body=None):
+        with self.client.lock:
+            self.client.indexes[index] = {
+                "uuid": uuid.uuid4().hex,
+                "body": body or {},
+                "settings": {"index.refresh_interval": "1s", "index.number_of_replicas": "1"},
+                "docs": {},
+            }
+            self.client._matrices.pop(index, None)
+        return {"acknowledged": True}
+
+    def delete(self, index):
+        with self.client.lock:
+            if index not in self.client.indexes:
+                raise KeyError(index)
+            del self.client.indexes[index]
+            self.client._matrices.pop(index, None)
+        return {"acknowledged": True}
+
+    def get_mapping(self, index):
+        return {index: {"mappings": self.client.indexes[index]["body"].get("mappings", {})}}
+
+    def put_mapping(self, index, body):
+        self.client.indexes[index]["body"]["mappings"] = body
+        return {"acknowledged": True}
+
+    def get_settings(self, index, **kwargs):
+        state = self.client.indexes[index]
+        if kwargs.get("flat_settings"):
+            return {index: {"settings": dict(state["settings"]), "defaults": {}}}
+        return {index: {"settings": {"index": {"uuid": state["uuid"]}}}}
+
+    def put_settings(self, index, body):
+        for key, value in body.get("index", {}).items():
+            self.client.indexes[index]["settings"][f"index.{key}"] = value
+        return {"acknowledged": True}
+
+    def refresh(self, index=None):
+        return {}
+
+    def forcemerge(self, index=None, **kwargs):
+        return {}
+
+
+class _FakeTransport:
+    def __init__(self, client):
+        self.client = client
+        self.serializer = JSONSerializer()
+
+    def perform_request(self, method, url, params=None, body=None, **kwargs):
+        if url.startswith("/_search/pipeline/"):
+            self.client.search_pipelines[url.rsplit("/", 1)[-1]] = body
+            return {"acknowledged": True}
+        return {}
+
+
+class FakeOpenSearch:
+    """In-process OpenSearch with exact k-NN search.
+
+    Supports the index, bulk, mget and `knn` / `hybrid` search calls of the
+    repo. Scores follow the nmslib/faiss `cosinesimil` scale, 1 / (2 - cos).
+    Every request waits `latency` seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.indexes = {}
+        self.search_pipelines = {}
+        self._matrices = {}
+        self.indices = _FakeIndices(self)
+        self.transport = _FakeTransport(self)
+        self.requests = 0
+
+    def _wait(self):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def ping(self):
+        return True
+
+    def index_documents(self, index, documents):
+        # documents: {id: source}, bypasses the bulk API for fixtures
+        with self.lock:
+            self.indexes[index]["docs"].update(documents)
+            self._matrices.pop(index, None)
+
+    def bulk(self, body, *args, **kwargs):
+        self._wait()
+        lines = [line for line in body.splitlines() if line.strip()]
+        items = []
+        with self.lock:
+            # Sources are kept as JSON text and only parsed when searched, so
+            # the fake adds little to the client's own serialization cost
+            for action, source in zip(lines[::2], lines[1::2]):
+                (op, meta), = json.loads(action).items()
+                docs = self.indexes[meta["_index"]]["docs"]
+                doc_id = meta.get("_id") or uuid.uuid4().hex
+                docs[doc_id] = source
+                self._matrices.pop(meta["_index"], None)
+                items.append({op: {"_index": meta["_index"], "_id": doc_id, "status": 201}})
+        return {"took": 1, "errors": False, "items": items}
+
+    def mget(self, index, body, _source=None, **kwargs):
+        self._wait()
+        docs = self.indexes[index]["docs"]
+        return {"docs": [{"_id": i, "found": i in docs} for i in body["ids"]]}
+
+    def _sources(self, index):
+        docs = self.indexes[index]["docs"]
+        for doc_id, source in docs.items():
+            if isinstance(source, str):
+                docs[doc_id] = json.loads(source)
+        return docs
+
+    def _matrix(self, index, vector_field):
+        with self.lock:
+            cached = self._matrices.get(index)
+            if cached is None:
+                docs = self._sources(index)
+                ids = list(docs)
+                vectors = np.asarray([docs[i][vector_field] for i in ids], dtype=np.float32).reshape(len(ids), -1)
+                norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                norms[norms == 0] = 1
+                cached = self._matrices[index] = (ids, vectors / norms)
+            return cached
+
+    def _knn(self, index, knn):
+        (vector_field, query), = knn.items()
+        ids, matrix = self._matrix(index, vector_field)
+        vector = np.asarray(query["vector"], dtype=np.float32)
+        vector /= max(np.linalg.norm(vector), 1e-12)
+        cos = matrix @ vector if len(ids) else np.zeros(0, dtype=np.float32)
+        top = np.argsort(-cos)[: query["k"]]
+        return [(ids[i], float(1 / (2 - cos[i]))) for i in top]
+
+    def search(self, index, body, params=None, **kwargs):
+        self._wait()
+        query = body["query"]
+        if "hybrid" in query:
+            # Good enough for timing, the k-NN part decides the order
+            query = next(q for q in query["hybrid"]["queries"] if "knn" in q)
+        if "bool" in query:
+            query = query["bool"]["must"][0]
+        hits = self._knn(index, query["knn"])[: body.get("size", 10)]
+        with self.lock:
+            docs = self._sources(index)
+        source_filter = body.get("_source", True)
+        excludes = source_filter.get("excludes", []) if isinstance(source_filter, dict) else []
+        return {
+            "hits": {
+                "hits": [
+                    {
+                        "_index": index,
+                        "_id": doc_id,
+                        "_score": score,
+                        "_source": {k: v for k, v in docs[doc_id].items() if k not in excludes},
+                    }
+                    for doc_id, score in hits
+                    if score >= body.get("min_score", 0.0)
+                ]
+            }
+        }
+
+
+class _FakeS3Body(io.BytesIO):
+    def iter_lines(self):
+        return iter(self.read().splitlines())
+
+
+class FakeS3:
+    """S3 client backed by a local directory, one sub-directory per bucket.
+
+    Being on disk, objects written by forked worker processes are visible to
+    the parent. Every call waits `latency` seconds.
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+        ClientError = ClientError
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _metadata_path(self, bucket, key):
+        return self._path(bucket, key) + ".metadata.json"
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _write(self, bucket, key, data, metadata=None, if_none_match=None):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        if if_none_match == "*":
+            # Linking fails if the key exists, like S3's conditional create
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject") from None
+            finally:
+                os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        if metadata:
+            with open(self._metadata_path(bucket, key), "w") as f:
+                json.dump(metadata, f)
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, IfNoneMatch=None, **kwargs):
+        self._wait()
+        self._write(Bucket, Key, Body if isinstance(Body, bytes) else Body.read(), Metadata, IfNoneMatch)
+        return {"ETag": f'"{hashlib.md5(Body if isinstance(Body, bytes) else b"").hexdigest()}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._wait()
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise self.exceptions.NoSuchKey(Key)
+        with open(path, "rb") as f:
+            return {"Body": _FakeS3Body(f.read())}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._wait()
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        metadata = {}
+        if os.path.exists(self._metadata_path(Bucket, Key)):
+            with open(self._metadata_path(Bucket, Key)) as f:
+                metadata = json.load(f)
+        with open(path, "rb") as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        return {"ETag": f'"{etag}"', "Metadata": metadata, "ContentLength": os.path.getsize(path)}
+
+    def download_file(self, Bucket, Key, Filename, Config=None, **kwargs):
+        self._wait()
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, **kwargs):
+        self._wait()
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+
+class FakeSession:
+    """Stands in for boto3.session.Session in forked workers."""
+
+    s3 = None
+
+    def client(self, service_name, *args, **kwargs):
+        return FakeSession.s3
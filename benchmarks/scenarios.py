@@ -0,0 +1,341 @@
+"""Benchmark scenarios driving the real entry points against the local fakes.
+
+Each scenario patches the module-level client factories of one entry point,
+runs it on synthetic data and returns a flat dict of metrics. They are meant
+to run in their own process, see benchmark.py, so patches and peak memory do
+not leak between them.
+"""
+import gzip
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.fakes import FakeBedrockRuntime, FakeOpenSearch, FakeS3, FakeSession, fake_embedding
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+INDEX_NAME = "bench"
+
+# Synthetic text is drawn from a fixed vocabulary so runs are comparable
+WORDS = (
+    "battery scooter charge brake light mode sleep power key lock seat motor speed "
+    "display button range tire pressure service warning helmet mirror signal horn "
+    "throttle station swap riding app bluetooth update firmware temperature rain "
+    "parking stand cover screw fuse panel alarm reset error code dashboard eco boost"
+).split()
+
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def latency_metrics(prefix, seconds):
+    """p50/p95/p99 in milliseconds of a list of durations in seconds."""
+    if not seconds:
+        return {}
+    p50, p95, p99 = np.percentile(np.asarray(seconds) * 1000, [50, 95, 99])
+    return {
+        f"{prefix}_p50_ms": round(float(p50), 3),
+        f"{prefix}_p95_ms": round(float(p95), 3),
+        f"{prefix}_p99_ms": round(float(p99), 3),
+    }
+
+
+def peak_memory_mb():
+    # ru_maxrss is in KiB on Linux, children covers the Lambda's workers
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return round(peak / 1024, 1)
+
+
+def timed(fn, durations, lock):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with lock:
+                durations.append(time.perf_counter() - started)
+
+    return wrapper
+
+
+def fake_bedrock(options):
+    return FakeBedrockRuntime(
+        embedding_latency=options.embedding_latency_ms / 1000,
+        first_token_latency=options.first_token_latency_ms / 1000,
+        token_latency=options.token_latency_ms / 1000,
+        output_tokens=options.output_tokens,
+    )
+
+
+def write_dataset(path, records, seed=0):
+    # [question, answer] pairs like the gooaq dataset the loader defaults to
+    rng = random.Random(seed)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for i in range(records):
+            pair = [f"Question {i}: {sentence(rng, 8)}", sentence(rng, 40)]
+            f.write(json.dumps(pair) + "\n")
+
+
+def run_loader(options, workdir):
+    """Embed and index a synthetic dataset with load_data_to_opensearch.main."""
+    sys.path.insert(0, str(REPO_ROOT))
+    import load_data_to_opensearch as loader
+    from utils import embedding, opensearch
+
+    dataset_path = os.path.join(workdir, "dataset.jsonl.gz")
+    write_dataset(dataset_path, options.loader_records)
+
+    bedrock = fake_bedrock(options)
+    search = FakeOpenSearch(latency=options.opensearch_latency_ms / 1000)
+    loader.get_bedrock_client = lambda region, max_pool_connections=10: bedrock
+    opensearch.get_opensearch_cluster_client = lambda *args, **kwargs: search
+
+    lock = threading.Lock()
+    embed_durations, bulk_durations = [], []
+    # Includes the wait on the rate limiter, as a record sees it
+    embedding.call_with_backoff = timed(embedding.call_with_backoff, embed_durations, lock)
+    opensearch.BulkWriter._write_batch = timed(opensearch.BulkWriter._write_batch, bulk_durations, lock)
+
+    sys.argv = [
+        "load_data_to_opensearch.py",
+        "--dataset", dataset_path,
+        "--index", INDEX_NAME,
+        "--recreate", "1",
+        "--checkpoint", os.path.join(workdir, "checkpoint.sqlite3"),
+        "--artifact", os.path.join(workdir, "artifact"),
+        "--concurrency", str(options.loader_concurrency),
+        "--rate", str(options.loader_rate),
+    ]
+    started = time.perf_counter()
+    loader.main()
+    elapsed = time.perf_counter() - started
+
+    indexed = len(search.indexes[INDEX_NAME]["docs"])
+    if indexed != options.loader_records:
+        raise RuntimeError(f"Indexed {indexed} of {options.loader_records} records")
+    return {
+        "loader_records": indexed,
+        "loader_wall_s": round(elapsed, 3),
+        "loader_records_per_s": round(indexed / elapsed, 1),
+        **latency_metrics("loader_embed", embed_durations),
+        **latency_metrics("loader_bulk", bulk_durations),
+        "loader_peak_mb": peak_memory_mb(),
+    }
+
+
+def make_manual(path, pages, seed):
+    """A manual with numbered chapters, a logo on every page and some photos."""
+    import fitz
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    logo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 40, 20), False)
+    logo.clear_with(90)
+    chapter, subsection = 1, 0
+    for page_number in range(pages):
+        page = doc.new_page()
+        page.insert_image(fitz.Rect(500, 20, 560, 50), pixmap=logo)
+        lines = []
+        if page_number % 4 == 0:
+            chapter, subsection = chapter + 1, 1
+            lines += [f"{chapter}. {sentence(rng, 3)}", f"{chapter}.1 {sentence(rng, 3)}"]
+        else:
+            subsection += 1
+            lines.append(f"{chapter}.{subsection} {sentence(rng, 3)}")
+        lines += [sentence(rng, 12) for _ in range(30)]
+        y = 70
+        for line in lines:
+            page.insert_text((50, y), line, fontsize=9)
+            y += 12
+            if y == 70 + 12 * 8 and page_number % 3 == 0:
+                # Unique photo per manual and page, exercises the upload path
+                photo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 120, 80), False)
+                photo.clear_with(rng.randrange(256))
+                page.insert_image(fitz.Rect(60, y, 240, y + 120), pixmap=photo)
+                y += 130
+    doc.save(path)
+
+
+def run_lambda(options, workdir):
+    """Extract and chunk synthetic manuals with the PDF lambda_handler."""
+    os.environ["SPOOL_DIR"] = workdir
+    os.environ.setdefault("RECORD_CONCURRENCY", str(options.lambda_record_concurrency))
+    if options.lambda_extract_workers:
+        os.environ.setdefault("EXTRACT_WORKERS", str(options.lambda_extract_workers))
+    sys.path.insert(0, str(REPO_ROOT / "src"))
+    import boto3
+    import data
+
+    s3 = FakeS3(os.path.join(workdir, "s3"), latency=options.s3_latency_ms / 1000)
+    FakeSession.s3 = s3
+    data.s3_client = s3
+    # The extraction workers are forked and open their own client
+    boto3.session.Session = FakeSession
+
+    records = []
+    for i in range(options.lambda_documents):
+        key = f"manuals/bench-{i}.pdf"
+        path = os.path.join(workdir, f"bench-{i}.pdf")
+        make_manual(path, options.lambda_pages, seed=i)
+        s3.upload_file(path, data.bucket_name, key)
+        records.append({
+            "eventSource": "aws:s3",
+            "s3": {"bucket": {"name": data.bucket_name}, "object": {"key": key, "eTag": f"bench-{i}"}},
+        })
+    event = {"Records": records}
+
+    lock = threading.Lock()
+    document_durations = []
+    data.process_document = timed(data.process_document, document_durations, lock)
+
+    started = time.perf_counter()
+    response = data.lambda_handler(event, None)
+    elapsed = time.perf_counter() - started
+    if response["batchItemFailures"]:
+        raise RuntimeError(f"Lambda failed {response['batchItemFailures']}")
+
+    # Delivered again, every document is skipped by its ETag
+    started = time.perf_counter()
+    data.lambda_handler(event, None)
+    skip_elapsed = time.perf_counter() - started
+
+    pages = options.lambda_documents * options.lambda_pages
+    return {
+        "lambda_documents": options.lambda_documents,
+        "lambda_pages": pages,
+        "lambda_wall_s": round(elapsed, 3),
+        "lambda_pages_per_s": round(pages / elapsed, 1),
+        **latency_metrics("lambda_document", document_durations[: options.lambda_documents]),
+        "lambda_redelivery_ms": round(skip_elapsed * 1000, 3),
+        "lambda_peak_mb": peak_memory_mb(),
+    }
+
+
+class TraceCollector:
+    """Trace exporter keeping every finished record in memory."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        with self._lock:
+            self.records.append(record)
+
+
+def corpus_documents(size, seed=0):
+    rng = random.Random(seed)
+    return [" ".join(sentence(rng, 15) for _ in range(4)) for _ in range(size)]
+
+
+def questions(corpus, count, seed=1):
+    # Unique questions made of words from one corpus document each
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        words = rng.choice(corpus).split()
+        result.append(f"{i} " + " ".join(rng.sample(words, 6)) + "?")
+    return result
+
+
+def install_chat_fakes(options, corpus_size):
+    """Import the chat flow with its Bedrock and OpenSearch clients faked.
+
+    Must run before anything else imports the flow, its configuration is
+    read from the environment at import. Returns the is_question_relevant
+    module, the fakes and the corpus loaded into the index.
+    """
+    os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
+    os.environ.setdefault("SEMANTIC_CACHE_SIZE", "0")
+    os.environ.setdefault("TRACE_EXPORTERS", "histogram")
+    sys.path.insert(0, str(REPO_ROOT))
+    sys.path.insert(0, str(REPO_ROOT / "main_flow"))
+    import is_question_relevant as flow
+    import rag_pipeline
+    from utils.index_spec import IndexSpec
+
+    bedrock = fake_bedrock(options)
+    search = FakeOpenSearch(latency=options.opensearch_latency_ms / 1000)
+    search.indices.create(INDEX_NAME, IndexSpec().body())
+    corpus = corpus_documents(corpus_size)
+    search.index_documents(INDEX_NAME, {
+        f"doc-{i}": {"text": text, "vector_field": fake_embedding(text)}
+        for i, text in enumerate(corpus)
+    })
+
+    create_vector_search = rag_pipeline.create_opensearch_vector_search_client
+
+    def create_fake_vector_search(index_name, embeddings, *args, **kwargs):
+        vector_search = create_vector_search(index_name, embeddings, "http://localhost:9200", "bench", "bench")
+        vector_search.client = search
+        return vector_search
+
+    rag_pipeline.get_bedrock_client = lambda region, credentials_profile_name=None: bedrock
+    rag_pipeline.create_opensearch_vector_search_client = create_fake_vector_search
+    sys.argv = ["is_question_relevant.py", "--index", INDEX_NAME]
+    return flow, bedrock, search, corpus
+
+
+def chat_turn(flow, query, stream):
+    answer = flow.main(query, [], stream=stream)
+    if stream:
+        answer = "".join(answer)
+    return answer
+
+
+def run_chat(options, workdir):
+    """Answer unique questions through the promptflow tool `main`."""
+    flow, bedrock, search, corpus = install_chat_fakes(options, options.chat_corpus)
+    collector = TraceCollector()
+    flow.TRACER.add_exporter(collector)
+    flow.warm_up()
+
+    lock = threading.Lock()
+    turn_durations = []
+    turn = timed(lambda query: chat_turn(flow, query, options.chat_stream), turn_durations, lock)
+    queries = questions(corpus, options.chat_turns)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.chat_concurrency) as executor:
+        list(executor.map(turn, queries))
+    elapsed = time.perf_counter() - started
+
+    first_tokens = [
+        (span["start_ms"] + span["duration_ms"]) / 1000
+        for record in collector.records
+        for span in record["spans"]
+        if span["name"] == "llm_first_token"
+    ]
+    metrics = {
+        "chat_turns": len(queries),
+        "chat_wall_s": round(elapsed, 3),
+        "chat_turns_per_s": round(len(queries) / elapsed, 2),
+        **latency_metrics("chat_turn", turn_durations),
+        **latency_metrics("chat_ttft", first_tokens),
+    }
+    # Per-stage percentiles from the flow's own latency histograms
+    for name, summary in sorted(flow.LATENCY_HISTOGRAMS.stats().items()):
+        if name in ("chat_turn", "client_setup", "index_check"):
+            continue
+        metrics[f"chat_stage_{name}_p50_ms"] = summary["p50_ms"]
+        metrics[f"chat_stage_{name}_p95_ms"] = summary["p95_ms"]
+    metrics["chat_peak_mb"] = peak_memory_mb()
+    return metrics
+
+
+SCENARIOS = {
+    "loader": run_loader,
+    "lambda": run_lambda,
+    "chat": run_chat,
+}
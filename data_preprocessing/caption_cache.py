@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+import boto3
+
+
+def caption_key(image_bytes: bytes, prompt: str, model_id: str) -> str:
+    # The caption only depends on the image, the prompt and the model, a
+    # changed prompt or model misses the cache
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    key = f"{model_id}\x00{prompt}\x00{image_hash}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class SQLiteCaptionStore:
+    """On-disk caption store holding at most `max_bytes` of captions.
+
+    Least recently used entries are evicted once the limit is passed.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, model_id TEXT NOT NULL, caption TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)"
+        )
+        self._conn.commit()
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM captions"
+        ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT caption FROM captions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE captions SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        return row[0]
+
+    def put(self, key: str, model_id: str, caption: str):
+        size = len(caption.encode("utf-8"))
+        with self._lock:
+            previous = self._conn.execute(
+                "SELECT size FROM captions WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, ?)",
+                (key, model_id, caption, size, time.time()),
+            )
+            self._size += size - (previous[0] if previous else 0)
+            while self._size > self.max_bytes:
+                oldest = self._conn.execute(
+                    "SELECT key, size FROM captions ORDER BY last_used LIMIT 1"
+                ).fetchone()
+                if oldest is None or oldest[0] == key:
+                    break
+                self._conn.execute("DELETE FROM captions WHERE key = ?", (oldest[0],))
+                self._size -= oldest[1]
+                self.evictions += 1
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+    def size(self) -> int:
+        with self._lock:
+            return self._size
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class S3CaptionStore:
+    """Caption objects under an s3://bucket/prefix, shared between machines.
+
+    `endpoint_url` points it at any S3-compatible store such as MinIO.
+    Expiry is left to a lifecycle rule on the bucket.
+    """
+
+    def __init__(self, uri: str, endpoint_url: Optional[str] = None, client=None):
+        self.bucket, _, self.prefix = uri[len("s3://"):].partition("/")
+        self.client = client or boto3.client("s3", endpoint_url=endpoint_url)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.json")
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())["caption"]
+
+    def put(self, key: str, model_id: str, caption: str):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{key}.json",
+            Body=json.dumps({"model_id": model_id, "caption": caption}, ensure_ascii=False).encode("utf-8"),
+        )
+
+
+class CaptionCache:
+    """Caption cache with a local SQLite tier in front of an optional S3 tier.
+
+    Lookups go disk -> S3 -> model, S3 hits are copied to disk and new
+    captions are written to both.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        path: Optional[str] = None,
+        max_bytes: int = 64 * 1024 * 1024,
+        s3_uri: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+    ):
+        self.model_id = model_id
+        self.store = SQLiteCaptionStore(path, max_bytes) if path else None
+        self.remote = S3CaptionStore(s3_uri, endpoint_url) if s3_uri else None
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.s3_hits = 0
+        self.misses = 0
+
+    def key(self, image_bytes: bytes, prompt: str) -> str:
+        return caption_key(image_bytes, prompt, self.model_id)
+
+    def get(self, key: str) -> Optional[str]:
+        if self.store is not None:
+            caption = self.store.get(key)
+            if caption is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                return caption
+        if self.remote is not None:
+            caption = self.remote.get(key)
+            if caption is not None:
+                with self._lock:
+                    self.s3_hits += 1
+                if self.store is not None:
+                    self.store.put(key, self.model_id, caption)
+                return caption
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, caption: str):
+        if self.store is not None:
+            self.store.put(key, self.model_id, caption)
+        if self.remote is not None:
+            self.remote.put(key, self.model_id, caption)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            hits = self.disk_hits + self.s3_hits
+            lookups = hits + self.misses
+            stats = {
+                "disk_hits": self.disk_hits,
+                "s3_hits": self.s3_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+        if self.store is not None:
+            stats["disk_entries"] = len(self.store)
+            stats["disk_bytes"] = self.store.size()
+            stats["evictions"] = self.store.evictions
+        return stats
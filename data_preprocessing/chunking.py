@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import re
+
+# Chunks are cut at numbered headings and page boundaries, sections longer
+# than CHUNK_MAX_CHARS are split at line breaks and sections shorter than
+# CHUNK_MIN_CHARS are merged with their neighbours on the same page
+CHUNK_MAX_CHARS = int(os.environ.get('CHUNK_MAX_CHARS', 800))
+CHUNK_MIN_CHARS = int(os.environ.get('CHUNK_MIN_CHARS', 200))
+
+# "3.1.5 休眠模式", "4. 上路騎乘"
+HEADING_PATTERN = re.compile(r'^\s*(\d{1,2}(?:\.\d{1,2}){0,4})\.?\s+(\S.{0,59}?)\s*$')
+# Table of contents lines end with the page number
+TOC_PAGE_NUMBER = re.compile(r'\s\d{1,3}$')
+IMAGE_MARK = re.compile(r'^image \d+$')
+
+
+def heading_number(line):
+    match = HEADING_PATTERN.match(line)
+    if not match or TOC_PAGE_NUMBER.search(match.group(2)):
+        return None
+    return tuple(int(n) for n in match.group(1).split('.'))
+
+
+def parse_heading(line, section, page_numbers=frozenset()):
+    """Return the section number tuple if `line` is a heading after `section`.
+
+    Sub-section headings ("3.1.5") must come after the current section and
+    at most one chapter ahead. A chapter heading ("4.") must be the next
+    chapter and be followed by its first sub-section ("4.1") in
+    `page_numbers`, the heading numbers found on the same page, otherwise it
+    reads as a numbered list item. Table of contents entries are body text.
+    """
+    number = heading_number(line)
+    if number is None:
+        return None
+    if len(number) == 1:
+        if number + (1,) not in page_numbers:
+            return None
+        return number if not section or number[0] == section[0] + 1 else None
+    if not section:
+        return number
+    return number if section < number and number[0] <= section[0] + 1 else None
+
+
+def split_page(text, section, heading):
+    """Split one page into (section, heading, start, end) spans of its text.
+
+    `section` and `heading` are the ones the previous page ended in, the
+    spans before the first heading on the page continue that section.
+    """
+    lines = text.splitlines(keepends=True)
+    page_numbers = {heading_number(line) for line in lines}
+    spans = []
+    start = offset = 0
+    for line in lines:
+        number = parse_heading(line, section, page_numbers)
+        if number is not None:
+            if text[start:offset].strip():
+                spans.append((section, heading, start, offset))
+            section, heading, start = number, line.strip(), offset
+        offset += len(line)
+    if text[start:].strip():
+        spans.append((section, heading, start, len(text)))
+    return spans, section, heading
+
+
+def split_long(text, start, end, max_chars):
+    # Cut at line breaks, never right after an image mark so the mark stays
+    # with the text it illustrates
+    pieces = []
+    piece_start = offset = start
+    for line in text[start:end].splitlines(keepends=True):
+        if offset - piece_start + len(line) > max_chars and offset > piece_start \
+                and not IMAGE_MARK.match(text[piece_start:offset].splitlines()[-1]):
+            pieces.append((piece_start, offset))
+            piece_start = offset
+        line_start, offset = offset, offset + len(line)
+        # A single line over the limit is cut hard, a piece kept growing
+        # after an image mark only once it is twice the limit
+        limit = max_chars if line_start == piece_start else max_chars * 2
+        while offset - piece_start > limit:
+            pieces.append((piece_start, piece_start + max_chars))
+            piece_start += max_chars
+    if offset > piece_start:
+        pieces.append((piece_start, offset))
+    return pieces
+
+
+def section_name(section):
+    return '.'.join(str(n) for n in section) if section else None
+
+
+def chunk_page(page_number, text, section, heading, max_chars=CHUNK_MAX_CHARS, min_chars=CHUNK_MIN_CHARS):
+    """Chunk one page, returns (chunks, section and heading at the page end)."""
+    spans, section_out, heading_out = split_page(text, section, heading)
+
+    # Merge short neighbouring sections, the first one names the chunk
+    groups = []
+    for span in spans:
+        if groups and groups[-1][-1][3] - groups[-1][0][2] < min_chars \
+                and span[3] - groups[-1][0][2] <= max_chars:
+            groups[-1].append(span)
+        else:
+            groups.append([span])
+
+    chunks = []
+    for group in groups:
+        span_section, span_heading = group[0][0], group[0][1]
+        for start, end in split_long(text, group[0][2], group[-1][3], max_chars):
+            body = text[start:end].strip()
+            # Continuations and page carry-overs repeat the heading for context
+            if span_heading and not body.startswith(span_heading):
+                body = f"{span_heading}\n{body}"
+            chunks.append({
+                'page': page_number,
+                'section': section_name(span_section),
+                'heading': span_heading,
+                'sections': [section_name(s[0]) for s in group if s[2] < end and s[3] > start],
+                'start': start,
+                'end': end,
+                'images': [line for line in text[start:end].splitlines() if IMAGE_MARK.match(line)],
+                'text': body,
+            })
+    return chunks, section_out, heading_out
+
+
+def page_key(text, section, heading, max_chars, min_chars):
+    # A page chunks the same whenever its text, the section it starts in and
+    # the limits are the same, wherever it sits in the manual
+    payload = json.dumps([text, section, heading, max_chars, min_chars], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def chunk_document(document, pages, previous_state=None, previous_chunks=(),
+                   max_chars=CHUNK_MAX_CHARS, min_chars=CHUNK_MIN_CHARS):
+    """Chunk the (page number, text) pairs of a manual in page order.
+
+    Pages whose key is in `previous_state` reuse their chunks from
+    `previous_chunks` instead of being chunked again, so an updated manual
+    only re-chunks the pages that changed. Returns the chunks, the state to
+    pass in next time and counts of chunked and reused pages.
+    """
+    previous_pages = (previous_state or {}).get('pages', {})
+    reusable = {}
+    first_page = {}
+    for chunk in previous_chunks:
+        # Repeated identical pages share a key, take the chunks of the first
+        if first_page.setdefault(chunk['page_key'], chunk['page']) == chunk['page']:
+            reusable.setdefault(chunk['page_key'], []).append(chunk)
+
+    chunks = []
+    state = {'pages': {}}
+    stats = {'pages': 0, 'rechunked_pages': 0, 'reused_pages': 0}
+    section, heading = None, None
+    seen_ids = set()
+    for page_number, text in pages:
+        key = page_key(text, section, heading, max_chars, min_chars)
+        known = previous_pages.get(key)
+        stats['pages'] += 1
+        if known is not None and (known['chunks'] == 0 or key in reusable):
+            page_chunks = [
+                {**{k: v for k, v in chunk.items() if k not in ('id', 'document', 'page_key')}, 'page': page_number}
+                for chunk in reusable.get(key, [])
+            ]
+            section, heading = tuple(known['section']) if known['section'] else None, known['heading']
+            stats['reused_pages'] += 1
+        else:
+            page_chunks, section, heading = chunk_page(page_number, text, section, heading, max_chars, min_chars)
+            stats['rechunked_pages'] += 1
+        state['pages'][key] = {'section': section, 'heading': heading, 'chunks': len(page_chunks)}
+
+        for chunk in page_chunks:
+            chunk_id = hashlib.sha256(f"{document}\n{chunk['section']}\n{chunk['text']}".encode('utf-8')).hexdigest()
+            # Identical chunks, e.g. a repeated warning box, keep distinct ids
+            while chunk_id in seen_ids:
+                chunk_id = hashlib.sha256(chunk_id.encode('utf-8')).hexdigest()
+            seen_ids.add(chunk_id)
+            chunks.append({'id': chunk_id, 'document': document, **chunk, 'page_key': key})
+    stats['chunks'] = len(chunks)
+    return chunks, state, stats
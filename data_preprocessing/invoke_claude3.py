@@ -1,24 +1,85 @@
+import argparse
+import functools
 import json
+import os
+import sys
 import boto3
 import base64
 from io import BytesIO
+from pathlib import Path
+from botocore.config import Config
 from PIL import Image
 
+# Reuse the loader's rate limiter and backoff from utils/
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from utils import embedding
+from caption_cache import CaptionCache
+
 # Configuration
 SERVICE_NAME = "bedrock-runtime"
 REGION_NAME = "us-east-1"
 MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
 
-def invoke_claude_3_multimodal(prompt: str, base64_image_data: str) -> str:
+# Images written by the PDF Lambda, one object per content hash
+DEFAULT_SOURCE = "s3://gogoro-hackton-data-pipeline/images/"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+# Captions are cached by image bytes, prompt and model, set
+# CAPTION_CACHE_PATH="" to turn the local tier off
+CAPTION_CACHE_PATH = os.environ.get(
+    "CAPTION_CACHE_PATH", str(Path(__file__).parent / ".cache" / "captions.sqlite3")
+)
+CAPTION_CACHE_MAX_MB = int(os.environ.get("CAPTION_CACHE_MAX_MB", 64))
+# Optional shared tier, s3://bucket/prefix on S3 or an S3-compatible endpoint
+CAPTION_CACHE_S3_URI = os.environ.get("CAPTION_CACHE_S3_URI") or None
+CAPTION_CACHE_ENDPOINT_URL = os.environ.get("CAPTION_CACHE_ENDPOINT_URL") or None
+
+CAPTION_PROMPT = "請用繁體中文簡短描述這張機車使用手冊中的圖片, 包含圖中的按鍵、指示燈或零件名稱, 只輸出描述本身。"
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(max_pool_connections=10):
+    # One client per process, its connection pool is shared by the worker
+    # threads. Throttles and transient errors are retried by
+    # utils.embedding.call_with_backoff.
+    config = Config(
+        max_pool_connections=max_pool_connections,
+        retries={"total_max_attempts": 1},
+    )
+    return boto3.client(service_name=SERVICE_NAME, region_name=REGION_NAME, config=config)
+
+
+def get_cache(path=CAPTION_CACHE_PATH, max_mb=CAPTION_CACHE_MAX_MB, s3_uri=CAPTION_CACHE_S3_URI,
+              endpoint_url=CAPTION_CACHE_ENDPOINT_URL):
+    if not path and not s3_uri:
+        return None
+    return CaptionCache(MODEL_ID, path or None, max_mb * 1024 * 1024, s3_uri, endpoint_url)
+
+
+def media_type(image_bytes: bytes) -> str:
+    # Image objects are stored as .png whatever their format, Claude needs
+    # the real one
+    if image_bytes.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+def invoke_claude_3_multimodal(prompt: str, base64_image_data: str, image_media_type: str = "image/png", client=None) -> str:
     """
     Invoke Anthropic Claude 3 Sonnet to perform multimodal inference using the provided input.
 
     :param prompt: The text prompt for Claude 3.
     :param base64_image_data: The base64-encoded image data to be included in the request.
+    :param image_media_type: The media type of the image.
+    :param client: The bedrock-runtime client, the shared one by default.
     :return: The inferred response from the model.
     """
-    
-    client = boto3.client(service_name=SERVICE_NAME, region_name=REGION_NAME)
+
+    client = client or get_client()
 
     # Create the request body
     request_body = {
@@ -31,7 +92,7 @@ def invoke_claude_3_multimodal(prompt: str, base64_image_data: str) -> str:
                     {"type": "text", "text": prompt},
                     {
                         "type": "image",
-                        "source": {"type": "base64", "media_type": "image/png", "data": base64_image_data}
+                        "source": {"type": "base64", "media_type": image_media_type, "data": base64_image_data}
                     },
                 ],
             }
@@ -46,33 +107,157 @@ def invoke_claude_3_multimodal(prompt: str, base64_image_data: str) -> str:
         result = json.loads(response.get("body").read())
         return result['content'][0]['text'] if result.get("content") else ""
     except Exception as e:
-        print(f"Error invoking the model: {type(e).__name__}: {e}")
+        # Throttles and transient errors are retried by the caller
+        if not (embedding.is_throttling_error(e) or embedding.is_transient_error(e)):
+            print(f"Error invoking the model: {type(e).__name__}: {e}")
         raise
 
-def process_and_describe_image(image_path: str, prompt: str):
+def describe_image(image_bytes: bytes, prompt: str, client=None, cache=None, limiter=None):
+    """Caption an image through the cache, returns (caption, served from cache).
+
+    Only cache misses reach `invoke_claude_3_multimodal`, and with a
+    `limiter` only they count against the rate limit.
+    """
+    key = cache.key(image_bytes, prompt) if cache is not None else None
+    if key is not None:
+        description = cache.get(key)
+        if description is not None:
+            return description, True
+
+    base64_image_data = base64.b64encode(image_bytes).decode('utf-8')
+    invoke = lambda: invoke_claude_3_multimodal(prompt, base64_image_data, media_type(image_bytes), client)
+    description = embedding.call_with_backoff(invoke, limiter)
+    if key is not None:
+        cache.put(key, description)
+    return description, False
+
+
+def process_and_describe_image(image_path: str, prompt: str, cache=None):
     # Open the image and convert it to base64
     with open(image_path, "rb") as image_file:
         buffered = BytesIO(image_file.read())
-    base64_image_data = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
+
     # Invoke the multimodal function
-    description = invoke_claude_3_multimodal(prompt, base64_image_data)
+    description, _ = describe_image(buffered.getvalue(), prompt, cache=cache)
     return description
 
+
+def list_images(source: str, s3_client=None):
+    """Yield the image keys under an s3://bucket/prefix URI or the paths in a directory."""
+    if source.startswith("s3://"):
+        bucket, _, prefix = source[len("s3://"):].partition("/")
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].lower().endswith(IMAGE_EXTENSIONS):
+                    yield f"s3://{bucket}/{item['Key']}"
+    else:
+        for path in sorted(Path(source).rglob("*")):
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                yield str(path)
+
+
+def read_image(image_key: str, s3_client=None) -> bytes:
+    if image_key.startswith("s3://"):
+        bucket, _, key = image_key[len("s3://"):].partition("/")
+        return s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    with open(image_key, "rb") as image_file:
+        return image_file.read()
+
+
+def load_captioned(output_path: str) -> set:
+    # Keys already in the output, an interrupted run picks up where it stopped
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, encoding="utf-8") as f:
+        return {json.loads(line)["key"] for line in f if line.strip()}
+
+
+def caption_images(source, output_path, prompt=CAPTION_PROMPT, concurrency=8, requests_per_minute=60, max_images=None,
+                   cache=None):
+    """Caption every image under `source`, appending JSONL lines to `output_path`.
+
+    Requests run on `concurrency` threads sharing one pooled client and go
+    through a token bucket set to the account's requests per minute quota,
+    throttled requests back off and lower the rate. Images found in `cache`
+    are not sent to the model. Returns the number of captions written and of
+    images skipped because they were already done.
+    """
+    s3_client = boto3.client("s3") if source.startswith("s3://") else None
+    client = get_client(max_pool_connections=concurrency)
+    limiter = embedding.TokenBucket(requests_per_minute / 60, capacity=concurrency)
+
+    done = load_captioned(output_path)
+    keys = [key for key in list_images(source, s3_client) if key not in done]
+    if max_images is not None:
+        keys = keys[:max_images]
+    print(f"Captioning {len(keys)} images from {source}, {len(done)} already captioned")
+
+    def caption(image_key):
+        image_bytes = read_image(image_key, s3_client)
+        description, cached = describe_image(image_bytes, prompt, client, cache, limiter)
+        return {"key": image_key, "caption": description, "model": MODEL_ID, "cached": cached}
+
+    written = 0
+    with open(output_path, "a", encoding="utf-8") as output:
+        # Results come back on this thread in completion order
+        for record in embedding.embed_concurrently(keys, caption, concurrency=concurrency):
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            written += 1
+            if written % 100 == 0:
+                print(f"{written}/{len(keys)} images captioned")
+    print(f"{written} captions written to {output_path}, {len(keys) - written} failed")
+    if cache is not None:
+        print(f"Caption cache {cache.stats()}")
+    return written, len(done)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", type=str, default=None, help="Caption one local image and print it")
+    parser.add_argument(
+        "--source",
+        type=str,
+        default=DEFAULT_SOURCE,
+        help="s3://bucket/prefix or local directory of images to caption",
+    )
+    parser.add_argument("--output", type=str, default="captions.jsonl")
+    parser.add_argument("--prompt", type=str, default=CAPTION_PROMPT)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=60,
+        help="Bedrock InvokeModel quota for the model in this account and region",
+    )
+    parser.add_argument("--max-images", type=int, default=None)
+    parser.add_argument("--cache-path", type=str, default=CAPTION_CACHE_PATH, help="Local caption cache, \"\" to disable")
+    parser.add_argument("--cache-max-mb", type=int, default=CAPTION_CACHE_MAX_MB)
+    parser.add_argument("--cache-s3-uri", type=str, default=CAPTION_CACHE_S3_URI, help="s3://bucket/prefix shared caption cache")
+    parser.add_argument("--cache-endpoint-url", type=str, default=CAPTION_CACHE_ENDPOINT_URL, help="S3-compatible endpoint")
+    return parser.parse_args()
+
+
 # from langchain_core.prompts import ChatPromptTemplate
 # chat_template = ChatPromptTemplate()
 
 # chat_template.format_messages()
 
 if __name__ == "__main__":
-    
-    image_path = "/Users/rich/Desktop/gen-ai-hackton/test.png"
-    prompt ='''
-    請用繁體描述這張圖, 並且取名為Description, 
-    輸入格式限用這樣的格式: ![Image Descrption]({S3://gen-ai-hackton-image/}) 
-    把Description換成你的描述, 後面的路徑不能換, 但是你可以自訂檔名'''
-    
-    description = process_and_describe_image(image_path, prompt)
-    print(f"圖片描述: {description}")
-
+    args = parse_args()
+    cache = get_cache(args.cache_path, args.cache_max_mb, args.cache_s3_uri, args.cache_endpoint_url)
 
+    if args.image:
+        description = process_and_describe_image(args.image, args.prompt, cache)
+        print(f"圖片描述: {description}")
+    else:
+        caption_images(
+            args.source,
+            args.output,
+            prompt=args.prompt,
+            concurrency=args.concurrency,
+            requests_per_minute=args.requests_per_minute,
+            max_images=args.max_images,
+            cache=cache,
+        )
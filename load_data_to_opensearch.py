@@ -1,12 +1,16 @@
 import argparse
+import contextlib
+import itertools
 import json
 import os
 import sys
 
 import boto3
+from botocore.config import Config
 from loguru import logger
 
-from utils import dataset, opensearch
+from utils import artifact, checkpoint, dataset, embedding, opensearch, quantization
+from utils.index_spec import add_index_arguments, index_spec_from_args
 
 # logger
 logger.remove()
@@ -18,25 +22,111 @@ OPENSEARCH_USERNAME = os.environ.get("OPENSEARCH_USERNAME")
 OPENSEARCH_PASSWORD = os.environ.get("OPENSEARCH_PASSWORD")
 
 
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+DATASET_URL = "https://huggingface.co/datasets/sentence-transformers/embedding-training-data/resolve/main/gooaq_pairs.jsonl.gz"
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--recreate", type=bool, default=0)
     parser.add_argument("--early-stop", type=bool, default=0)
     parser.add_argument("--index", type=str, default="shiun")
     parser.add_argument("--region", type=str, default="us-east-1")
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default=DATASET_URL,
+        help="URL or local path of a JSONL dataset, optionally gzipped",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="Checkpoint journal path, defaults to .checkpoints/<index>.sqlite3",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report how many records would be embedded",
+    )
+    parser.add_argument(
+        "--artifact",
+        type=str,
+        default=".artifacts",
+        help="Directory of the local embedding artifact, empty to disable",
+    )
+    parser.add_argument(
+        "--artifact-dtype", type=str, default="float32", choices=["float32", "float16"]
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Load the index from the local embedding artifact, never calls Bedrock",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of embedding requests in flight",
+    )
+    parser.add_argument(
+        "--bulk-threads", type=int, default=4, help="Bulk requests in flight"
+    )
+    parser.add_argument(
+        "--bulk-chunk-bytes",
+        type=int,
+        default=10 * 1024 * 1024,
+        help="Maximum size of one bulk request body before compression",
+    )
+    parser.add_argument(
+        "--bulk-settings",
+        action="store_true",
+        help="Drop replicas and refresh while loading into an existing index, then force merge it",
+    )
+    parser.add_argument(
+        "--skip-force-merge",
+        action="store_true",
+        help="Do not force merge the index after loading",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=20,
+        help="Maximum embedding requests per second, match the Bedrock quota",
+    )
+    parser.add_argument(
+        "--search-pipeline",
+        type=str,
+        default=None,
+        help="Create or update this hybrid search pipeline, use with --text-analyzer",
+    )
+    parser.add_argument(
+        "--lexical-weight",
+        type=float,
+        default=0.3,
+        help="Weight of the BM25 score in the hybrid search pipeline, k-NN gets the rest",
+    )
+    add_index_arguments(parser)
 
     return parser.parse_known_args()
 
 
-def get_bedrock_client(region):
-    bedrock_client = boto3.client("bedrock-runtime", region_name=region)
+def get_bedrock_client(region, max_pool_connections=10):
+    # Retries, of throttles as well as 5xx, timeouts and dropped connections,
+    # are handled by utils.embedding so throttling also slows the shared rate
+    # limiter instead of every thread retrying on its own
+    config = Config(
+        max_pool_connections=max_pool_connections,
+        retries={"total_max_attempts": 1},
+    )
+    bedrock_client = boto3.client("bedrock-runtime", region_name=region, config=config)
     return bedrock_client
 
 
-def create_vector_embedding_with_bedrock(text, name, bedrock_client):
+def create_vector_embedding_with_bedrock(text, name, bedrock_client, doc_id=None):
     payload = {"inputText": f"{text}"}
     body = json.dumps(payload)
-    modelId = "amazon.titan-embed-text-v1"
+    modelId = EMBEDDING_MODEL_ID
     accept = "application/json"
     contentType = "application/json"
 
@@ -46,13 +136,65 @@ def create_vector_embedding_with_bedrock(text, name, bedrock_client):
     response_body = json.loads(response.get("body").read())
 
     embedding = response_body.get("embedding")
-    return {"_index": name, "text": text, "vector_field": embedding}
+    record = {"_index": name, "text": text, "vector_field": embedding}
+    if doc_id is not None:
+        record["_id"] = doc_id
+    return record
+
+
+def skip_indexed_records(records, journal, opensearch_client, index_name, stats):
+    # records are tuples starting with the doc id, checked against the local
+    # journal first and against the index only for ids the journal does not know
+    for batch in dataset.batched(records, 500):
+        new_ids = journal.filter_new(record[0] for record in batch)
+        if new_ids and opensearch_client is not None:
+            new_ids -= opensearch.get_existing_ids(
+                opensearch_client, index_name, new_ids
+            )
+        stats["skipped"] += len(batch) - len(new_ids)
+        for record in batch:
+            if record[0] in new_ids:
+                # Duplicated records in the dataset share an id, embed once
+                new_ids.discard(record[0])
+                stats["new"] += 1
+                yield record
+
+
+def persist_to_artifact(batches, embedding_artifact, stats):
+    for batch in batches:
+        # Persist first, a failed bulk must not lose paid-for embeddings
+        stats["embedded"] += embedding_artifact.append(batch)
+        yield batch
+
+
+def quantize_batches(batches, quantization_type):
+    # The artifact keeps full precision, only the copy sent to the index shrinks
+    for batch in batches:
+        yield [
+            {
+                **record,
+                "vector_field": quantization.quantize_vector(
+                    record["vector_field"], quantization_type
+                ),
+            }
+            for record in batch
+        ]
+
+
+def failed_ids(failed):
+    if not isinstance(failed, list):
+        return set()
+    return {
+        item["_id"]
+        for error in failed
+        for item in error.values()
+        if isinstance(item, dict) and "_id" in item
+    }
 
 
 def main():
     logger.info("Starting")
 
-    dataset_url = "https://huggingface.co/datasets/sentence-transformers/embedding-training-data/resolve/main/gooaq_pairs.jsonl.gz"
     early_stop_record_count = 100
 
     args, _ = parse_args()
@@ -65,72 +207,228 @@ def main():
     )
     logger.info("Preparing OpenSearch Index")
     opensearch_client = opensearch.get_opensearch_cluster_client(
-        OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD, region
+        OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD, region, pool_maxsize=args.bulk_threads
+    )
+
+    checkpoint_path = args.checkpoint or os.path.join(
+        ".checkpoints", f"{index_name}.sqlite3"
+    )
+    journal = checkpoint.CheckpointJournal(checkpoint_path)
+    logger.info(
+        f"Using checkpoint journal {checkpoint_path} with {len(journal)} indexed documents"
     )
 
     # Check if to delete OpenSearch index with the argument passed to the script --recreate 1
-    if args.recreate:
+    if args.recreate and not args.dry_run:
         response = opensearch.delete_opensearch_index(opensearch_client, index_name)
         if response:
             logger.info("OpenSearch index successfully deleted")
 
     logger.info(f"Checking if index {index_name} exists in OpenSearch cluster")
     exists = opensearch.check_opensearch_index(opensearch_client, index_name)
-    if not exists:
-        logger.info("Creating OpenSearch index")
-        success = opensearch.create_index(opensearch_client, index_name)
+    spec = index_spec_from_args(args)
+    quantization_type = spec.quantization
+    if not exists and not args.dry_run:
+        logger.info(f"Creating OpenSearch index with {spec}")
+        success = opensearch.create_index(opensearch_client, index_name, spec)
         if success:
-            logger.info("Creating OpenSearch index mapping")
-            success = opensearch.create_index_mapping(opensearch_client, index_name)
-            logger.info(f"OpenSearch Index mapping created")
+            logger.info(f"OpenSearch Index and mapping created")
+    elif exists:
+        # An existing index keeps the vector format it was created with
+        quantization_type = opensearch.get_index_quantization(
+            opensearch_client, index_name
+        )
+    if quantization_type:
+        logger.info(f"Indexing {quantization_type} quantized vectors")
 
-    # Download sample dataset from HuggingFace
-    logger.info("Downloading dataset from HuggingFace")
-    compressed_file_path = dataset.download_dataset(dataset_url)
-    if compressed_file_path is not None:
-        file_path = dataset.decompress_dataset(compressed_file_path)
-        if file_path is not None:
-            all_records = dataset.prep_for_put(file_path)
+    # The journal only vouches for the index it was filled for, a new or
+    # replaced index starts from an empty one
+    index_uuid = (
+        opensearch.get_index_uuid(opensearch_client, index_name)
+        if exists or not args.dry_run
+        else None
+    )
+    if not args.dry_run and journal.bind(index_uuid, created=not exists):
+        logger.info(f"Index {index_name} ({index_uuid}) is new or was replaced, checkpoint journal reset")
+
+    if args.search_pipeline and not args.dry_run:
+        if not spec.text_analyzer:
+            logger.warning(
+                "Hybrid search without --text-analyzer only matches the exact text"
+            )
+        opensearch.put_hybrid_search_pipeline(
+            opensearch_client, args.search_pipeline, lexical_weight=args.lexical_weight
+        )
+        logger.info(
+            f"Search pipeline {args.search_pipeline} ready, BM25 weight {args.lexical_weight}"
+        )
 
-    # Initialize bedrock client
-    bedrock_client = get_bedrock_client(region)
+    embedding_artifact = None
+    if args.artifact:
+        # Replays and dry runs only read it, and must not touch the rows a
+        # concurrent loader is writing
+        embedding_artifact = artifact.EmbeddingArtifact(
+            args.artifact,
+            EMBEDDING_MODEL_ID,
+            dtype=args.artifact_dtype,
+            writable=not (args.replay or args.dry_run),
+        )
+    elif args.replay:
+        raise ValueError("--replay needs an --artifact directory")
 
-    # Vector embedding using Amazon Bedrock Titan text embedding
-    all_json_records = []
-    logger.info(f"Creating embeddings for records")
+    if args.replay:
+        # (doc_id, text, vector) straight from the memory-mapped artifact
+        all_records = embedding_artifact.iter_records()
+    else:
+        # Stream the dataset (HuggingFace by default) straight through gzip,
+        # records are decoded lazily as the embedder asks for them
+        all_records = dataset.stream_records(args.dataset)
 
     # using the arg --early-stop
-    i = 0
-    for record in all_records:
-        i += 1
-        if args.early_stop:
-            if i > early_stop_record_count:
-                # Bulk put all records to OpenSearch
-                success, failed = opensearch.put_bulk_in_opensearch(
-                    all_json_records, opensearch_client
-                )
-                logger.info(
-                    f"Documents saved {success}, documents failed to save {failed}"
-                )
-                break
-        records_with_embedding = create_vector_embedding_with_bedrock(
-            record, index_name, bedrock_client
+    if args.early_stop:
+        all_records = itertools.islice(all_records, early_stop_record_count)
+
+    # Deterministic ids make reruns idempotent, records already indexed with
+    # the same content hash are skipped before paying for an embedding
+    if not args.replay:
+        all_records = (
+            (checkpoint.content_hash(text, EMBEDDING_MODEL_ID), text)
+            for text in all_records
+        )
+    stats = {"new": 0, "skipped": 0, "embedded": 0}
+    if args.dry_run and (
+        args.recreate
+        or not exists
+        or journal.index_uuid() not in (None, index_uuid)
+    ):
+        # Nothing would survive a recreate, and a missing or replaced index
+        # has none of the journal's ids
+        journal = checkpoint.CheckpointJournal(":memory:")
+    new_records = skip_indexed_records(
+        all_records,
+        journal,
+        opensearch_client if exists else None,
+        index_name,
+        stats,
+    )
+
+    if args.dry_run:
+        reused = 0
+        for record in new_records:
+            if args.replay or (
+                embedding_artifact is not None and record[0] in embedding_artifact
+            ):
+                reused += 1
+        logger.info(
+            f"Dry run: {stats['new'] - reused} records would be embedded, {reused} loaded from the artifact, {stats['skipped']} already indexed"
+        )
+        return
+
+    if args.replay:
+        records_with_embedding = (
+            {
+                "_index": index_name,
+                "_id": doc_id,
+                "text": text,
+                "vector_field": vector.tolist(),
+            }
+            for doc_id, text, vector in new_records
         )
-        logger.info(f"Embedding for record {i} created")
-        all_json_records.append(records_with_embedding)
-        if i % 500 == 0 or i == len(all_records) - 1:
-            # Bulk put all records to OpenSearch
-            success, failed = opensearch.put_bulk_in_opensearch(
-                all_json_records, opensearch_client
+    else:
+        # Initialize bedrock client
+        bedrock_client = get_bedrock_client(
+            region, max_pool_connections=args.concurrency
+        )
+        limiter = embedding.TokenBucket(args.rate, capacity=args.concurrency)
+
+        def embed_record(record):
+            doc_id, text = record
+            if embedding_artifact is not None:
+                vector = embedding_artifact.get(doc_id)
+                if vector is not None:
+                    return {
+                        "_index": index_name,
+                        "_id": doc_id,
+                        "text": text,
+                        "vector_field": vector,
+                    }
+            # Only Bedrock calls go through the rate limiter
+            return embedding.call_with_backoff(
+                lambda: create_vector_embedding_with_bedrock(
+                    text, index_name, bedrock_client, doc_id=doc_id
+                ),
+                limiter,
             )
-            all_json_records = []
-            logger.info(f"Documents saved {success}, documents failed to save {failed}")
 
-    logger.info("Finished creating records using Amazon Bedrock Titan text embedding")
+        # Vector embedding using Amazon Bedrock Titan text embedding
+        logger.info(
+            f"Creating embeddings for records with concurrency {args.concurrency} at up to {args.rate} requests/s"
+        )
+        records_with_embedding = embedding.embed_concurrently(
+            new_records, embed_record, concurrency=args.concurrency
+        )
+
+    # Embeddings arrive in completion order, the bulk writer does not care
+    batches = dataset.batched(records_with_embedding, 500)
+    if embedding_artifact is not None and not args.replay:
+        batches = persist_to_artifact(batches, embedding_artifact, stats)
+    if quantization_type == "byte":
+        batches = quantize_batches(batches, quantization_type)
+
+    writer = opensearch.BulkWriter(
+        opensearch_client,
+        thread_count=args.bulk_threads,
+        max_chunk_bytes=args.bulk_chunk_bytes,
+    )
+    # Replicas, refresh and segments of a live index are only touched when
+    # asked to, and of any index only once there is something to write
+    batches = iter(batches)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        logger.info(f"Nothing new to index, {index_name} settings left untouched")
+        batches = []
+        load_settings = contextlib.nullcontext({})
+    else:
+        batches = itertools.chain([first_batch], batches)
+        if not exists or args.bulk_settings:
+            load_settings = opensearch.bulk_load_settings(
+                opensearch_client, index_name, force_merge=not args.skip_force_merge
+            )
+        else:
+            logger.info(
+                f"Writing into existing index {index_name} with its own settings, see --bulk-settings"
+            )
+            load_settings = contextlib.nullcontext({})
+    with load_settings as load:
+        for all_json_records, success, failed in writer.write(batches):
+            logger.info(
+                f"Documents saved {success}, documents failed to save {len(failed)}, {writer.docs_per_second():.1f} docs/s"
+            )
+            not_saved = failed_ids(failed)
+            journal.mark_done(
+                record["_id"]
+                for record in all_json_records
+                if record["_id"] not in not_saved
+            )
+        load["documents"] = writer.success
 
-    logger.info("Cleaning up")
-    dataset.delete_file(compressed_file_path)
-    dataset.delete_file(file_path)
+    logger.info(
+        f"Indexed {writer.success} documents ({writer.failed} failed) at {writer.docs_per_second():.1f} docs/s"
+    )
+    if args.replay:
+        logger.info(
+            f"Replayed {stats['new']} records from the artifact, skipped {stats['skipped']} already indexed"
+        )
+    else:
+        logger.info(
+            f"Sent {stats['new']} new records to embedding, skipped {stats['skipped']} already indexed"
+        )
+        if embedding_artifact is not None:
+            logger.info(
+                f"{stats['embedded']} embedded with Bedrock, {stats['new'] - stats['embedded']} loaded from the artifact"
+            )
+
+    logger.info("Finished creating records using Amazon Bedrock Titan text embedding")
 
     logger.info("Finished")
 
@@ -0,0 +1,476 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from loguru import logger
+
+# logger
+logger.remove()
+logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
+
+# Fields a question log line may carry the question in, flow inputs first
+QUESTION_FIELDS = ("question", "query", "ask", "body", "title")
+# The streamed answer starts with the sources block, the first token is the
+# first non-empty chunk after it
+SOURCES_PREFIX = "Sources:"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Replay questions against the chat flow at increasing load and report the saturation curve"
+    )
+    parser.add_argument(
+        "--questions",
+        type=str,
+        default=None,
+        help="JSONL question log, one {\"question\", \"chat_history\"} per line. "
+        "Synthetic questions when omitted with --backend fake",
+    )
+    parser.add_argument(
+        "--url",
+        type=str,
+        default=None,
+        help="Score endpoint of a served flow, e.g. http://localhost:8080/score. Calls the flow in process when omitted",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="fake",
+        choices=["fake", "live"],
+        help="In process only, fake Bedrock and OpenSearch or the configured live ones",
+    )
+    parser.add_argument("--stream", type=int, default=1, help="1 to stream answers, 0 for blocking calls")
+    parser.add_argument(
+        "--rates",
+        type=str,
+        default=None,
+        help="Open loop: comma separated arrival rates in requests/s, one step each",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=str,
+        default="1,2,4,8,16",
+        help="Closed loop: comma separated numbers of concurrent chats, used without --rates",
+    )
+    parser.add_argument(
+        "--arrivals",
+        type=str,
+        default="poisson",
+        choices=["poisson", "constant"],
+        help="Open loop inter-arrival times",
+    )
+    parser.add_argument("--step-duration", type=float, default=30, help="Seconds of load per step")
+    parser.add_argument("--pause", type=float, default=2, help="Seconds between steps")
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=256,
+        help="Open loop: requests arriving beyond this many in flight fail as dropped",
+    )
+    parser.add_argument("--timeout", type=float, default=120, help="HTTP request timeout in seconds")
+    parser.add_argument("--warmup-requests", type=int, default=2)
+    parser.add_argument(
+        "--slo-p95-ms",
+        type=float,
+        default=5000,
+        help="A step whose p95 latency exceeds this is saturated",
+    )
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.01,
+        help="A step with more errors than this is saturated",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write the report as JSON")
+    parser.add_argument(
+        "--requests-log", type=str, default=None, help="Write every request as a JSONL line"
+    )
+    parser.add_argument(
+        "--flow-log-level",
+        type=str,
+        default="WARNING",
+        help="Log level of the flow's own per-turn logging when in process",
+    )
+    # Stubbed backends, the same knobs as benchmark.py
+    parser.add_argument("--embedding-latency-ms", type=float, default=20)
+    parser.add_argument("--first-token-latency-ms", type=float, default=300)
+    parser.add_argument("--token-latency-ms", type=float, default=10)
+    parser.add_argument("--output-tokens", type=int, default=60)
+    parser.add_argument("--opensearch-latency-ms", type=float, default=5)
+    parser.add_argument("--corpus", type=int, default=5000, help="Documents in the fake index")
+    # Unknown arguments (--index, --bedrock-model-id, ...) are left for the
+    # flow's own parser when it runs in process
+    return parser.parse_known_args()
+
+
+def load_questions(path):
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            row = row.get("inputs", row)
+            question = next((row[k] for k in QUESTION_FIELDS if row.get(k)), None)
+            if question is None:
+                logger.warning(f"Skipping line without a question: {line.strip()[:80]}")
+                continue
+            questions.append((question, row.get("chat_history") or []))
+    return questions
+
+
+class InProcessTarget:
+    """Calls the promptflow tool `main` of main_flow on the caller's thread."""
+
+    def __init__(self, flow, stream):
+        self.flow = flow
+        self.stream = stream
+
+    def send(self, question, chat_history):
+        answer = self.flow.main(question, chat_history, stream=self.stream)
+        if self.stream:
+            yield from answer
+        else:
+            yield answer
+
+    def warm_up(self):
+        logger.info(f"Flow warmed up: {self.flow.warm_up()}")
+
+
+class HttpTarget:
+    """POSTs to a served flow, e.g. `pf flow serve --source main_flow --port 8080`.
+
+    Streams are read as the server-sent events of promptflow serving, one
+    `data: {"answer": chunk}` event per chunk.
+    """
+
+    def __init__(self, url, stream, timeout, output_field="answer"):
+        self.url = url
+        self.stream = stream
+        self.timeout = timeout
+        self.output_field = output_field
+        self._local = threading.local()
+
+    def session(self):
+        # One keep-alive connection per load generator thread
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def send(self, question, chat_history):
+        payload = {"question": question, "chat_history": chat_history, "stream": self.stream}
+        headers = {"Accept": "text/event-stream" if self.stream else "application/json"}
+        with self.session().post(
+            self.url, json=payload, headers=headers, stream=self.stream, timeout=self.timeout
+        ) as response:
+            response.raise_for_status()
+            if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith("data:"):
+                        chunk = json.loads(line[len("data:"):]).get(self.output_field)
+                        if chunk:
+                            yield chunk
+            else:
+                yield response.json()[self.output_field]
+
+    def warm_up(self):
+        pass
+
+
+def build_target(args):
+    if args.url:
+        logger.info(f"Sending requests to {args.url}")
+        return HttpTarget(args.url, bool(args.stream), args.timeout), None
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "main_flow"))
+    corpus = None
+    if args.backend == "fake":
+        from benchmarks.scenarios import install_chat_fakes
+
+        flow, _, _, corpus = install_chat_fakes(args, args.corpus)
+        logger.info(f"Calling the flow in process with fake backends and {len(corpus)} indexed documents")
+    else:
+        import is_question_relevant as flow
+
+        logger.info("Calling the flow in process with the configured backends")
+    # The flow reconfigures the logger on import, keep its per-turn logs quiet
+    logger.remove()
+    logger.add(
+        sys.stdout,
+        filter={"": args.flow_log_level, "__main__": os.getenv("LOG_LEVEL", "INFO")},
+    )
+    return InProcessTarget(flow, bool(args.stream)), corpus
+
+
+class Recorder:
+    """Sends one request and records its latency, time to first token and error.
+
+    Latency is measured from the scheduled arrival, so in the open loop the
+    time a request waited for a free thread counts against it.
+    """
+
+    def __init__(self, target, questions):
+        self.target = target
+        self.questions = questions
+        self.records = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def next_question(self):
+        with self._lock:
+            index = next(self._counter) % len(self.questions)
+        return index, self.questions[index]
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def begin(self):
+        # Counted from submission, a request waiting for a thread is in flight
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def send(self, step, scheduled):
+        index, (question, chat_history) = self.next_question()
+        started = time.perf_counter()
+        first_token = None
+        chars = 0
+        error = None
+        try:
+            for chunk in self.target.send(question, chat_history):
+                if first_token is None and chunk and not chunk.startswith(SOURCES_PREFIX):
+                    first_token = time.perf_counter()
+                chars += len(chunk)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+        ended = time.perf_counter()
+        with self._lock:
+            self.in_flight -= 1
+        self.add({
+            "step": step,
+            "question": index,
+            "scheduled": round(scheduled, 6),
+            "queue_ms": round((started - scheduled) * 1000, 3),
+            "latency_ms": round((ended - scheduled) * 1000, 3),
+            "ttft_ms": round((first_token - scheduled) * 1000, 3) if first_token else None,
+            "chars": chars,
+            "error": error,
+        })
+
+    def drop(self, step, scheduled):
+        self.add({
+            "step": step,
+            "question": None,
+            "scheduled": round(scheduled, 6),
+            "queue_ms": 0.0,
+            "latency_ms": 0.0,
+            "ttft_ms": None,
+            "chars": 0,
+            "error": "dropped: too many requests in flight",
+        })
+
+
+def arrival_times(rate, duration, arrivals, rng):
+    times = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate) if arrivals == "poisson" else 1 / rate
+        if t >= duration:
+            return times
+        times.append(t)
+
+
+def run_open_step(recorder, step, rate, args, rng):
+    """Requests arrive at `rate` per second whatever the flow's latency."""
+    times = arrival_times(rate, args.step_duration, args.arrivals, rng)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.max_in_flight) as executor:
+        for offset in times:
+            scheduled = started + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if recorder.in_flight >= args.max_in_flight:
+                recorder.drop(step, scheduled)
+                continue
+            recorder.begin()
+            executor.submit(recorder.send, step, scheduled)
+    return started
+
+
+def run_closed_step(recorder, step, concurrency, args):
+    """`concurrency` chats each send their next question as soon as answered."""
+    started = time.perf_counter()
+    deadline = started + args.step_duration
+
+    def chat():
+        while time.perf_counter() < deadline:
+            recorder.begin()
+            recorder.send(step, time.perf_counter())
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(chat)
+    return started
+
+
+def percentiles(values, prefix):
+    if not values:
+        return {f"{prefix}_p50_ms": None, f"{prefix}_p95_ms": None, f"{prefix}_p99_ms": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        f"{prefix}_p50_ms": round(float(p50), 1),
+        f"{prefix}_p95_ms": round(float(p95), 1),
+        f"{prefix}_p99_ms": round(float(p99), 1),
+    }
+
+
+def summarize_step(step, load, records, started, ended, max_in_flight, args):
+    ok = [r for r in records if r["error"] is None]
+    errors = len(records) - len(ok)
+    elapsed = ended - started
+    summary = {
+        "step": step,
+        "load": load,
+        "requests": len(records),
+        "errors": errors,
+        "error_rate": round(errors / len(records), 4) if records else 0.0,
+        "offered_per_s": round(len(records) / args.step_duration, 2),
+        # Completions over the step and the drain of its last requests
+        "throughput_per_s": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "max_in_flight": max_in_flight,
+        **percentiles([r["latency_ms"] for r in ok], "latency"),
+        **percentiles([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None], "ttft"),
+        **percentiles([r["queue_ms"] for r in ok], "queue"),
+    }
+    reasons = []
+    if summary["latency_p95_ms"] is not None and summary["latency_p95_ms"] > args.slo_p95_ms:
+        reasons.append(f"p95 {summary['latency_p95_ms']:.0f}ms over {args.slo_p95_ms:.0f}ms")
+    if summary["error_rate"] > args.max_error_rate:
+        reasons.append(f"error rate {summary['error_rate']:.1%}")
+    if not ok:
+        reasons.append("no successful requests")
+    summary["saturated"] = bool(reasons)
+    summary["saturation_reasons"] = reasons
+    return summary
+
+
+def print_report(steps, unit):
+    widest = max((s["latency_p95_ms"] or 0 for s in steps), default=0) or 1
+    print(
+        f"{unit:>12} {'reqs':>6} {'err%':>6} {'thru/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'ttft p50':>9} {'ttft p95':>9}  p95 latency"
+    )
+
+    def cell(value):
+        return f"{value:9.0f}" if value is not None else f"{'-':>9}"
+
+    for s in steps:
+        bar = "#" * max(1, round(40 * (s["latency_p95_ms"] or 0) / widest))
+        print(
+            f"{s['load']:>12g} {s['requests']:>6} {s['error_rate']:>6.1%} {s['throughput_per_s']:>8.2f} "
+            f"{cell(s['latency_p50_ms'])} {cell(s['latency_p95_ms'])} {cell(s['latency_p99_ms'])} "
+            f"{cell(s['ttft_p50_ms'])} {cell(s['ttft_p95_ms'])}  {bar}{' saturated' if s['saturated'] else ''}"
+        )
+
+
+def main():
+    args, _ = parse_args()
+    target, corpus = build_target(args)
+
+    if args.questions:
+        questions = load_questions(args.questions)
+    elif corpus is not None:
+        from benchmarks.scenarios import questions as synthetic_questions
+
+        questions = [(q, []) for q in synthetic_questions(corpus, 1000, seed=args.seed)]
+    else:
+        raise ValueError("--questions is needed unless the flow runs in process with --backend fake")
+    if not questions:
+        raise ValueError(f"No questions in {args.questions}")
+    logger.info(f"Replaying {len(questions)} questions")
+
+    target.warm_up()
+    warm = Recorder(target, questions)
+    for _ in range(args.warmup_requests):
+        warm.begin()
+        warm.send("warmup", time.perf_counter())
+
+    open_loop = bool(args.rates)
+    loads = [float(x) if open_loop else int(x) for x in (args.rates or args.concurrency).split(",") if x.strip()]
+    unit = "req/s" if open_loop else "concurrency"
+    rng = random.Random(args.seed)
+    recorder = Recorder(target, questions)
+    steps = []
+    for step, load in enumerate(loads):
+        logger.info(f"Step {step}: {load:g} {unit} for {args.step_duration:g}s")
+        recorder.max_in_flight = 0
+        count = len(recorder.records)
+        if open_loop:
+            started = run_open_step(recorder, step, load, args, rng)
+        else:
+            started = run_closed_step(recorder, step, load, args)
+        ended = time.perf_counter()
+        summary = summarize_step(
+            step, load, recorder.records[count:], started, ended, recorder.max_in_flight, args
+        )
+        steps.append(summary)
+        logger.info(
+            f"Step {step}: {summary['throughput_per_s']:.2f} req/s, p95 {summary['latency_p95_ms']} ms, "
+            f"ttft p95 {summary['ttft_p95_ms']} ms, {summary['errors']} errors"
+            + (f", saturated: {'; '.join(summary['saturation_reasons'])}" if summary["saturated"] else "")
+        )
+        if step < len(loads) - 1:
+            time.sleep(args.pause)
+
+    print_report(steps, unit)
+    knee = next((s for s in steps if s["saturated"]), None)
+    sustained = [s for s in steps if not s["saturated"] and (knee is None or s["step"] < knee["step"])]
+    report = {
+        "target": args.url or f"in process ({args.backend} backends)",
+        "mode": "open" if open_loop else "closed",
+        "stream": bool(args.stream),
+        "step_duration_s": args.step_duration,
+        "slo_p95_ms": args.slo_p95_ms,
+        "max_error_rate": args.max_error_rate,
+        "questions": len(questions),
+        "steps": steps,
+        "max_sustained_load": sustained[-1]["load"] if sustained else None,
+        "saturated_at": knee["load"] if knee else None,
+    }
+    if knee is None:
+        logger.info(f"Not saturated up to {loads[-1]:g} {unit}, raise the load to find the knee")
+    else:
+        sustained_text = (
+            f"sustained {report['max_sustained_load']:g} {unit}" if sustained else "no step was sustained"
+        )
+        logger.info(
+            f"Saturated at {knee['load']:g} {unit} ({'; '.join(knee['saturation_reasons'])}), {sustained_text}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Report written to {args.output}")
+    if args.requests_log:
+        with open(args.requests_log, "w") as f:
+            for record in recorder.records:
+                f.write(json.dumps(record) + "\n")
+        logger.info(f"{len(recorder.records)} requests written to {args.requests_log}")
+
+
+if __name__ == "__main__":
+    main()
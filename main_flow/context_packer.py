@@ -0,0 +1,149 @@
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+# CJK ideographs, kana and fullwidth forms are about one token each, the rest
+# of the text averages about four characters per token
+_CJK = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@dataclass
+class PackResult:
+    docs: List[Document]
+    tokens: int
+    retrieved_tokens: int
+    duplicates: int
+    over_budget: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.retrieved_tokens - self.tokens
+
+
+class ContextPacker:
+    """Fit retrieved chunks into a token budget before they reach the prompt.
+
+    Candidates are picked greedily by maximal marginal relevance over their
+    embeddings, passed next to the documents as `vectors`: each step takes the chunk with the best
+    `mmr_lambda * relevance - (1 - mmr_lambda) * similarity to the picked
+    chunks`, chunks at least `duplicate_threshold` cosine-similar to a picked
+    one are dropped as near-duplicates, and chunks that no longer fit in
+    `max_tokens` are skipped. The survivors are returned most relevant first.
+    A `max_tokens` of 0 disables the budget.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 3000,
+        mmr_lambda: float = 0.7,
+        duplicate_threshold: float = 0.95,
+    ):
+        self.max_tokens = max_tokens
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_threshold = duplicate_threshold
+        self._lock = threading.Lock()
+        self._turns = 0
+        self._tokens_saved = 0
+
+    @staticmethod
+    def _normalized(vectors) -> Optional[np.ndarray]:
+        if vectors is None or any(v is None for v in vectors):
+            return None
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def pack(
+        self, docs: Sequence[Document], query_embedding=None, vectors=None
+    ) -> PackResult:
+        tokens = np.asarray([estimate_tokens(d.page_content) for d in docs])
+        retrieved_tokens = int(tokens.sum())
+        vectors = self._normalized(vectors) if docs else None
+
+        if vectors is not None and query_embedding is not None:
+            query = np.asarray(query_embedding, dtype=np.float32)
+            relevance = vectors @ (query / max(np.linalg.norm(query), 1e-12))
+        else:
+            # Retrieval order is already by relevance
+            relevance = -np.arange(len(docs), dtype=np.float32)
+        if vectors is not None:
+            similarity = vectors @ vectors.T
+        else:
+            similarity = np.zeros((len(docs), len(docs)), dtype=np.float32)
+
+        budget = self.max_tokens if self.max_tokens > 0 else np.inf
+        picked: List[int] = []
+        remaining = np.ones(len(docs), dtype=bool)
+        max_similarity = np.full(len(docs), -np.inf, dtype=np.float32)
+        used = 0
+        duplicates = over_budget = 0
+        while remaining.any():
+            redundancy = np.where(np.isfinite(max_similarity), max_similarity, 0)
+            score = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            candidate = int(np.argmax(np.where(remaining, score, -np.inf)))
+            remaining[candidate] = False
+            if max_similarity[candidate] >= self.duplicate_threshold:
+                duplicates += 1
+                continue
+            if used + tokens[candidate] > budget:
+                over_budget += 1
+                continue
+            picked.append(candidate)
+            used += int(tokens[candidate])
+            max_similarity = np.maximum(max_similarity, similarity[candidate])
+
+        picked.sort(key=lambda i: -relevance[i])
+        result = PackResult(
+            docs=[docs[i] for i in picked],
+            tokens=used,
+            retrieved_tokens=retrieved_tokens,
+            duplicates=duplicates,
+            over_budget=over_budget,
+        )
+        with self._lock:
+            self._turns += 1
+            self._tokens_saved += result.tokens_saved
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"turns": self._turns, "tokens_saved": self._tokens_saved}
+
+
+def history_turn_text(turn: Dict[str, Any]) -> str:
+    # promptflow chat history entries: {"inputs": {...}, "outputs": {...}}
+    inputs = turn.get("inputs", {})
+    outputs = turn.get("outputs", {})
+    question = inputs.get("question", inputs.get("query", ""))
+    answer = outputs.get("answer", "")
+    if not isinstance(answer, str):
+        answer = str(answer)
+    return f"Human: {question}\nAssistant: {answer}"
+
+
+def trim_history(chat_history: Sequence[Dict[str, Any]], max_tokens: int):
+    """Keep the most recent turns that fit in `max_tokens`.
+
+    Returns (history text, tokens kept, tokens of the full history).
+    """
+    turns = [history_turn_text(turn) for turn in chat_history or []]
+    total = sum(estimate_tokens(t) for t in turns)
+    kept: List[str] = []
+    used = 0
+    for text in reversed(turns):
+        cost = estimate_tokens(text)
+        if used + cost > max_tokens:
+            break
+        kept.append(text)
+        used += cost
+    return "\n\n".join(reversed(kept)), used, total
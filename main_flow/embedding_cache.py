@@ -0,0 +1,184 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+
+def normalize_query(text: str) -> str:
+    # NFKC folds full-width characters (common in Traditional Chinese input),
+    # so "休眠模式是什麼？" and "休眠模式是什麼?" share one entry
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split()).casefold()
+
+
+def cache_key(text: str, model_id: str) -> str:
+    key = f"{model_id}\x00{normalize_query(text)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class SQLiteEmbeddingStore:
+    """On-disk embedding store shared by every worker on the host."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model_id TEXT NOT NULL, "
+            "vector BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return array("f", row[0]).tolist()
+
+    def put_many(self, items: List[Tuple[str, str, List[float]]]):
+        now = time.time()
+        rows = [
+            (key, model_id, array("f", vector).tobytes(), now)
+            for key, model_id, vector in items
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper with an in-memory LRU/TTL tier in front of SQLite.
+
+    Lookups go memory -> disk -> wrapped embeddings client. Disk entries never
+    expire because an embedding only depends on the text and the model id, the
+    TTL only bounds how long a vector stays pinned in process memory.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_id: str,
+        path: Optional[str] = None,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600,
+    ):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.store = SQLiteEmbeddingStore(path) if path else None
+        self._memory: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _get_memory(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, vector = entry
+            if expires_at < time.monotonic():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return vector
+
+    def _put_memory(self, key: str, vector: List[float]):
+        with self._lock:
+            self._memory[key] = (time.monotonic() + self.ttl_seconds, vector)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        vector = self._get_memory(key)
+        if vector is not None:
+            return vector
+        if self.store is not None:
+            vector = self.store.get(key)
+            if vector is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._put_memory(key, vector)
+                return vector
+        return None
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [cache_key(text, self.model_id) for text in texts]
+        vectors: List[Optional[List[float]]] = [self._lookup(key) for key in keys]
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            computed = self.embeddings.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+                self._put_memory(keys[i], vector)
+            if self.store is not None:
+                self.store.put_many(
+                    [(keys[i], self.model_id, vectors[i]) for i in missing]
+                )
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        key = cache_key(text, self.model_id)
+        vector = self._lookup(key)
+        if vector is not None:
+            return vector
+
+        with self._lock:
+            self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        self._put_memory(key, vector)
+        if self.store is not None:
+            self.store.put_many([(key, self.model_id, vector)])
+        return vector
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            stats = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+        if self.store is not None:
+            stats["disk_entries"] = len(self.store)
+        return stats
+
+    def log_stats(self):
+        logger.info(f"Embedding cache {self.stats()}")
@@ -1,24 +1,34 @@
 import argparse
+import functools
 import os
 import sys
 from pathlib import Path
 from typing import Any, Dict, List
 
-import boto3
 from dotenv import load_dotenv
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains.retrieval import create_retrieval_chain
-from langchain.chains.retrieval_qa.base import RetrievalQA
-from langchain.prompts import ChatPromptTemplate
-from langchain_aws import ChatBedrock
-from langchain_aws.embeddings import BedrockEmbeddings
-from langchain_community.vectorstores.opensearch_vector_search import (
-    OpenSearchVectorSearch,
-)
 from loguru import logger
-from opensearchpy import OpenSearch
 from promptflow.tools.aoai import tool
 
+# utils/ is copied into the flow snapshot by additional_includes, when running
+# from a checkout it sits next to main_flow/
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import tracing
+from rag_pipeline import (
+    PipelineConfig,
+    create_langchain_vector_embedding_using_bedrock,
+    create_opensearch_vector_search_client,
+    get_bedrock_client,
+    get_model,
+    get_opensearch_client,
+    get_pipeline,
+)
+from utils.opensearch import (
+    create_index,
+    create_index_mapping,
+    delete_opensearch_index,
+)
+
 # logger
 logger.remove()
 logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
@@ -37,7 +47,55 @@ AZURE_EMBEDDINGS_DEPLOYMENT_NAME = os.environ.get("AZURE_EMBEDDINGS_DEPLOYMENT_N
 OPENSEARCH_ENDPOINT = os.environ.get("OPENSEARCH_ENDPOINT")
 OPENSEARCH_USERNAME = os.environ.get("OPENSEARCH_USERNAME")
 OPENSEARCH_PASSWORD = os.environ.get("OPENSEARCH_PASSWORD")
+# Minimum k-NN score for a chunk to reach the prompt, and the score drop
+# between neighbouring chunks that ends the context early (0 disables it)
 RAG_THRESHOLD = float(os.environ.get("RAG_THRESHOLD", 0.5))
+RAG_MAX_GAP = float(os.environ.get("RAG_MAX_GAP", 0))
+
+# Token budgets for the retrieved context and the chat history in the prompt
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", 3000))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.environ.get("CONTEXT_DUPLICATE_THRESHOLD", 0.95))
+HISTORY_MAX_TOKENS = int(os.environ.get("HISTORY_MAX_TOKENS", 1000))
+
+# Query embedding cache, set EMBEDDING_CACHE_PATH="" to keep it in memory only
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH",
+    str(Path(__file__).parent / ".cache" / "embeddings.sqlite3"),
+)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 1024))
+EMBEDDING_CACHE_TTL = float(os.environ.get("EMBEDDING_CACHE_TTL", 3600))
+
+# Semantic answer cache, set SEMANTIC_CACHE_SIZE=0 to disable it
+SEMANTIC_CACHE_PATH = os.environ.get(
+    "SEMANTIC_CACHE_PATH",
+    str(Path(__file__).parent / ".cache" / "answers.sqlite3"),
+)
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", 512))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+
+# Re-rank results of a quantized index with the loader's float32 artifact
+RESCORE_ARTIFACT_PATH = os.environ.get("RESCORE_ARTIFACT_PATH") or None
+RESCORE_OVERSAMPLE = int(os.environ.get("RESCORE_OVERSAMPLE", 4))
+
+# VECTOR_BACKEND=local searches the embedding artifact in process, no OpenSearch
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "opensearch")
+LOCAL_INDEX_PATH = os.environ.get(
+    "LOCAL_INDEX_PATH", str(Path(__file__).resolve().parent.parent / ".artifacts")
+)
+LOCAL_INDEX_TYPE = os.environ.get("LOCAL_INDEX_TYPE", "auto")
+
+# Hybrid BM25 + k-NN retrieval through this OpenSearch search pipeline
+HYBRID_SEARCH_PIPELINE = os.environ.get("HYBRID_SEARCH_PIPELINE") or None
+
+# Per-stage latency spans of every turn: "log" writes one JSON line per turn,
+# "histogram" keeps percentiles in process, "jsonl" appends to TRACE_FILE and
+# "module:Class" loads a custom exporter
+TRACE_EXPORTERS = os.environ.get("TRACE_EXPORTERS", "log,histogram").split(",")
+TRACE_FILE = os.environ.get("TRACE_FILE") or None
+TRACE_LOG_LEVEL = os.environ.get("TRACE_LOG_LEVEL", "INFO")
+TRACER, LATENCY_HISTOGRAMS = tracing.build_tracer(
+    TRACE_EXPORTERS, TRACE_FILE, TRACE_LOG_LEVEL
+)
 
 
 def parse_args():
@@ -57,136 +115,121 @@ def parse_args():
     return parser.parse_known_args()
 
 
-def get_model(model: str = "claude 3 sonnet") -> ChatBedrock:
-    model = model.lower()
-    if model == "claude 3 sonnet":
-        llm = ChatBedrock(
-            credentials_profile_name=AWS_PROFILE,
-            model_id="anthropic.claude-3-sonnet-20240229-v1:0",
-            streaming=True,
-        )
-
-    return llm
-
-
-def get_bedrock_client(region):
-    bedrock_client = boto3.client("bedrock-runtime", region_name=region)
-    return bedrock_client
-
-
-def create_langchain_vector_embedding_using_bedrock(
-    bedrock_client, bedrock_embedding_model_id
-):
-    bedrock_embeddings_client = BedrockEmbeddings(
-        client=bedrock_client, model_id=bedrock_embedding_model_id
-    )
-    return bedrock_embeddings_client
-
-
-def get_opensearch_client(cluster_url, username, password):
-
-    client = OpenSearch(
-        hosts=[cluster_url], http_auth=(username, password), verify_certs=True
-    )
-    return client
-
-
-def create_opensearch_vector_search_client(
-    index_name,
-    bedrock_embeddings_client,
-    opensearch_endpoint=OPENSEARCH_ENDPOINT,
-    opensearch_username=OPENSEARCH_USERNAME,
-    opensearch_password=OPENSEARCH_PASSWORD,
-    _is_aoss=False,
-):
-    docsearch = OpenSearchVectorSearch(
-        index_name=index_name,
-        embedding_function=bedrock_embeddings_client,
-        opensearch_url=opensearch_endpoint,
-        http_auth=(opensearch_username, opensearch_password),
-        is_aoss=_is_aoss,
+@functools.lru_cache(maxsize=None)
+def get_pipeline_config() -> PipelineConfig:
+    # argv does not change during the life of a worker, parse it once
+    args, _ = parse_args()
+    return PipelineConfig(
+        index_name=args.index,
+        region=args.region,
+        bedrock_model_id=args.bedrock_model_id,
+        bedrock_embedding_model_id=args.bedrock_embedding_model_id,
+        opensearch_endpoint=OPENSEARCH_ENDPOINT,
+        opensearch_username=OPENSEARCH_USERNAME,
+        opensearch_password=OPENSEARCH_PASSWORD,
+        credentials_profile_name=AWS_PROFILE,
+        embedding_cache_path=EMBEDDING_CACHE_PATH,
+        embedding_cache_size=EMBEDDING_CACHE_SIZE,
+        embedding_cache_ttl=EMBEDDING_CACHE_TTL,
+        semantic_cache_path=SEMANTIC_CACHE_PATH,
+        semantic_cache_size=SEMANTIC_CACHE_SIZE,
+        semantic_cache_threshold=SEMANTIC_CACHE_THRESHOLD,
+        rescore_artifact_path=RESCORE_ARTIFACT_PATH,
+        rescore_oversample=RESCORE_OVERSAMPLE,
+        vector_backend=VECTOR_BACKEND,
+        local_index_path=LOCAL_INDEX_PATH,
+        local_index_type=LOCAL_INDEX_TYPE,
+        hybrid_search_pipeline=HYBRID_SEARCH_PIPELINE,
+        relevance_threshold=RAG_THRESHOLD,
+        relevance_max_gap=RAG_MAX_GAP,
+        context_max_tokens=CONTEXT_MAX_TOKENS,
+        context_duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD,
+        history_max_tokens=HISTORY_MAX_TOKENS,
     )
-    return docsearch
 
 
-def create_index(opensearch_client, index_name):
-    settings = {"settings": {"index": {"knn": True, "knn.space_type": "cosinesimil"}}}
-    response = opensearch_client.indices.create(index=index_name, body=settings)
-    return bool(response["acknowledged"])
+def warm_up():
+    pipeline = get_pipeline(get_pipeline_config())
+    pipeline.warm_up()
+    status = pipeline.health_check()
+    if LATENCY_HISTOGRAMS is not None:
+        status["latency"] = LATENCY_HISTOGRAMS.stats()
+    return status
 
 
-def create_index_mapping(opensearch_client, index_name):
-    response = opensearch_client.indices.put_mapping(
-        index=index_name,
-        body={
-            "properties": {
-                "vector_field": {"type": "knn_vector", "dimension": 1536},
-                "text": {"type": "keyword"},
-            }
-        },
-    )
-    return bool(response["acknowledged"])
+def format_sources(docs, max_chars=80):
+    lines = ["Sources:"]
+    for i, d in enumerate(docs, start=1):
+        snippet = " ".join(d.page_content.split())
+        if len(snippet) > max_chars:
+            snippet = snippet[:max_chars] + "…"
+        lines.append(f"[{i}] {snippet}")
+    return "\n".join(lines) + "\n\n"
 
 
-def delete_opensearch_index(opensearch_client, index_name):
-    logger.info(f"Trying to delete index {index_name}")
+def stream_answer(config, query, chat_history=None):
+    # The turn and its trace start with the first read of the stream, a
+    # generator that is dropped unread has nothing to finish
+    trace = TRACER.start("chat_turn", stream=True, history_turns=len(chat_history or []))
     try:
-        response = opensearch_client.indices.delete(index=index_name)
-        logger.info(f"Index {index_name} deleted")
-        return response["acknowledged"]
+        with tracing.activate(trace):
+            with tracing.span("client_setup"):
+                pipeline = get_pipeline(config)
+            streaming_answer = pipeline.stream(query, chat_history)
     except Exception as e:
-        logger.info(f"Index {index_name} not found, nothing to delete")
-        return True
+        trace.finish(error=repr(e))
+        raise
 
-
-@tool
-def main(query: str, chat_history: List[Dict[str, Any]]):
-    logger.info("Starting...")
-    args, _ = parse_args()
-    region = args.region
-    index_name = args.index
-    bedrock_model_id = args.bedrock_model_id
-    bedrock_embedding_model_id = args.bedrock_embedding_model_id
-    question = args.ask
-    logger.info(f"Question provided: {query}")
-
-    # Creating all clients for chain
-    bedrock_client = get_bedrock_client(region)
-    bedrock_llm = get_model()
-    bedrock_embeddings_client = create_langchain_vector_embedding_using_bedrock(
-        bedrock_client, bedrock_embedding_model_id
-    )
-    opensearch_client = get_opensearch_client(
-        OPENSEARCH_ENDPOINT, OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD
-    )
-    opensearch_vector_search_client = create_opensearch_vector_search_client(
-        index_name,
-        bedrock_embeddings_client,
-        OPENSEARCH_ENDPOINT,
-        OPENSEARCH_USERNAME,
-        OPENSEARCH_PASSWORD,
+    logger.info(
+        "These are the similar documents from OpenSearch based on the provided query:"
     )
+    for d in streaming_answer.context:
+        logger.info(f"Text: {d.page_content}")
 
-    # LangChain prompt template
-    prompt = ChatPromptTemplate.from_template(
-        """If the context is not relevant, please answer the question by using your own knowledge about the topic. If you don't know the answer, just say that you don't know, don't try to make up an answer. don't include harmful content
-
-    {context}
+    # Sources are known before the first token, send them ahead of the answer
+    try:
+        if streaming_answer.context:
+            yield format_sources(streaming_answer.context)
+        yield from streaming_answer
+    finally:
+        # Also exported when the client stops reading half way
+        trace.finish(
+            error=None if streaming_answer.total_latency is not None else "stream not consumed"
+        )
 
-    Question: {input}
-    Answer:"""
+    pipeline.embeddings.log_stats()
+    logger.info(f"Relevance gate: {pipeline.relevance_gate.stats()}")
+    logger.info(
+        f"Answer served from semantic cache: {streaming_answer.cached}, time to first token {streaming_answer.time_to_first_token or 0:.3f}s, total latency {streaming_answer.total_latency:.3f}s"
     )
 
-    docs_chain = create_stuff_documents_chain(bedrock_llm, prompt)
-    retrieval_chain = create_retrieval_chain(
-        retriever=opensearch_vector_search_client.as_retriever(),
-        combine_docs_chain=docs_chain,
-    )
 
+@tool
+def main(query: str, chat_history: List[Dict[str, Any]], stream: bool = False):
+    logger.info("Starting...")
+    config = get_pipeline_config()
+    bedrock_model_id = config.bedrock_model_id
+    bedrock_embedding_model_id = config.bedrock_embedding_model_id
+    logger.info(f"Question provided: {query}")
     logger.info(
         f"Invoking the chain with KNN similarity using OpenSearch, Bedrock FM {bedrock_model_id}, and Bedrock embeddings with {bedrock_embedding_model_id}"
     )
-    response = retrieval_chain.invoke({"input": query})
+    if stream:
+        # promptflow streams a generator returned from the chat output node,
+        # the trace is finished when the stream is
+        return stream_answer(config, query, chat_history)
+
+    trace = TRACER.start("chat_turn", stream=stream, history_turns=len(chat_history or []))
+    try:
+        # Clients and chains are built once per worker and reused across turns
+        with tracing.activate(trace):
+            with tracing.span("client_setup"):
+                pipeline = get_pipeline(config)
+            response = pipeline.invoke(query, chat_history)
+    except Exception as e:
+        trace.finish(error=repr(e))
+        raise
+    trace.finish()
 
     print("")
     logger.info(
@@ -197,6 +240,12 @@ def main(query: str, chat_history: List[Dict[str, Any]]):
         print("")
         logger.info(f"Text: {d.page_content}")
 
+    pipeline.embeddings.log_stats()
+    logger.info(f"Relevance gate: {pipeline.relevance_gate.stats()}")
+    logger.info(
+        f"Answer served from semantic cache: {response['cached']}, total latency {response['total_latency']:.3f}s, {pipeline.semantic_cache.stats()}"
+    )
+
     print("")
     logger.info(
         f"The answer from Bedrock {bedrock_model_id} is: {response.get('answer')}"
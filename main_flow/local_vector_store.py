@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from loguru import logger
+
+from utils.artifact import EmbeddingArtifact
+from utils.checkpoint import content_hash
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# logger
+logger.remove()
+logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
+
+INDEX_TYPES = ("auto", "flat", "ivf", "hnsw")
+# Brute force scans every vector (~1ms per 2000 1536-dim rows on one core),
+# past this many a graph or IVF index is cheaper per query
+FLAT_MAX_VECTORS = 20000
+BLOCK_SIZE = 65536
+
+
+def opensearch_score(cosine):
+    # Same transform as the OpenSearch cosinesimil space, so score thresholds
+    # mean the same thing with either backend
+    return 1 / (2 - cosine)
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class FlatIndex:
+    """Exact cosine search, one matrix-vector product per corpus block."""
+
+    def __init__(self, vectors, inverse_norms):
+        self.vectors = vectors
+        self.inverse_norms = inverse_norms
+
+    def search(self, query, k):
+        best_rows, best_scores = [], []
+        for start in range(0, len(self.vectors), BLOCK_SIZE):
+            block = np.asarray(self.vectors[start : start + BLOCK_SIZE], np.float32)
+            scores = block @ query * self.inverse_norms[start : start + BLOCK_SIZE]
+            top = top_k(scores, k)
+            best_rows.append(top + start)
+            best_scores.append(scores[top])
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        order = top_k(scores, k)
+        return rows[order], scores[order]
+
+
+class IVFIndex:
+    """Inverted file index over spherical k-means cells.
+
+    Only the `nprobe` cells whose centroids are closest to the query are
+    scanned, trading a little recall for a scan of about nprobe / nlist of
+    the corpus.
+    """
+
+    def __init__(self, vectors, inverse_norms, nlist=None, nprobe=32, path=None):
+        self.vectors = vectors
+        self.inverse_norms = inverse_norms
+        self.nlist = nlist or max(1, int(np.sqrt(len(vectors))))
+        self.nprobe = min(nprobe, self.nlist)
+        if path and os.path.exists(path):
+            saved = np.load(path)
+            self.centroids, self.order, self.offsets = (
+                saved["centroids"],
+                saved["order"],
+                saved["offsets"],
+            )
+            return
+        self.centroids, assignments = self._train()
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(
+            assignments[self.order], np.arange(self.nlist + 1)
+        )
+        if path:
+            np.savez(
+                path, centroids=self.centroids, order=self.order, offsets=self.offsets
+            )
+
+    def _normalized(self, rows):
+        return np.asarray(self.vectors[rows], np.float32) * self.inverse_norms[
+            rows, None
+        ]
+
+    def _assign(self, centroids):
+        assignments = np.empty(len(self.vectors), dtype=np.int64)
+        for start in range(0, len(self.vectors), BLOCK_SIZE):
+            rows = np.arange(start, min(start + BLOCK_SIZE, len(self.vectors)))
+            assignments[rows] = np.argmax(self._normalized(rows) @ centroids.T, axis=1)
+        return assignments
+
+    def _train(self, iterations=10, seed=0):
+        started = time.perf_counter()
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(self.vectors), self.nlist * 256)
+        sample = self._normalized(
+            np.sort(rng.choice(len(self.vectors), sample_size, replace=False))
+        )
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for cell in range(self.nlist):
+                members = sample[labels == cell]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[cell] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        assignments = self._assign(centroids)
+        logger.info(
+            f"Trained IVF index with {self.nlist} cells in {time.perf_counter() - started:.2f}s"
+        )
+        return centroids, assignments
+
+    def search(self, query, k):
+        cells = top_k(self.centroids @ query, self.nprobe)
+        rows = np.sort(
+            np.concatenate(
+                [self.order[self.offsets[c] : self.offsets[c + 1]] for c in cells]
+            )
+        )
+        scores = np.asarray(self.vectors[rows], np.float32) @ query
+        scores *= self.inverse_norms[rows]
+        top = top_k(scores, k)
+        return rows[top], scores[top]
+
+
+class HNSWIndex:
+    """hnswlib graph, saved next to the artifact so it is built only once."""
+
+    def __init__(self, vectors, m=16, ef_construction=200, ef_search=100, path=None):
+        self.index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+        if path and os.path.exists(path):
+            self.index.load_index(path, max_elements=len(vectors))
+        else:
+            started = time.perf_counter()
+            self.index.init_index(
+                max_elements=len(vectors), ef_construction=ef_construction, M=m
+            )
+            for start in range(0, len(vectors), BLOCK_SIZE):
+                block = np.asarray(vectors[start : start + BLOCK_SIZE], np.float32)
+                self.index.add_items(block, np.arange(start, start + len(block)))
+            logger.info(
+                f"Built HNSW index over {len(vectors)} vectors in {time.perf_counter() - started:.2f}s"
+            )
+            if path:
+                self.index.save_index(path)
+        self.index.set_ef(ef_search)
+
+    def search(self, query, k):
+        k = min(k, self.index.get_current_count())
+        self.index.set_ef(max(self.index.ef, k))
+        rows, distances = self.index.knn_query(query, k=k)
+        return rows[0].astype(np.int64), 1 - distances[0]
+
+
+class LocalVectorStore(VectorStore):
+    """In-process vector store over the loader's embedding artifact.
+
+    Answers the same calls the chat flow makes on `OpenSearchVectorSearch`
+    without a network hop. Vectors stay memory-mapped; `index_type` picks
+    brute force (`flat`), an inverted file (`ivf`) or an `hnsw` graph, and
+    `auto` uses brute force up to FLAT_MAX_VECTORS and a graph (or IVF when
+    hnswlib is missing) beyond that. Built IVF/HNSW indexes are cached in
+    the artifact directory, keyed by the artifact's uuid and row count.
+
+    `add_texts` appends to the artifact like the loader does and needs it
+    opened `writable`. Metadata is not stored, the artifact only keeps ids,
+    texts and vectors.
+    """
+
+    def __init__(
+        self,
+        embedding_artifact: EmbeddingArtifact,
+        embedding: Embeddings,
+        index_type: str = "auto",
+    ):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type}, use one of {INDEX_TYPES}")
+        if index_type == "hnsw" and hnswlib is None:
+            raise ImportError("index_type hnsw needs the hnswlib package")
+        self.artifact = embedding_artifact
+        self.embedding = embedding
+        self.requested_index_type = index_type
+        self.count = None
+        self.refresh()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def _choose_index_type(self, count):
+        if self.requested_index_type != "auto":
+            return self.requested_index_type
+        if count <= FLAT_MAX_VECTORS:
+            return "flat"
+        return "hnsw" if hnswlib is not None else "ivf"
+
+    def refresh(self) -> bool:
+        """Reload when the artifact has grown, returns whether it did."""
+        count = self.artifact.refresh()
+        if count == self.count:
+            return False
+        started = time.perf_counter()
+        self.count = count
+        self.vectors = self.artifact.vectors()
+        norms = np.empty(count, dtype=np.float32)
+        for start in range(0, count, BLOCK_SIZE):
+            block = np.asarray(self.vectors[start : start + BLOCK_SIZE], np.float32)
+            norms[start : start + len(block)] = np.linalg.norm(block, axis=1)
+        norms[norms == 0] = 1
+        self.inverse_norms = 1 / norms
+
+        self.index_type = self._choose_index_type(count)
+        cache_path = os.path.join(
+            self.artifact.directory, f"{self.index_type}.{self.artifact.uuid}.{count}"
+        )
+        if count == 0 or self.index_type == "flat":
+            self.index = FlatIndex(self.vectors, self.inverse_norms)
+        elif self.index_type == "ivf":
+            self.index = IVFIndex(
+                self.vectors, self.inverse_norms, path=cache_path + ".npz"
+            )
+        else:
+            self.index = HNSWIndex(self.vectors, path=cache_path + ".bin")
+        logger.info(
+            f"Local vector store loaded {count} vectors with a {self.index_type} index in {time.perf_counter() - started:.3f}s"
+        )
+        return True
+
+    def generation(self) -> str:
+        # Plays the role of the OpenSearch index uuid for cache invalidation
+        return f"{self.artifact.directory}:{self.artifact.uuid}:{self.count}"
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        if self.count == 0:
+            return []
+        query = np.asarray(embedding, np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        rows, scores = self.index.search(query, k)
+        records = self.artifact.records(rows)
+        # Like OpenSearch without a metadata field, the stored vector comes
+        # back in the metadata for the context packer
+        return [
+            (
+                Document(
+                    page_content=records[row][1],
+                    metadata={
+                        "id": records[row][0],
+                        "vector_field": np.asarray(self.vectors[row], np.float32).tolist(),
+                    },
+                ),
+                float(opensearch_score(score)),
+            )
+            for row, score in zip(rows.tolist(), scores.tolist())
+            if row in records
+        ]
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_with_score_by_vector(
+                embedding, k, **kwargs
+            )
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(
+            self.embedding.embed_query(query), k, **kwargs
+        )
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return self.similarity_search_by_vector(
+            self.embedding.embed_query(query), k, **kwargs
+        )
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """Embed and append `texts`, returns their content hash ids.
+
+        Texts already in the artifact are not embedded again.
+        """
+        texts = list(texts)
+        ids = [content_hash(text, self.artifact.model_id) for text in texts]
+        new = [(doc_id, text) for doc_id, text in zip(ids, texts) if doc_id not in self.artifact]
+        if new:
+            vectors = self.embedding.embed_documents([text for _, text in new])
+            self.artifact.append(
+                {"_id": doc_id, "text": text, "vector_field": vector}
+                for (doc_id, text), vector in zip(new, vectors)
+            )
+            self.refresh()
+        return ids
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        artifact_path: Optional[str] = None,
+        model_id: str = "amazon.titan-embed-text-v1",
+        dim: int = 1536,
+        index_type: str = "auto",
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        """Open a writable artifact under `artifact_path` and add `texts`."""
+        if artifact_path is None:
+            raise ValueError("LocalVectorStore.from_texts needs an artifact_path")
+        artifact = EmbeddingArtifact(artifact_path, model_id, dim=dim, writable=True)
+        store = cls(artifact, embedding, index_type=index_type)
+        store.add_texts(texts, metadatas)
+        return store
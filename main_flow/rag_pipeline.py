@@ -0,0 +1,617 @@
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import boto3
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_aws import ChatBedrock
+from langchain_aws.embeddings import BedrockEmbeddings
+from langchain_community.vectorstores.opensearch_vector_search import (
+    OpenSearchVectorSearch,
+)
+from langchain_core.documents import Document
+from loguru import logger
+from opensearchpy import OpenSearch
+
+import tracing
+from context_packer import ContextPacker, estimate_tokens, trim_history
+from embedding_cache import CachedEmbeddings
+from local_vector_store import LocalVectorStore
+from relevance_gate import RelevanceGate
+from semantic_cache import SemanticAnswerCache, document_id
+from utils import artifact, checkpoint, quantization
+from utils.opensearch import get_index_quantization, hybrid_search
+
+PROMPT_TEMPLATE = """If the context is not relevant, please answer the question by using your own knowledge about the topic. If you don't know the answer, just say that you don't know, don't try to make up an answer. don't include harmful content{history}
+
+    {context}
+
+    Question: {input}
+    Answer:"""
+
+# Used when no retrieved chunk passes the relevance gate, the question is
+# answered without stuffing unrelated manual pages into the prompt
+NO_CONTEXT_PROMPT_TEMPLATE = """Please answer the question by using your own knowledge about the topic. If you don't know the answer, just say that you don't know, don't try to make up an answer. don't include harmful content{history}
+
+    Question: {input}
+    Answer:"""
+
+WARM_UP_QUERY = "休眠模式是什麼"
+
+
+def format_history(history: str) -> str:
+    # Empty history leaves the prompt exactly as it was without it
+    if not history:
+        return ""
+    return f"\n\n    Conversation so far:\n{history}"
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    """Everything that decides which clients a pipeline talks to.
+
+    Instances are hashable so they can key the process-wide pipeline registry.
+    """
+
+    index_name: str = "shiun"
+    region: str = "us-east-1"
+    bedrock_model_id: str = "anthropic.claude-3-sonnet-20240229-v1:0"
+    bedrock_embedding_model_id: str = "amazon.titan-embed-text-v1"
+    opensearch_endpoint: Optional[str] = None
+    opensearch_username: Optional[str] = None
+    opensearch_password: Optional[str] = field(default=None, repr=False)
+    credentials_profile_name: Optional[str] = None
+    # Empty path keeps the embedding cache in memory only
+    embedding_cache_path: Optional[str] = None
+    embedding_cache_size: int = 1024
+    embedding_cache_ttl: float = 3600
+    top_k: int = 4
+    # Chunks scoring below relevance_threshold are not put in the prompt, and
+    # the list is cut where the score drops by more than relevance_max_gap
+    relevance_threshold: float = 0.0
+    relevance_max_gap: float = 0.0
+    # Token budgets for retrieved chunks and chat history, 0 disables the
+    # context budget; near-duplicate chunks are dropped either way
+    context_max_tokens: int = 3000
+    context_mmr_lambda: float = 0.7
+    context_duplicate_threshold: float = 0.95
+    history_max_tokens: int = 1000
+    # A size of 0 disables the semantic answer cache
+    semantic_cache_threshold: float = 0.95
+    semantic_cache_size: int = 512
+    semantic_cache_path: Optional[str] = None
+    index_generation_check_interval: float = 60
+    # Embedding artifact written by the loader, re-ranks quantized results
+    # with the full-precision vectors when set
+    rescore_artifact_path: Optional[str] = None
+    rescore_oversample: int = 4
+    # "opensearch" or "local", the latter searches the embedding artifact at
+    # local_index_path in process, see local_vector_store.LocalVectorStore
+    vector_backend: str = "opensearch"
+    local_index_path: Optional[str] = None
+    local_index_type: str = "auto"
+    # Name of the search pipeline created by the loader's --search-pipeline,
+    # switches retrieval to one BM25 + k-NN hybrid query
+    hybrid_search_pipeline: Optional[str] = None
+
+
+def get_bedrock_client(region, credentials_profile_name=None):
+    session = boto3.Session(profile_name=credentials_profile_name)
+    bedrock_client = session.client("bedrock-runtime", region_name=region)
+    return bedrock_client
+
+
+def get_model(
+    model_id: str = "anthropic.claude-3-sonnet-20240229-v1:0",
+    bedrock_client=None,
+    credentials_profile_name=None,
+) -> ChatBedrock:
+    llm = ChatBedrock(
+        client=bedrock_client,
+        credentials_profile_name=credentials_profile_name,
+        model_id=model_id,
+        streaming=True,
+    )
+    return llm
+
+
+def create_langchain_vector_embedding_using_bedrock(
+    bedrock_client, bedrock_embedding_model_id
+):
+    bedrock_embeddings_client = BedrockEmbeddings(
+        client=bedrock_client, model_id=bedrock_embedding_model_id
+    )
+    return bedrock_embeddings_client
+
+
+def get_opensearch_client(cluster_url, username, password):
+
+    client = OpenSearch(
+        hosts=[cluster_url], http_auth=(username, password), verify_certs=True
+    )
+    return client
+
+
+def create_opensearch_vector_search_client(
+    index_name,
+    bedrock_embeddings_client,
+    opensearch_endpoint=None,
+    opensearch_username=None,
+    opensearch_password=None,
+    _is_aoss=False,
+):
+    docsearch = OpenSearchVectorSearch(
+        index_name=index_name,
+        embedding_function=bedrock_embeddings_client,
+        opensearch_url=opensearch_endpoint,
+        http_auth=(opensearch_username, opensearch_password),
+        is_aoss=_is_aoss,
+    )
+    return docsearch
+
+
+def pop_vectors(
+    scored_docs: List[Tuple[Document, float]], vector_field: str = "vector_field"
+) -> Dict[str, List[float]]:
+    # Search hits carry their stored vector in the metadata, moved out here
+    return {
+        document_id(doc.page_content): doc.metadata.pop(vector_field, None)
+        for doc, _ in scored_docs
+    }
+
+
+def traced_chunks(chunks: Iterator[str], trace) -> Iterator[str]:
+    # Records the LLM's time to first token and the whole generation as
+    # spans, measured from the request to Bedrock
+    started = time.perf_counter()
+    parts = []
+    first_token = False
+    for chunk in chunks:
+        # Skips the empty message_start chunk, like StreamingAnswer
+        if chunk and not first_token and trace is not None:
+            trace.record("llm_first_token", started, time.perf_counter())
+            first_token = True
+        parts.append(chunk)
+        yield chunk
+    if trace is not None:
+        trace.record(
+            "generation",
+            started,
+            time.perf_counter(),
+            output_tokens=estimate_tokens("".join(parts)),
+        )
+
+
+class StreamingAnswer:
+    """Answer chunks for one question, with retrieval already done.
+
+    `context` is available as soon as the object exists, before the first
+    token, so callers can show sources up front. Iterating yields the answer
+    chunks as the LLM produces them (or the cached answer as a single chunk)
+    and records `time_to_first_token` and `total_latency` in seconds, both
+    measured from the start of the turn.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        query,
+        embedding,
+        docs,
+        doc_ids,
+        cached_answer,
+        started,
+        history="",
+    ):
+        self.query = query
+        self.history = history
+        self.context = docs
+        self.cached = cached_answer is not None
+        self.answer: Optional[str] = cached_answer
+        self.time_to_first_token: Optional[float] = None
+        self.total_latency: Optional[float] = None
+        self._pipeline = pipeline
+        self._embedding = embedding
+        self._doc_ids = doc_ids
+        self._started = started
+        # The answer is streamed after the caller's trace context is gone
+        self._trace = tracing.current_trace()
+
+    def __iter__(self) -> Iterator[str]:
+        if self.cached:
+            chunks = iter([self.answer])
+        else:
+            chunks = traced_chunks(
+                self._pipeline.answer_chain(self.context).stream(
+                    {
+                        "input": self.query,
+                        "context": self.context,
+                        "history": format_history(self.history),
+                    }
+                ),
+                self._trace,
+            )
+
+        parts = []
+        for chunk in chunks:
+            # ChatBedrock yields an empty chunk for message_start, before any text
+            if chunk and self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - self._started
+            parts.append(chunk)
+            yield chunk
+
+        self.total_latency = time.perf_counter() - self._started
+        self.answer = "".join(parts)
+        if not self.cached and not self.history:
+            self._pipeline.semantic_cache.store(
+                self._embedding, self._doc_ids, self.answer
+            )
+        logger.info(
+            f"Streamed answer, time to first token {self.time_to_first_token or 0:.3f}s, total {self.total_latency:.3f}s"
+        )
+
+
+class RagPipeline:
+    """Long-lived retrieval + generation pipeline for one PipelineConfig.
+
+    All clients and chains are built once in the constructor and reused by
+    every call to `invoke`, so a chat turn only pays for the embedding, the
+    k-NN search and the completion. The completion is skipped when the
+    semantic cache already holds an answer for a near-identical question with
+    the same retrieved context.
+    """
+
+    def __init__(self, config: PipelineConfig):
+        self.config = config
+        self.warmed_up = False
+        started = time.perf_counter()
+
+        self.bedrock_client = get_bedrock_client(
+            config.region, config.credentials_profile_name
+        )
+        self.llm = get_model(
+            config.bedrock_model_id,
+            bedrock_client=self.bedrock_client,
+            credentials_profile_name=config.credentials_profile_name,
+        )
+        self.embeddings = CachedEmbeddings(
+            create_langchain_vector_embedding_using_bedrock(
+                self.bedrock_client, config.bedrock_embedding_model_id
+            ),
+            config.bedrock_embedding_model_id,
+            path=config.embedding_cache_path,
+            max_entries=config.embedding_cache_size,
+            ttl_seconds=config.embedding_cache_ttl,
+        )
+        if config.vector_backend == "local":
+            self.vector_store = LocalVectorStore(
+                artifact.EmbeddingArtifact(
+                    config.local_index_path, config.bedrock_embedding_model_id
+                ),
+                self.embeddings,
+                index_type=config.local_index_type,
+            )
+            self.opensearch_client = None
+        elif config.vector_backend == "opensearch":
+            self.vector_store = create_opensearch_vector_search_client(
+                config.index_name,
+                self.embeddings,
+                config.opensearch_endpoint,
+                config.opensearch_username,
+                config.opensearch_password,
+            )
+            # The vector store already owns an OpenSearch client, reuse it for
+            # index and health checks instead of opening a second connection pool
+            self.opensearch_client = self.vector_store.client
+        else:
+            raise ValueError(f"Unknown vector backend {config.vector_backend}")
+        self.hybrid_search_pipeline = config.hybrid_search_pipeline
+        if self.hybrid_search_pipeline and self.opensearch_client is None:
+            logger.warning("Hybrid search needs OpenSearch, using k-NN only")
+            self.hybrid_search_pipeline = None
+
+        self.prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+        self.docs_chain = create_stuff_documents_chain(self.llm, self.prompt)
+        self.no_context_chain = (
+            ChatPromptTemplate.from_template(NO_CONTEXT_PROMPT_TEMPLATE)
+            | self.llm
+            | StrOutputParser()
+        )
+        self.relevance_gate = RelevanceGate(
+            threshold=config.relevance_threshold, max_gap=config.relevance_max_gap
+        )
+        self.context_packer = ContextPacker(
+            max_tokens=config.context_max_tokens,
+            mmr_lambda=config.context_mmr_lambda,
+            duplicate_threshold=config.context_duplicate_threshold,
+        )
+
+        self.semantic_cache = SemanticAnswerCache(
+            threshold=config.semantic_cache_threshold,
+            max_entries=config.semantic_cache_size,
+            path=config.semantic_cache_path,
+        )
+        self._generation_checked_at = 0.0
+        self.quantization = None
+        self.rescore_artifact = None
+        if config.rescore_artifact_path:
+            if os.path.isdir(config.rescore_artifact_path):
+                self.rescore_artifact = artifact.EmbeddingArtifact(
+                    config.rescore_artifact_path, config.bedrock_embedding_model_id
+                )
+            else:
+                logger.warning(
+                    f"Rescore artifact {config.rescore_artifact_path} not found, rescoring disabled"
+                )
+
+        logger.info(
+            f"Pipeline for index {config.index_name} built in {time.perf_counter() - started:.3f}s"
+        )
+
+    def index_generation(self) -> Optional[str]:
+        if self.opensearch_client is None:
+            self.vector_store.refresh()
+            return self.vector_store.generation()
+        # A recreated index gets a new uuid even when it keeps its name
+        response = self.opensearch_client.indices.get_settings(
+            index=self.config.index_name
+        )
+        settings = next(iter(response.values()))["settings"]["index"]
+        return settings.get("uuid")
+
+    def check_index_generation(self, force: bool = False):
+        now = time.monotonic()
+        if (
+            not force
+            and now - self._generation_checked_at
+            < self.config.index_generation_check_interval
+        ):
+            return
+        self._generation_checked_at = now
+        try:
+            with tracing.span("index_check"):
+                self.semantic_cache.set_generation(self.index_generation())
+                if self.opensearch_client is not None:
+                    # A recreated index may store its vectors in another format
+                    self.quantization = get_index_quantization(
+                        self.opensearch_client, self.config.index_name
+                    )
+        except Exception as e:
+            logger.warning(f"Could not read index generation: {e}")
+
+    def rescore(
+        self, embedding: List[float], scored_docs: List[Tuple[Document, float]], k: int
+    ) -> List[Tuple[Document, float]]:
+        """Re-rank quantized k-NN candidates by exact cosine on float32 vectors.
+
+        Candidates keep their index scores, so the relevance threshold stays
+        on the engine's scale. Candidates missing from the artifact keep their
+        index order after the rescored ones.
+        """
+        vectors, found, missing = [], [], []
+        for doc, score in scored_docs:
+            vector = self.rescore_artifact.get(
+                checkpoint.content_hash(
+                    doc.page_content, self.config.bedrock_embedding_model_id
+                )
+            )
+            if vector is None:
+                missing.append((doc, score))
+            else:
+                vectors.append(vector)
+                found.append((doc, score))
+        if missing:
+            logger.debug(f"{len(missing)} candidates not in the rescore artifact")
+        if not found:
+            return scored_docs[:k]
+        order, _ = quantization.rescore(embedding, vectors, k)
+        return ([found[i] for i in order] + missing)[:k]
+
+    def hybrid_retrieve(
+        self, query: str, embedding: List[float]
+    ) -> List[Tuple[Document, float]]:
+        hits = hybrid_search(
+            self.opensearch_client,
+            self.config.index_name,
+            self.hybrid_search_pipeline,
+            query,
+            quantization.quantize_vector(embedding, self.quantization),
+            self.config.top_k,
+            # The context packer compares chunks by their stored vectors
+            include_vector=True,
+        )
+        # Same metadata rule as OpenSearchVectorSearch
+        return [
+            (
+                Document(
+                    page_content=hit["_source"]["text"],
+                    metadata=hit["_source"].get("metadata", hit["_source"]),
+                ),
+                hit["_score"],
+            )
+            for hit in hits
+        ]
+
+    def retrieve(
+        self, query: str
+    ) -> Tuple[List[float], List[Document], Dict[str, List[float]]]:
+        """Embed `query` and return the relevant chunks.
+
+        Also returns the chunks' stored vectors by document_id. They are taken
+        out of the document metadata, only the context packer needs them and
+        they would otherwise travel with every document into the prompt
+        context, the traces and the logs.
+        """
+        with tracing.span("query_embedding"):
+            embedding = self.embeddings.embed_query(query)
+        if self.hybrid_search_pipeline:
+            with tracing.span("hybrid_search", k=self.config.top_k) as span:
+                scored_docs = self.hybrid_retrieve(query, embedding)
+                span["scores"] = [round(score, 4) for _, score in scored_docs]
+            vectors = pop_vectors(scored_docs)
+            # Fused scores are min-max normalized per query, the best chunk
+            # always scores high, so only the gap cut applies to them
+            docs = self.relevance_gate.select(scored_docs, apply_threshold=False)
+            tracing.annotate(retrieved=len(scored_docs), relevant=len(docs))
+            return embedding, docs, vectors
+        k = self.config.top_k
+        if self.rescore_artifact is not None:
+            k *= self.config.rescore_oversample
+        with tracing.span("vector_search", backend=self.config.vector_backend, k=k) as span:
+            scored_docs = self.vector_store.similarity_search_with_score_by_vector(
+                quantization.quantize_vector(embedding, self.quantization), k=k
+            )
+            span["scores"] = [round(score, 4) for _, score in scored_docs]
+        vectors = pop_vectors(scored_docs)
+        if self.rescore_artifact is not None:
+            with tracing.span("rescore", candidates=len(scored_docs)):
+                scored_docs = self.rescore(embedding, scored_docs, self.config.top_k)
+        docs = self.relevance_gate.select(scored_docs)
+        tracing.annotate(retrieved=len(scored_docs), relevant=len(docs))
+        return embedding, docs, vectors
+
+    def answer_chain(self, docs: List[Document]):
+        return self.docs_chain if docs else self.no_context_chain
+
+    def generate(self, query: str, docs: List[Document], history: str = "") -> str:
+        # Streamed and joined, so the time to first token is measured here too
+        chunks = self.answer_chain(docs).stream(
+            {"input": query, "context": docs, "history": format_history(history)}
+        )
+        return "".join(traced_chunks(chunks, tracing.current_trace()))
+
+    def _retrieve_and_lookup(self, query: str, chat_history=None):
+        self.check_index_generation()
+        embedding, docs, vectors = self.retrieve(query)
+        with tracing.span("prompt_assembly") as span:
+            packed = self.context_packer.pack(
+                docs, embedding, [vectors.get(document_id(d.page_content)) for d in docs]
+            )
+            history, history_tokens, all_history_tokens = trim_history(
+                chat_history, self.config.history_max_tokens
+            )
+            span.update(chunks=len(packed.docs), tokens_saved=packed.tokens_saved)
+        tracing.annotate(
+            context_tokens=packed.tokens,
+            history_tokens=history_tokens,
+            prompt_tokens=packed.tokens + history_tokens + estimate_tokens(query),
+        )
+        logger.info(
+            f"Context packed {len(packed.docs)}/{len(docs)} chunks, {packed.tokens}/{packed.retrieved_tokens} tokens "
+            f"({packed.duplicates} near-duplicates, {packed.over_budget} over budget), "
+            f"history {history_tokens}/{all_history_tokens} tokens, "
+            f"{packed.tokens_saved + all_history_tokens - history_tokens} tokens saved"
+        )
+        docs = packed.docs
+        doc_ids = [document_id(d.page_content) for d in docs]
+        # Answers to follow-up questions depend on the conversation, only
+        # first turns go through the semantic cache
+        answer = None
+        if not history:
+            with tracing.span("semantic_cache_lookup") as span:
+                answer = self.semantic_cache.lookup(embedding, doc_ids)
+                span["hit"] = answer is not None
+        tracing.annotate(cached=answer is not None)
+        return embedding, docs, doc_ids, answer, history
+
+    def invoke(self, query: str, chat_history=None) -> Dict[str, Any]:
+        started = time.perf_counter()
+        embedding, docs, doc_ids, answer, history = self._retrieve_and_lookup(
+            query, chat_history
+        )
+        cached = answer is not None
+        if not cached:
+            answer = self.generate(query, docs, history)
+            if not history:
+                self.semantic_cache.store(embedding, doc_ids, answer)
+
+        return {
+            "input": query,
+            "context": docs,
+            "answer": answer,
+            "cached": cached,
+            "total_latency": time.perf_counter() - started,
+        }
+
+    def stream(self, query: str, chat_history=None) -> StreamingAnswer:
+        started = time.perf_counter()
+        embedding, docs, doc_ids, answer, history = self._retrieve_and_lookup(
+            query, chat_history
+        )
+        return StreamingAnswer(
+            self, query, embedding, docs, doc_ids, answer, started, history
+        )
+
+    def warm_up(self, query: str = WARM_UP_QUERY) -> float:
+        """Open the Bedrock and OpenSearch connections before taking traffic.
+
+        Embeds `query` and runs one k-NN search with it, which performs the
+        TLS handshakes and loads the k-NN graph on the data nodes. The LLM is
+        not called. Returns the elapsed seconds.
+        """
+        started = time.perf_counter()
+        self.vector_store.similarity_search(query, k=1)
+        self.check_index_generation(force=True)
+        self.warmed_up = True
+        elapsed = time.perf_counter() - started
+        logger.info(f"Pipeline for index {self.config.index_name} warmed up in {elapsed:.3f}s")
+        return elapsed
+
+    def health_check(self) -> Dict[str, Any]:
+        """Cheap readiness probe, never calls Bedrock."""
+        status = {
+            "index": self.config.index_name,
+            "warmed_up": self.warmed_up,
+            "opensearch": False,
+            "index_exists": False,
+        }
+        if self.opensearch_client is None:
+            status["backend"] = f"local {self.vector_store.index_type}"
+            status["vectors"] = self.vector_store.count
+            status["healthy"] = self.vector_store.count > 0
+        else:
+            try:
+                status["opensearch"] = bool(self.opensearch_client.ping())
+                status["index_exists"] = bool(
+                    self.opensearch_client.indices.exists(index=self.config.index_name)
+                )
+            except Exception as e:
+                logger.warning(f"Health check failed: {e}")
+            status["healthy"] = status["opensearch"] and status["index_exists"]
+        status["embedding_cache"] = self.embeddings.stats()
+        status["semantic_cache"] = self.semantic_cache.stats()
+        status["quantization"] = self.quantization
+        status["rescoring"] = self.rescore_artifact is not None
+        status["hybrid_search_pipeline"] = self.hybrid_search_pipeline
+        status["relevance_gate"] = self.relevance_gate.stats()
+        status["context_packer"] = self.context_packer.stats()
+        return status
+
+
+_PIPELINES: Dict[PipelineConfig, RagPipeline] = {}
+_PIPELINES_LOCK = threading.Lock()
+
+
+def get_pipeline(config: PipelineConfig) -> RagPipeline:
+    pipeline = _PIPELINES.get(config)
+    if pipeline is not None:
+        return pipeline
+
+    with _PIPELINES_LOCK:
+        pipeline = _PIPELINES.get(config)
+        if pipeline is None:
+            logger.info(f"Building pipeline for {config}")
+            pipeline = RagPipeline(config)
+            _PIPELINES[config] = pipeline
+    return pipeline
+
+
+def reset_pipelines() -> List[PipelineConfig]:
+    with _PIPELINES_LOCK:
+        configs = list(_PIPELINES)
+        _PIPELINES.clear()
+    return configs
@@ -0,0 +1,62 @@
+import threading
+from typing import List, Tuple
+
+from langchain_core.documents import Document
+
+PATHS = ("full_context", "trimmed_context", "no_context")
+
+
+class RelevanceGate:
+    """Decide which retrieved chunks are worth putting in the prompt.
+
+    Chunks come in as (document, score) pairs in rank order with k-NN scores
+    (higher is closer). Chunks scoring below `threshold` are dropped, and the
+    list is cut at the first drop between neighbouring scores larger than
+    `max_gap`, so a clear winner is not padded with weaker chunks. A `max_gap`
+    of 0 disables the cut. When nothing survives the question is answered
+    without retrieved context.
+
+    Counts how often each path in PATHS is taken.
+    """
+
+    def __init__(self, threshold: float = 0.0, max_gap: float = 0.0, min_k: int = 1):
+        self.threshold = threshold
+        self.max_gap = max_gap
+        self.min_k = min_k
+        self._lock = threading.Lock()
+        self._counts = {path: 0 for path in PATHS}
+        self._dropped = 0
+
+    def select(
+        self, scored_docs: List[Tuple[Document, float]], apply_threshold: bool = True
+    ) -> List[Document]:
+        kept = [
+            pair
+            for pair in scored_docs
+            if not apply_threshold or pair[1] >= self.threshold
+        ]
+        if self.max_gap > 0:
+            for i in range(max(1, self.min_k), len(kept)):
+                if kept[i - 1][1] - kept[i][1] > self.max_gap:
+                    kept = kept[:i]
+                    break
+
+        if not kept:
+            path = "no_context"
+        elif len(kept) < len(scored_docs):
+            path = "trimmed_context"
+        else:
+            path = "full_context"
+        with self._lock:
+            self._counts[path] += 1
+            self._dropped += len(scored_docs) - len(kept)
+        return [doc for doc, _ in kept]
+
+    def stats(self):
+        with self._lock:
+            total = sum(self._counts.values())
+            return {
+                **self._counts,
+                "dropped_chunks": self._dropped,
+                "no_context_rate": self._counts["no_context"] / total if total else 0.0,
+            }
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from loguru import logger
+
+
+def document_id(page_content: str) -> str:
+    # OpenSearchVectorSearch does not hand back the hit _id, so retrieved
+    # chunks are identified by their content instead
+    return hashlib.sha1(page_content.encode("utf-8")).hexdigest()
+
+
+class SemanticAnswerCache:
+    """Cache of generated answers looked up by query embedding similarity.
+
+    An entry is reused when the cosine similarity between the new query and a
+    cached query is at least `threshold` and the new query retrieved exactly the
+    same documents, so a changed context always goes back to the LLM. Entries
+    are evicted least-recently-used once `max_entries` is reached, and the
+    whole cache is dropped when the index generation changes.
+
+    With `path` set the entries are also kept in a local SQLite file so they
+    survive restarts, otherwise the cache lives in process memory only.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        max_entries: int = 512,
+        path: Optional[str] = None,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.generation: Optional[str] = None
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._entries: List[Optional[Tuple[Tuple[str, ...], str, Optional[int]]]] = [
+            None
+        ] * max_entries
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.context_changed = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._conn = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, embedding BLOB NOT NULL, "
+                "doc_ids TEXT NOT NULL, answer TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._conn.commit()
+            self._load()
+
+    def _load(self):
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'generation'"
+        ).fetchone()
+        self.generation = row[0] if row else None
+        rows = self._conn.execute(
+            "SELECT id, embedding, doc_ids, answer, last_used FROM answers "
+            "ORDER BY last_used DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for row_id, embedding, doc_ids, answer, last_used in rows:
+            vector = np.frombuffer(embedding, dtype=np.float32)
+            self._insert(vector, tuple(json.loads(doc_ids)), answer, row_id, last_used)
+        logger.info(f"Loaded {len(rows)} semantic cache entries")
+
+    def _insert(self, vector, doc_ids, answer, row_id, last_used) -> Optional[int]:
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), np.float32)
+
+        evicted_row_id = None
+        if self._size < self.max_entries:
+            slot = self._size
+            self._size += 1
+        else:
+            slot = int(np.argmin(self._last_used[: self._size]))
+            evicted_row_id = self._entries[slot][2]
+            self.evictions += 1
+
+        self._vectors[slot] = vector
+        self._last_used[slot] = last_used
+        self._entries[slot] = (doc_ids, answer, row_id)
+        return evicted_row_id
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self, embedding: Sequence[float], doc_ids: Sequence[str]
+    ) -> Optional[str]:
+        if self.max_entries <= 0:
+            return None
+        doc_ids = tuple(doc_ids)
+        vector = self._normalize(embedding)
+
+        with self._lock:
+            if self._size == 0 or self._vectors.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None
+
+            similarities = self._vectors[: self._size] @ vector
+            candidates = np.flatnonzero(similarities >= self.threshold)
+            # Most similar first, the first one with the same context wins
+            for slot in candidates[np.argsort(-similarities[candidates])]:
+                cached_doc_ids, answer, row_id = self._entries[slot]
+                if cached_doc_ids == doc_ids:
+                    now = time.time()
+                    self._last_used[slot] = now
+                    self.hits += 1
+                    if self._conn is not None:
+                        self._conn.execute(
+                            "UPDATE answers SET last_used = ? WHERE id = ?",
+                            (now, row_id),
+                        )
+                        self._conn.commit()
+                    return answer
+
+            if len(candidates):
+                self.context_changed += 1
+            self.misses += 1
+            return None
+
+    def store(self, embedding: Sequence[float], doc_ids: Sequence[str], answer: str):
+        if self.max_entries <= 0:
+            return
+        doc_ids = tuple(doc_ids)
+        vector = self._normalize(embedding)
+        now = time.time()
+
+        with self._lock:
+            if self._vectors is not None and self._vectors.shape[1] != vector.shape[0]:
+                # Embedding model changed under us, old vectors are unusable
+                self._clear()
+
+            row_id = None
+            if self._conn is not None:
+                cursor = self._conn.execute(
+                    "INSERT INTO answers (embedding, doc_ids, answer, last_used) "
+                    "VALUES (?, ?, ?, ?)",
+                    (vector.tobytes(), json.dumps(doc_ids), answer, now),
+                )
+                row_id = cursor.lastrowid
+
+            evicted_row_id = self._insert(vector, doc_ids, answer, row_id, now)
+            if self._conn is not None:
+                if evicted_row_id is not None:
+                    self._conn.execute(
+                        "DELETE FROM answers WHERE id = ?", (evicted_row_id,)
+                    )
+                self._conn.commit()
+
+    def _clear(self):
+        self._vectors = None
+        self._last_used[:] = 0
+        self._entries = [None] * self.max_entries
+        self._size = 0
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+
+    def invalidate(self, generation: Optional[str] = None):
+        with self._lock:
+            self._clear()
+            self.generation = generation
+            self.invalidations += 1
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('generation', ?)",
+                    (generation,),
+                )
+                self._conn.commit()
+        logger.info(f"Semantic cache invalidated, index generation {generation}")
+
+    def set_generation(self, generation: Optional[str]) -> bool:
+        """Drop every entry if `generation` differs from the one cached for.
+
+        Returns True when the cache was invalidated.
+        """
+        if generation == self.generation:
+            return False
+        self.invalidate(generation)
+        return True
+
+    def __len__(self):
+        return self._size
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "context_changed": self.context_changed,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._size,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
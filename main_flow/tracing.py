@@ -0,0 +1,280 @@
+import bisect
+import contextlib
+import contextvars
+import importlib
+import json
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from loguru import logger
+
+# Upper bounds in milliseconds, the last bucket is open-ended
+LATENCY_BUCKETS_MS = (
+    1, 2, 5, 10, 20, 50, 100, 200, 300, 500, 750,
+    1000, 1500, 2000, 3000, 5000, 7500, 10000, 20000, 30000, 60000,
+)
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+class Trace:
+    """Timings and attributes of one chat turn.
+
+    Spans are recorded with their start offset and duration in milliseconds,
+    relative to the start of the trace. `finish()` hands the record to the
+    tracer's exporters once.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, **attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.attributes: Dict[str, Any] = dict(attributes)
+        self.spans: List[Dict[str, Any]] = []
+        self.started = time.perf_counter()
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def record(self, name: str, started: float, ended: float, **attributes):
+        span = {
+            "name": name,
+            "start_ms": round((started - self.started) * 1000, 3),
+            "duration_ms": round((ended - started) * 1000, 3),
+            **attributes,
+        }
+        with self._lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Dict[str, Any]]:
+        # Attributes added to the yielded dict end up on the span
+        started = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = repr(e)
+            raise
+        finally:
+            self.record(name, started, time.perf_counter(), **attributes)
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def finish(self, error: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._finished:
+                return None
+            self._finished = True
+            record = {
+                "trace": self.name,
+                "trace_id": self.trace_id,
+                "timestamp": self.timestamp,
+                "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+                "spans": list(self.spans),
+                "attributes": dict(self.attributes),
+            }
+        if error is not None:
+            record["error"] = error
+        self.tracer.export(record)
+        return record
+
+
+class Tracer:
+    """Starts traces and fans finished records out to exporters.
+
+    An exporter is any object with an `export(record)` method. A failing
+    exporter is logged and never breaks the chat turn.
+    """
+
+    def __init__(self, exporters: Sequence[Any] = ()):
+        self.exporters = list(exporters)
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def start(self, name: str, **attributes) -> Trace:
+        return Trace(self, name, **attributes)
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **attributes) -> Iterator[Trace]:
+        trace = self.start(name, **attributes)
+        with activate(trace):
+            try:
+                yield trace
+            except Exception as e:
+                trace.finish(error=repr(e))
+                raise
+        trace.finish()
+
+    def export(self, record: Dict[str, Any]):
+        for exporter in self.exporters:
+            try:
+                exporter.export(record)
+            except Exception as e:
+                logger.warning(f"Trace exporter {type(exporter).__name__} failed: {e}")
+
+
+@contextlib.contextmanager
+def activate(trace: Optional[Trace]):
+    # Makes `trace` the one `span()` and `annotate()` record into
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Dict[str, Any]]:
+    """Time a block into the current trace, a no-op outside of one."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield attributes
+        return
+    with trace.span(name, **attributes) as span_attributes:
+        yield span_attributes
+
+
+def annotate(**attributes):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.set(**attributes)
+
+
+class LogExporter:
+    """Writes every trace as one JSON log line."""
+
+    def __init__(self, level: str = "INFO"):
+        self.level = level
+
+    def export(self, record: Dict[str, Any]):
+        logger.log(self.level, json.dumps(record, ensure_ascii=False))
+
+
+class JsonlExporter:
+    """Appends every trace to a JSON lines file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class LatencyHistogram:
+    """Bucketed latency distribution with interpolated percentiles."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max, 3),
+        }
+
+
+class HistogramExporter:
+    """Keeps a latency histogram per trace and per span name in process."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, name: str, value: float):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram(self.buckets)
+        histogram.observe(value)
+
+    def export(self, record: Dict[str, Any]):
+        with self._lock:
+            self._observe(record["trace"], record["duration_ms"])
+            for span in record["spans"]:
+                self._observe(span["name"], span["duration_ms"])
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: h.summary() for name, h in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+def load_exporter(path: str):
+    # "package.module:ClassName", instantiated without arguments
+    module_name, _, class_name = path.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def build_tracer(
+    exporters: Sequence[str] = ("log", "histogram"),
+    path: Optional[str] = None,
+    level: str = "INFO",
+):
+    """Tracer from exporter names: log, histogram, jsonl or module:Class.
+
+    Returns the tracer and its HistogramExporter, None without one.
+    """
+    tracer = Tracer()
+    histograms = None
+    for name in exporters:
+        name = name.strip()
+        if not name:
+            continue
+        if name == "log":
+            tracer.add_exporter(LogExporter(level))
+        elif name == "histogram":
+            histograms = HistogramExporter()
+            tracer.add_exporter(histograms)
+        elif name == "jsonl":
+            if not path:
+                raise ValueError("The jsonl trace exporter needs a path")
+            tracer.add_exporter(JsonlExporter(path))
+        elif ":" in name:
+            tracer.add_exporter(load_exporter(name))
+        else:
+            raise ValueError(f"Unknown trace exporter {name}")
+    return tracer, histograms
@@ -1,94 +1,541 @@
 import fitz
 import boto3
+import hashlib
+import json
 import os
-from io import BytesIO
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import queue
+import urllib.parse
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+
+import chunking
 
 s3_client = boto3.client('s3')
 
-def lambda_handler(event, context):
-    bucket_name = 'gogoro-hackton-data'
-    output_bucket_name = 'gogoro-hackton-data-source'
+bucket_name = 'gogoro-hackton-data'
+# The knowledge base data source only gets the modified PDFs. Text, chunks,
+# images and their state go to a bucket the knowledge base does not read,
+# load_data_to_opensearch.py indexes the chunks instead of the text.
+output_bucket_name = 'gogoro-hackton-data-source'
+pipeline_bucket_name = os.environ.get('PIPELINE_BUCKET', 'gogoro-hackton-data-pipeline')
 
-    # Extract the object key from the event
-    key = event['Records'][0]['s3']['object']['key']
-    filename = os.path.splitext(os.path.basename(key))[0]
+# Set image minimum size threshold
+min_width, min_height = 20, 20
 
-    # Download the PDF file from S3
-    response = s3_client.get_object(Bucket=bucket_name, Key=key)
-    pdf_data = response['Body'].read()
-    
-    # Open the PDF file
-    pdf_file = fitz.open(stream=pdf_data, filetype="pdf")
+# Worker processes default to the Lambda's vCPUs, uploads overlap on threads
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', 0)) or os.cpu_count() or 1
+UPLOAD_THREADS = int(os.environ.get('UPLOAD_THREADS', 8))
+# Below this many pages per worker the process start-up costs more than it saves
+MIN_PAGES_PER_WORKER = 10
 
-    # Create new PDF for modified content
-    modified_pdf = fitz.open()
+# Images are stored once under their content hash, every document gets a
+# `{filename}_images.json` mapping its image marks to those objects. The
+# content-addressed objects are the manifest, one per hash, created with a
+# conditional put so concurrent invocations never overwrite each other.
+IMAGE_PREFIX = os.environ.get('IMAGE_PREFIX', 'images/')
 
-    # Set image minimum size threshold
-    min_width, min_height = 20, 20
+# Input and outputs are spooled through /tmp and moved in 8 MB parts, so peak
+# memory does not grow with the size of the manual
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '/tmp')
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+)
 
-    # To store all pages' text content
-    all_text = ""
+# Records of one event are processed side by side, the extraction workers are
+# shared between them
+RECORD_CONCURRENCY = int(os.environ.get('RECORD_CONCURRENCY', 4))
+# PyMuPDF is not thread-safe, its calls in this process never overlap
+mupdf_lock = threading.Lock()
+# Stored on `{filename}_images.json`, which is written last, so an object whose
+# ETag matches was processed completely and is skipped
+SOURCE_ETAG_METADATA = 'source-etag'
+
+
+def get_page_images(page):
+    # Images drawn on the page in the serial path's order, one entry per
+    # placement larger than the minimum size
+    page_images = []
+    for img in page.get_images(full=True):
+        xref = img[0]
+        for rect in page.get_image_rects(xref):
+            width = rect.x1 - rect.x0
+            height = rect.y1 - rect.y0
+            if width > min_width and height > min_height:
+                page_images.append((xref, rect))
+    return page_images
+
+
+def page_text_with_marks(page, marks):
+    # The page text for chunking, every image mark placed before the first
+    # text block below the top of the image so it stays in its section
+    marks = sorted(marks, key=lambda mark: mark[0].y0)
+    parts = []
+    for x0, y0, x1, y1, text, block_no, block_type in page.get_text('blocks'):
+        if block_type != 0:
+            continue
+        while marks and marks[0][0].y0 <= y0:
+            parts.append(f"{marks.pop(0)[1]}\n")
+        parts.append(text if text.endswith('\n') else text + '\n')
+    parts.extend(f"{mark_text}\n" for _, mark_text in marks)
+    return ''.join(parts)
 
-    # Iterate through each page
-    image_count = 1
-    for page_index in range(len(pdf_file)):
-        page = pdf_file[page_index]
-        modified_page = modified_pdf.new_page(width=page.rect.width, height=page.rect.height)
 
-        # Get all image objects on the current page
-        images = page.get_images(full=True)
+def image_key(content_hash):
+    return f"{IMAGE_PREFIX}{content_hash}.png"
 
-        # Extract images and insert marks
-        for img in images:
-            xref = img[0]
-            image_rects = page.get_image_rects(xref)
 
-            for rect in image_rects:
-                width = rect.x1 - rect.x0
-                height = rect.y1 - rect.y0
+def store_image(client, content_hash, image_bytes):
+    """Store an image under its content hash unless it is there already.
 
-                # Only process images larger than the minimum size
-                if width > min_width and height > min_height:
+    Returns whether this call stored it. A HEAD saves the upload of an image
+    stored by an earlier document, the `If-None-Match` put settles the race
+    with a document storing the same image at the same time.
+    """
+    key = image_key(content_hash)
+    try:
+        client.head_object(Bucket=pipeline_bucket_name, Key=key)
+        return False
+    except client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+    while True:
+        try:
+            client.put_object(Bucket=pipeline_bucket_name, Key=key, Body=image_bytes, IfNoneMatch='*')
+            return True
+        except client.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'PreconditionFailed':
+                return False
+            # Another conditional put of the key is in flight, S3 asks to retry
+            if code != 'ConditionalRequestConflict':
+                raise
+
+
+def process_page_range(pdf_path, filename, start, stop, image_count, output_prefix):
+    """Extract pages [start, stop) numbering images from `image_count`.
+
+    Writes the modified pages to `<output_prefix>.pdf`, their plain text to
+    `<output_prefix>.txt` and one JSON line per page for chunking to
+    `<output_prefix>.pages.jsonl`, images are stored in S3 on a thread pool
+    while the next pages are processed. Every xref is extracted and every
+    content hash stored once. Returns the output paths, the (image number,
+    content hash) references, {content hash: (bytes, stored by this range)}
+    and the number of xrefs extracted.
+    """
+    # boto3 clients are not fork-safe, every worker process opens its own on a
+    # fresh session, the default one may have been forked mid-request
+    worker_s3_client = boto3.session.Session().client('s3')
+    pdf_file = fitz.open(pdf_path)
+    modified_pdf = fitz.open()
+    pdf_output_path = f"{output_prefix}.pdf"
+    text_output_path = f"{output_prefix}.txt"
+    pages_output_path = f"{output_prefix}.pages.jsonl"
+
+    # xref -> content hash, a logo drawn on every page is extracted once
+    xref_hashes = {}
+    references = []
+    stores = {}
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor, \
+            open(text_output_path, 'w', encoding='utf-8') as text_file, \
+            open(pages_output_path, 'w', encoding='utf-8') as pages_file:
+        for page_index in range(start, stop):
+            page = pdf_file[page_index]
+            modified_page = modified_pdf.new_page(width=page.rect.width, height=page.rect.height)
+            marks = []
+
+            # Extract images and insert marks
+            for xref, rect in get_page_images(page):
+                content_hash = xref_hashes.get(xref)
+                if content_hash is None:
                     # Extract image data
                     image_data = pdf_file.extract_image(xref)
                     image_bytes = image_data["image"]
-                    image_path = f"{filename}_image_{image_count}.png"
+                    content_hash = hashlib.sha256(image_bytes).hexdigest()
+                    xref_hashes[xref] = content_hash
+
+                    if content_hash not in stores:
+                        # Store the image without waiting for the upload
+                        stores[content_hash] = (len(image_bytes), executor.submit(
+                            store_image, worker_s3_client, content_hash, image_bytes))
+                references.append((image_count, content_hash))
 
-                    # Save image to S3
-                    s3_client.put_object(Bucket=output_bucket_name, Key=image_path, Body=image_bytes)
+                # Insert text mark at the top-left corner of the image
+                mark_text = f"image {image_count}"
+                modified_page.insert_text(rect.top_left, mark_text, fontsize=12, color=(1, 0, 0))
+                marks.append((rect, mark_text))
 
-                    # Insert text mark at the top-left corner of the image
-                    mark_text = f"image {image_count}"
-                    modified_page.insert_text(rect.top_left, mark_text, fontsize=12, color=(1, 0, 0))
+                # Add image mark to the plain text content
+                text_file.write(f"\n{mark_text}\n")
 
-                    # Add image mark to the plain text content
-                    all_text += f"\n{mark_text}\n"
+                image_count += 1
 
-                    image_count += 1
+            # Copy original page text content
+            text = page.get_text()
+            modified_page.insert_text((0, 0), text)
 
-        # Copy original page text content
-        text = page.get_text()
-        modified_page.insert_text((0, 0), text)
-        
-        # Accumulate text for all pages
-        all_text += text + "\n"
+            # Write the page text out instead of growing one big string
+            text_file.write(text + "\n")
+            pages_file.write(json.dumps(
+                {'page': page_index + 1, 'text': page_text_with_marks(page, marks)}, ensure_ascii=False) + "\n")
 
-    # Save modified PDF to a BytesIO object
-    output_pdf_stream = BytesIO()
-    modified_pdf.save(output_pdf_stream)
-    output_pdf_stream.seek(0)
+        # Surface the first failed upload
+        stored = {content_hash: (size, store.result()) for content_hash, (size, store) in stores.items()}
 
-    # Upload modified PDF to S3 with a new name based on the original filename
-    modified_pdf_key = f"{filename}.pdf"
-    s3_client.put_object(Bucket=output_bucket_name, Key=modified_pdf_key, Body=output_pdf_stream.getvalue())
+    modified_pdf.save(pdf_output_path)
     modified_pdf.close()
     pdf_file.close()
+    return pdf_output_path, text_output_path, pages_output_path, references, stored, len(xref_hashes)
+
+
+def _page_range_worker(connection):
+    # Serves page ranges until the pool sends None or goes away
+    try:
+        while True:
+            args = connection.recv()
+            if args is None:
+                break
+            try:
+                connection.send(('ok', process_page_range(*args)))
+            except Exception as e:
+                connection.send(('error', repr(e)))
+    except EOFError:
+        pass
+    finally:
+        connection.close()
+
+
+class ExtractPool:
+    """Extraction worker processes shared by the record threads.
+
+    Forking a threaded process can deadlock, so the workers are forked up
+    front, before the record threads start, and get their page ranges over
+    pipes. Lambda has no /dev/shm, so multiprocessing.Pool and its queues are
+    not available, plain processes with pipes are.
+    """
+
+    def __init__(self, size):
+        ctx = multiprocessing.get_context('fork')
+        self.processes = []
+        self.connections = []
+        self.idle = queue.Queue()
+        for _ in range(size):
+            parent_connection, child_connection = ctx.Pipe()
+            process = ctx.Process(target=_page_range_worker, args=(child_connection,))
+            process.start()
+            child_connection.close()
+            self.processes.append(process)
+            self.connections.append(parent_connection)
+            self.idle.put(parent_connection)
+
+    def run(self, *args):
+        """Run `process_page_range(*args)` on the next idle worker."""
+        connection = self.idle.get()
+        try:
+            connection.send(args)
+            return connection.recv()
+        except (EOFError, OSError):
+            # A dead worker keeps failing fast instead of blocking the others
+            return 'error', 'worker exited without a result'
+        finally:
+            self.idle.put(connection)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def plan_page_ranges(pdf_file, workers):
+    """Split the pages into contiguous ranges with their first image number.
+
+    Counting the qualifying images only reads page metadata, so every range
+    knows its image numbering before any worker starts.
+    """
+    page_count = len(pdf_file)
+    workers = max(1, min(workers, page_count // MIN_PAGES_PER_WORKER))
+    bounds = [page_count * i // workers for i in range(workers + 1)]
+
+    ranges = []
+    image_count = 1
+    for start, stop in zip(bounds, bounds[1:]):
+        ranges.append((start, stop, image_count))
+        for page_index in range(start, stop):
+            image_count += len(get_page_images(pdf_file[page_index]))
+    return ranges
+
+
+def extract_pages(pool, pdf_path, filename, ranges, work_dir):
+    prefixes = [os.path.join(work_dir, f"part_{i}") for i in range(len(ranges))]
+    # Even a single range goes to a worker, the record threads must not run
+    # PyMuPDF side by side
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        outcomes = list(executor.map(
+            lambda page_range, prefix: pool.run(pdf_path, filename, *page_range, prefix),
+            ranges, prefixes,
+        ))
+
+    errors = [result for status, result in outcomes if status != 'ok']
+    if errors:
+        raise RuntimeError(f"Page extraction failed: {errors}")
+    return [result for _, result in outcomes]
+
+
+def record_s3_objects(record):
+    """Return (bucket, key, ETag) for every object in one event record.
+
+    Handles S3 notifications delivered directly and through SQS, the ETag
+    may be None.
+    """
+    if record.get('eventSource') == 'aws:sqs':
+        # s3:TestEvent messages carry no records
+        s3_records = json.loads(record['body']).get('Records', [])
+    else:
+        s3_records = [record]
+    objects = []
+    for s3_record in s3_records:
+        s3 = s3_record['s3']
+        # Keys arrive URL-encoded, spaces as '+'
+        key = urllib.parse.unquote_plus(s3['object']['key'])
+        objects.append((s3['bucket'].get('name', bucket_name), key, s3['object'].get('eTag')))
+    return objects
+
+
+def parse_event(event):
+    """Return the (item identifier, bucket, key, ETag) objects and the failures.
+
+    The item identifier is the SQS message id reported back in
+    `batchItemFailures`, direct S3 records have none. A record that cannot be
+    parsed fails on its own as (item identifier, description) instead of
+    failing the whole batch.
+    """
+    objects, failed = [], []
+    for record in event.get('Records', []):
+        item_id = record.get('messageId') if record.get('eventSource') == 'aws:sqs' else None
+        try:
+            objects.extend((item_id, *s3_object) for s3_object in record_s3_objects(record))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Record {item_id}: malformed with {e!r}")
+            failed.append((item_id, f"record {item_id}"))
+    return objects, failed
+
+
+def iter_pages(pages_paths):
+    for path in pages_paths:
+        with open(path, encoding='utf-8') as pages_file:
+            for line in pages_file:
+                page = json.loads(line)
+                yield page['page'], page['text']
+
+
+def load_chunks(filename):
+    # Chunks and page state of the previous version of the manual, if any
+    try:
+        response = s3_client.get_object(Bucket=pipeline_bucket_name, Key=f"{filename}_chunks_state.json")
+        state = json.loads(response['Body'].read())
+        response = s3_client.get_object(Bucket=pipeline_bucket_name, Key=f"{filename}_chunks.jsonl")
+    except s3_client.exceptions.NoSuchKey:
+        return None, []
+    return state, [json.loads(line) for line in response['Body'].iter_lines() if line]
+
+
+def get_source_etag(bucket, key):
+    return s3_client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+
+
+def already_processed(filename, etag):
+    try:
+        response = s3_client.head_object(Bucket=pipeline_bucket_name, Key=f"{filename}_images.json")
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return response.get('Metadata', {}).get(SOURCE_ETAG_METADATA) == etag
+
+
+def pending_etag(bucket, key, etag):
+    """Return the object's ETag, or None when it was processed already."""
+    filename = os.path.splitext(os.path.basename(key))[0]
+    etag = (etag or get_source_etag(bucket, key)).strip('"')
+    if already_processed(filename, etag):
+        print(f"{filename}: ETag {etag} already processed, skipping")
+        return None
+    return etag
+
+
+def process_document(bucket, key, etag, workers, pool):
+    """Extract one PDF whose source ETag is `etag`, returns its stats."""
+    filename = os.path.splitext(os.path.basename(key))[0]
+    with tempfile.TemporaryDirectory(dir=SPOOL_DIR) as work_dir:
+        # Stream the PDF from S3 to local disk instead of reading it into memory
+        pdf_path = os.path.join(work_dir, 'input.pdf')
+        s3_client.download_file(bucket, key, pdf_path, Config=transfer_config)
+
+        # Open the PDF file, pages are read from disk on demand
+        with mupdf_lock:
+            pdf_file = fitz.open(pdf_path)
+            ranges = plan_page_ranges(pdf_file, workers)
+            pdf_file.close()
+
+        # Process page ranges in parallel, results come back in page order
+        results = extract_pages(pool, pdf_path, filename, ranges, work_dir)
+
+        # Stitch the modified page ranges and their text back together
+        modified_pdf_path = os.path.join(work_dir, 'modified.pdf')
+        with mupdf_lock:
+            modified_pdf = fitz.open()
+            for result in results:
+                with fitz.open(result[0]) as part:
+                    modified_pdf.insert_pdf(part)
+            modified_pdf.save(modified_pdf_path)
+            modified_pdf.close()
+
+        text_path = os.path.join(work_dir, 'all_text.txt')
+        image_map = {}
+        # {content hash: {"key", "bytes", "references", "uploaded"}}, rebuilt
+        # from scratch whenever the document is processed again
+        images = {}
+        stats = {'placements': 0, 'extracted': 0}
+        with open(text_path, 'wb') as text_file:
+            for _, part_text_path, _, references, stored, extracted in results:
+                stats['placements'] += len(references)
+                stats['extracted'] += extracted
+                for content_hash, (size, uploaded) in stored.items():
+                    image = images.setdefault(content_hash, {
+                        'key': image_key(content_hash),
+                        'bytes': size,
+                        'references': 0,
+                        'uploaded': False,
+                    })
+                    image['uploaded'] = image['uploaded'] or uploaded
+                for image_number, content_hash in references:
+                    image_map[f"image {image_number}"] = image_key(content_hash)
+                    images[content_hash]['references'] += 1
+
+                with open(part_text_path, 'rb') as part_text:
+                    shutil.copyfileobj(part_text, text_file)
+                os.remove(part_text_path)
+
+        # Upload modified PDF to S3 with a new name based on the original filename,
+        # large files go up as a multipart upload
+        modified_pdf_key = f"{filename}.pdf"
+        s3_client.upload_file(modified_pdf_path, output_bucket_name, modified_pdf_key, Config=transfer_config)
+
+        # Upload extracted text content to the pipeline bucket with a new name
+        # based on the original filename, captions are merged into it later
+        extracted_text_key = f"{filename}.txt"
+        s3_client.upload_file(text_path, pipeline_bucket_name, extracted_text_key, Config=transfer_config)
+
+        # Split the pages into section chunks, pages that did not change since
+        # the last version of the manual keep their chunks
+        previous_state, previous_chunks = load_chunks(filename)
+        chunks, chunk_state, chunk_stats = chunking.chunk_document(
+            filename, iter_pages(result[2] for result in results), previous_state, previous_chunks)
+        chunks_path = os.path.join(work_dir, 'chunks.jsonl')
+        with open(chunks_path, 'w', encoding='utf-8') as chunks_file:
+            for chunk in chunks:
+                chunks_file.write(json.dumps({**chunk, 'source': key}, ensure_ascii=False) + "\n")
+        s3_client.upload_file(chunks_path, pipeline_bucket_name, f"{filename}_chunks.jsonl", Config=transfer_config)
+        s3_client.put_object(
+            Bucket=pipeline_bucket_name,
+            Key=f"{filename}_chunks_state.json",
+            Body=json.dumps(chunk_state, ensure_ascii=False).encode('utf-8'),
+        )
+        stats['chunking'] = chunk_stats
+
+    # Image marks in the text point at content-addressed objects. Written last
+    # with the source ETag, it marks the document as done.
+    stats['unique'] = len(images)
+    stats['uploaded'] = sum(image['uploaded'] for image in images.values())
+    # Repeats of an image inside this document, and images another document
+    # had stored already
+    stats['in_document_duplicates'] = stats['placements'] - stats['unique']
+    stats['already_stored'] = stats['unique'] - stats['uploaded']
+    s3_client.put_object(
+        Bucket=pipeline_bucket_name,
+        Key=f"{filename}_images.json",
+        Body=json.dumps({'images': image_map, 'hashes': images, 'stats': stats}, ensure_ascii=False).encode('utf-8'),
+        Metadata={SOURCE_ETAG_METADATA: etag},
+    )
+    print(f"{filename}: {stats['placements']} image placements, {stats['extracted']} extracted, "
+          f"{stats['unique']} unique, {stats['uploaded']} uploaded, "
+          f"{stats['in_document_duplicates']} repeated in the document, {stats['already_stored']} already stored, "
+          f"{chunk_stats['chunks']} chunks, {chunk_stats['rechunked_pages']} of {chunk_stats['pages']} pages re-chunked")
+    return stats
+
+
+def lambda_handler(event, context):
+    objects, failed = parse_event(event)
+    if not objects and not failed:
+        return {'statusCode': 200, 'body': 'No objects to process.', 'batchItemFailures': []}
+
+    processed, skipped, pending = [], [], []
+    # Documents already processed are skipped before any worker is forked,
+    # the executor joins its threads on exit
+    with ThreadPoolExecutor(max_workers=max(1, RECORD_CONCURRENCY)) as executor:
+        futures = [
+            (item_id, bucket, key, executor.submit(pending_etag, bucket, key, etag))
+            for item_id, bucket, key, etag in objects
+        ]
+        for item_id, bucket, key, future in futures:
+            try:
+                etag = future.result()
+            except Exception as e:
+                print(f"{key}: failed with {e!r}")
+                failed.append((item_id, key))
+                continue
+            if etag is None:
+                skipped.append(key)
+            else:
+                pending.append((item_id, bucket, key, etag))
+
+    if pending:
+        concurrency = max(1, min(RECORD_CONCURRENCY, len(pending)))
+        workers = max(1, EXTRACT_WORKERS // concurrency)
+        # The workers are forked while the handler is single-threaded, as many
+        # as the pending documents extract with side by side
+        with ExtractPool(concurrency * workers) as pool, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                (item_id, key, executor.submit(process_document, bucket, key, etag, workers, pool))
+                for item_id, bucket, key, etag in pending
+            ]
+            for item_id, key, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"{key}: failed with {e!r}")
+                    failed.append((item_id, key))
+                    continue
+                processed.append(key)
+
+    summary = f"{len(processed)} processed, {len(skipped)} skipped, {len(failed)} failed"
+    print(summary)
 
-    # Upload extracted text content to S3 with a new name based on the original filename
-    extracted_text_key = f"{filename}.txt"
-    s3_client.put_object(Bucket=output_bucket_name, Key=extracted_text_key, Body=all_text.encode('utf-8'))
+    # Only failed SQS messages are retried, completed ones are skipped by ETag
+    # if a message is delivered again
+    failed_items = sorted({item_id for item_id, _ in failed if item_id is not None})
+    if any(item_id is None for item_id, _ in failed):
+        # Direct S3 invocations have no partial failure, retrying the whole
+        # event is cheap because finished documents are skipped
+        raise RuntimeError(f"Processing failed for {[key for _, key in failed]}")
 
     return {
         'statusCode': 200,
-        'body': 'Images extracted and PDF modified successfully.'
+        'body': f"Images extracted and PDF modified successfully: {summary}.",
+        'batchItemFailures': [{'itemIdentifier': item_id} for item_id in failed_items],
     }
@@ -0,0 +1,11 @@
+import sys
+from pathlib import Path
+
+# The flow imports its modules as siblings and utils/ from the repo root
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "main_flow"))
+# The PDF Lambda lives in src/ with its own requirements
+sys.path.append(str(ROOT / "src"))
+# The caption script imports its cache as a sibling
+sys.path.append(str(ROOT / "data_preprocessing"))
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from utils.artifact import EmbeddingArtifact
+
+MODEL = "amazon.titan-embed-text-v1"
+
+
+def record(doc_id, value, dim=4):
+    return {"_id": doc_id, "text": f"text {doc_id}", "vector_field": [value] * dim}
+
+
+def test_append_skips_known_ids_and_reopens(tmp_path):
+    artifact = EmbeddingArtifact(str(tmp_path), MODEL, dim=4, writable=True)
+    assert artifact.append([record("a", 1.0), record("b", 2.0), record("a", 9.0)]) == 2
+    assert artifact.append([record("b", 3.0), record("c", 3.0)]) == 1
+    artifact.close()
+
+    artifact = EmbeddingArtifact(str(tmp_path), MODEL)
+    assert len(artifact) == 3
+    assert artifact.get("b") == [2.0] * 4
+    assert artifact.get("missing") is None
+    assert [doc_id for doc_id, _, _ in artifact.iter_records(batch_size=2)] == ["a", "b", "c"]
+    assert artifact.records([2]) == {2: ("c", "text c")}
+
+
+def test_writer_cuts_a_torn_tail(tmp_path):
+    artifact = EmbeddingArtifact(str(tmp_path), MODEL, dim=4, writable=True)
+    artifact.append([record("a", 1.0)])
+    vectors_path = artifact.vectors_path
+    row_bytes = artifact.row_bytes
+    artifact.close()
+    # A crash after writing rows but before committing the sidecar
+    with open(vectors_path, "ab") as f:
+        np.full(6, 7.0, dtype=np.float32).tofile(f)
+
+    reader = EmbeddingArtifact(str(tmp_path), MODEL)
+    assert len(reader) == 1
+    assert reader.vectors().shape == (1, 4)
+    reader.close()
+
+    writer = EmbeddingArtifact(str(tmp_path), MODEL, writable=True)
+    assert writer.append([record("b", 2.0)]) == 1
+    assert writer.get("b") == [2.0] * 4
+    assert np.asarray(writer.vectors()).tolist() == [[1.0] * 4, [2.0] * 4]
+    writer.close()
+    with open(vectors_path, "rb") as f:
+        assert len(f.read()) == 2 * row_bytes
+
+
+def test_reader_never_truncates_a_writers_rows(tmp_path):
+    writer = EmbeddingArtifact(str(tmp_path), MODEL, dim=4, writable=True)
+    with open(writer.vectors_path, "ab") as f:
+        # Rows written, sidecar not committed yet
+        np.full(4, 5.0, dtype=np.float32).tofile(f)
+    EmbeddingArtifact(str(tmp_path), MODEL).close()
+    with open(writer.vectors_path, "rb") as f:
+        assert len(f.read()) == writer.row_bytes
+
+
+def test_single_writer(tmp_path):
+    writer = EmbeddingArtifact(str(tmp_path), MODEL, dim=4, writable=True)
+    with pytest.raises(RuntimeError):
+        EmbeddingArtifact(str(tmp_path), MODEL, writable=True)
+    with pytest.raises(RuntimeError):
+        EmbeddingArtifact(str(tmp_path), MODEL).append([record("a", 1.0)])
+    writer.close()
+    EmbeddingArtifact(str(tmp_path), MODEL, writable=True).close()
+
+
+def test_meta_wins_and_other_model_is_rejected(tmp_path):
+    EmbeddingArtifact(str(tmp_path), "vendor/model", dim=4).close()
+    assert EmbeddingArtifact(str(tmp_path), "vendor/model", dim=8).dim == 4
+    # Directory names are sanitized, two ids can share one
+    with pytest.raises(ValueError):
+        EmbeddingArtifact(str(tmp_path), "vendor_model")
@@ -0,0 +1,80 @@
+import itertools
+
+import caption_cache
+from caption_cache import CaptionCache, S3CaptionStore, SQLiteCaptionStore, caption_key
+
+from benchmarks.fakes import FakeS3
+
+
+def test_key_is_stable():
+    key = caption_key(b"png", "describe", "model-a")
+    assert key == caption_key(b"png", "describe", "model-a")
+    assert len(key) == 64
+
+
+def test_key_changes_with_image_prompt_and_model():
+    key = caption_key(b"png", "describe", "model-a")
+    assert caption_key(b"png2", "describe", "model-a") != key
+    assert caption_key(b"png", "describe briefly", "model-a") != key
+    assert caption_key(b"png", "describe", "model-b") != key
+    # Fields are separated, moving text between them changes the key
+    assert caption_key(b"png", "a", "model-") != caption_key(b"png", "", "model-a")
+
+
+def test_reopened_store_keeps_captions_and_size(tmp_path):
+    path = str(tmp_path / "captions.sqlite3")
+    store = SQLiteCaptionStore(path)
+    store.put("k", "model", "機車儀表板")
+    store.close()
+
+    store = SQLiteCaptionStore(path)
+    assert store.get("k") == "機車儀表板"
+    assert store.size() == len("機車儀表板".encode("utf-8"))
+
+
+def test_least_recently_used_evicted_by_bytes(tmp_path, monkeypatch):
+    monkeypatch.setattr(caption_cache.time, "time", itertools.count().__next__)
+    store = SQLiteCaptionStore(str(tmp_path / "captions.sqlite3"), max_bytes=30)
+    store.put("a", "model", "a" * 10)
+    store.put("b", "model", "b" * 10)
+    store.put("c", "model", "c" * 10)
+    # Reading "a" makes "b" the least recently used
+    assert store.get("a") == "a" * 10
+
+    store.put("d", "model", "d" * 10)
+
+    assert store.get("b") is None
+    assert [store.get(key) is not None for key in "acd"] == [True, True, True]
+    assert store.size() == 30
+    assert store.evictions == 1
+
+
+def test_replacing_a_caption_counts_its_bytes_once(tmp_path):
+    store = SQLiteCaptionStore(str(tmp_path / "captions.sqlite3"), max_bytes=30)
+    store.put("a", "model", "a" * 10)
+    store.put("a", "model", "a" * 20)
+    assert store.size() == 20
+    assert store.evictions == 0
+
+
+def test_caption_larger_than_the_limit_is_kept(tmp_path):
+    store = SQLiteCaptionStore(str(tmp_path / "captions.sqlite3"), max_bytes=10)
+    store.put("a", "model", "a" * 5)
+    store.put("big", "model", "b" * 50)
+    assert store.get("big") == "b" * 50
+    assert store.get("a") is None
+
+
+def test_s3_hit_is_copied_to_disk(tmp_path):
+    cache = CaptionCache("model", path=str(tmp_path / "captions.sqlite3"))
+    cache.remote = S3CaptionStore("s3://captions/cache/", client=FakeS3(str(tmp_path / "s3")))
+    key = cache.key(b"png", "describe")
+
+    assert cache.get(key) is None
+    cache.remote.put(key, "model", "儀表板")
+    assert cache.get(key) == "儀表板"
+    assert cache.get(key) == "儀表板"
+
+    stats = cache.stats()
+    assert (stats["misses"], stats["s3_hits"], stats["disk_hits"]) == (1, 1, 1)
+    assert stats["disk_entries"] == 1
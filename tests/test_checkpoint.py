@@ -0,0 +1,38 @@
+from utils.checkpoint import CheckpointJournal, content_hash
+
+
+def test_content_hash_includes_the_model():
+    assert content_hash("text", "titan-v1") == content_hash("text", "titan-v1")
+    assert content_hash("text", "titan-v1") != content_hash("text", "titan-v2")
+
+
+def test_done_ids_are_filtered_across_reopen(tmp_path):
+    path = str(tmp_path / "cp.sqlite3")
+    journal = CheckpointJournal(path)
+    assert journal.bind("uuid-1", created=True)
+    journal.mark_done(["a", "b"])
+    journal.close()
+
+    journal = CheckpointJournal(path)
+    assert not journal.bind("uuid-1")
+    assert journal.filter_new(["a", "b", "c"]) == {"c"}
+    assert len(journal) == 2
+
+
+def test_recreated_index_resets_the_journal(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "cp.sqlite3"))
+    journal.bind("uuid-1", created=True)
+    journal.mark_done(["a", "b"])
+
+    # Deleted and recreated outside the loader, or another cluster
+    assert journal.bind("uuid-2")
+    assert journal.index_uuid() == "uuid-2"
+    assert journal.filter_new(["a", "b"]) == {"a", "b"}
+
+
+def test_index_created_by_this_run_resets_the_journal(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "cp.sqlite3"))
+    journal.bind("uuid-1")
+    journal.mark_done(["a"])
+    assert journal.bind("uuid-1", created=True)
+    assert len(journal) == 0
@@ -0,0 +1,99 @@
+import json
+
+import chunking
+
+TOC = "目錄\n3.1 充電 12\n3.2 休眠模式 14\n"
+CHARGING = (
+    "3. 電池\n"
+    "3.1 充電\n"
+    "充電時請將車輛停放於平坦處。\n"
+    "1. 打開座墊\n"
+    "image 1\n"
+    "3.1.1 注意事項\n"
+    "請勿在雨中充電。\n"
+)
+SLEEP = "電池溫度過高時會停止充電。\n3.2 休眠模式\n長時間未使用時車輛會進入休眠。\n"
+
+
+def manual(*pages):
+    return list(enumerate(pages, start=1))
+
+
+def round_trip(chunks, state):
+    # The Lambda stores both as JSON between versions of the manual
+    return json.loads(json.dumps(state)), [json.loads(json.dumps(chunk)) for chunk in chunks]
+
+
+def test_chunks_follow_headings():
+    chunks, _, stats = chunking.chunk_document("manual", manual(TOC, CHARGING, SLEEP), max_chars=800, min_chars=0)
+
+    assert [(chunk["page"], chunk["section"]) for chunk in chunks] == [
+        (1, None), (2, "3"), (2, "3.1"), (2, "3.1.1"), (3, "3.1.1"), (3, "3.2"),
+    ]
+    charging = chunks[2]
+    # A numbered list item stays in its section, the image mark with its text
+    assert "1. 打開座墊" in charging["text"]
+    assert charging["images"] == ["image 1"]
+    # The carry-over on the next page repeats its heading
+    assert chunks[4]["text"].startswith("3.1.1 注意事項\n電池溫度過高")
+    assert stats == {"pages": 3, "rechunked_pages": 3, "reused_pages": 0, "chunks": 6}
+
+
+def test_table_of_contents_is_not_a_heading():
+    chunks, _, _ = chunking.chunk_document("manual", manual(TOC), min_chars=0)
+
+    assert [chunk["section"] for chunk in chunks] == [None]
+    assert chunks[0]["text"] == TOC.strip()
+
+
+def test_short_sections_merge():
+    chunks, _, _ = chunking.chunk_document("manual", manual(CHARGING), max_chars=800, min_chars=200)
+
+    assert len(chunks) == 1
+    assert chunks[0]["section"] == "3"
+    assert chunks[0]["sections"] == ["3", "3.1", "3.1.1"]
+
+
+def test_long_sections_split_at_line_breaks():
+    text = "3.1 充電\n" + "".join(f"第 {i} 行說明文字。\n" for i in range(40))
+    chunks, _, _ = chunking.chunk_document("manual", manual(text), max_chars=100, min_chars=0)
+
+    assert len(chunks) > 1
+    assert all(chunk["end"] - chunk["start"] <= 100 for chunk in chunks)
+    assert all(chunk["text"].startswith("3.1 充電\n") for chunk in chunks)
+    assert len({chunk["id"] for chunk in chunks}) == len(chunks)
+
+
+def test_unchanged_pages_are_reused():
+    pages = manual(TOC, CHARGING, SLEEP)
+    chunks, state, _ = chunking.chunk_document("manual", pages, min_chars=0)
+    state, previous = round_trip(chunks, state)
+
+    again, _, stats = chunking.chunk_document("manual", pages, state, previous, min_chars=0)
+
+    assert stats["rechunked_pages"] == 0 and stats["reused_pages"] == 3
+    assert again == chunks
+
+
+def test_changed_page_is_rechunked():
+    chunks, state, _ = chunking.chunk_document("manual", manual(TOC, CHARGING, SLEEP), min_chars=0)
+    state, previous = round_trip(chunks, state)
+    edited = SLEEP.replace("長時間", "超過七天")
+
+    again, _, stats = chunking.chunk_document("manual", manual(TOC, CHARGING, edited), state, previous, min_chars=0)
+
+    assert stats["rechunked_pages"] == 1 and stats["reused_pages"] == 2
+    assert [chunk["id"] for chunk in again[:4]] == [chunk["id"] for chunk in chunks[:4]]
+    assert "超過七天" in again[-1]["text"]
+
+
+def test_section_change_rechunks_the_next_page():
+    chunks, state, _ = chunking.chunk_document("manual", manual(TOC, CHARGING, SLEEP), min_chars=0)
+    state, previous = round_trip(chunks, state)
+    # Page 3 starts in the section page 2 ends in
+    edited = CHARGING.replace("3.1.1 注意事項", "3.1.1 充電注意事項")
+
+    again, _, stats = chunking.chunk_document("manual", manual(TOC, edited, SLEEP), state, previous, min_chars=0)
+
+    assert stats["rechunked_pages"] == 2 and stats["reused_pages"] == 1
+    assert again[4]["text"].startswith("3.1.1 充電注意事項\n")
@@ -0,0 +1,53 @@
+from langchain_core.documents import Document
+
+from context_packer import ContextPacker, estimate_tokens, trim_history
+
+
+def docs(*texts):
+    return [Document(page_content=text) for text in texts]
+
+
+def test_estimate_tokens_counts_cjk_per_character():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("電池續航力") == 5
+    # Five ideographs, a fullwidth comma, and " 80 km" as four per token
+    assert estimate_tokens("電池續航力，80 km") == 6 + 2
+
+
+def test_budget_skips_chunks_that_do_not_fit():
+    packer = ContextPacker(max_tokens=5)
+    result = packer.pack(docs("a" * 12, "b" * 12, "c" * 8))
+    assert [d.page_content[0] for d in result.docs] == ["a", "c"]
+    assert (result.tokens, result.retrieved_tokens, result.over_budget) == (5, 8, 1)
+    assert result.tokens_saved == 3
+    assert packer.stats() == {"turns": 1, "tokens_saved": 3}
+
+
+def test_zero_budget_keeps_everything():
+    result = ContextPacker(max_tokens=0).pack(docs("a" * 400, "b" * 400))
+    assert len(result.docs) == 2
+
+
+def test_near_duplicates_are_dropped():
+    packer = ContextPacker(duplicate_threshold=0.95)
+    vectors = [[1.0, 0.0], [0.99, 0.05], [0.0, 1.0]]
+    result = packer.pack(docs("first", "copy", "other"), [1.0, 0.0], vectors)
+    assert [d.page_content for d in result.docs] == ["first", "other"]
+    assert result.duplicates == 1
+
+
+def test_without_vectors_retrieval_order_is_kept():
+    result = ContextPacker().pack(docs("first", "second"), [1.0, 0.0], [[1.0, 0.0], None])
+    assert [d.page_content for d in result.docs] == ["first", "second"]
+    assert result.duplicates == 0
+
+
+def test_trim_history_keeps_recent_turns():
+    history = [
+        {"inputs": {"question": "q" * 40}, "outputs": {"answer": "a" * 40}},
+        {"inputs": {"question": "range?"}, "outputs": {"answer": "80 km"}},
+    ]
+    text, kept, total = trim_history(history, max_tokens=10)
+    assert text == "Human: range?\nAssistant: 80 km"
+    assert kept < total
@@ -0,0 +1,53 @@
+import gzip
+import http.server
+import json
+import threading
+
+import pytest
+
+from utils import dataset
+
+ROWS = [["range?", "80 km"], {"text": "3.1 Charging"}]
+BODY = "".join(json.dumps(row) + "\n" for row in ROWS).encode("utf-8")
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        if self.path == "/encoded.jsonl.gz":
+            # A .gz object served with Content-Encoding, as S3 and CDNs do
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(gzip.compress(BODY))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+EXPECTED = ["question: range?, answer: 80 km", "3.1 Charging"]
+
+
+@pytest.mark.parametrize("path", ["/plain.jsonl.gz", "/encoded.jsonl.gz"])
+def test_gzip_url_is_decompressed_once(server, path):
+    assert list(dataset.stream_records(server + path)) == EXPECTED
+
+
+def test_local_files(tmp_path):
+    plain = tmp_path / "rows.jsonl"
+    plain.write_bytes(BODY + b"\n")
+    compressed = tmp_path / "rows.jsonl.gz"
+    compressed.write_bytes(gzip.compress(BODY))
+    assert list(dataset.stream_records(str(plain))) == EXPECTED
+    assert list(dataset.stream_records(str(compressed))) == EXPECTED
+
+
+def test_batched():
+    assert list(dataset.batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
@@ -0,0 +1,47 @@
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+from utils import embedding
+
+
+def client_error(code, status):
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "InvokeModel",
+    )
+
+
+def flaky(errors, result="ok"):
+    errors = list(errors)
+
+    def fn():
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return fn
+
+
+def test_transient_errors_are_retried_without_slowing_the_limiter():
+    limiter = embedding.TokenBucket(100)
+    fn = flaky(
+        [
+            client_error("InternalServerException", 500),
+            ReadTimeoutError(endpoint_url="https://bedrock"),
+        ]
+    )
+    assert embedding.call_with_backoff(fn, limiter, base_delay=0) == "ok"
+    assert limiter.rate == limiter.max_rate
+
+
+def test_throttles_slow_the_limiter():
+    limiter = embedding.TokenBucket(100)
+    fn = flaky([client_error("ThrottlingException", 429)])
+    assert embedding.call_with_backoff(fn, limiter, base_delay=0) == "ok"
+    assert limiter.rate < limiter.max_rate
+
+
+def test_client_errors_are_not_retried():
+    fn = flaky([client_error("ValidationException", 400)])
+    with pytest.raises(ClientError):
+        embedding.call_with_backoff(fn, base_delay=0)
@@ -0,0 +1,68 @@
+import argparse
+
+import pytest
+
+from utils.index_spec import IndexSpec, add_index_arguments, index_spec_from_args
+
+
+def test_default_body_is_the_plugin_default_hnsw():
+    assert IndexSpec().body() == {
+        "settings": {
+            "index": {"knn": True, "number_of_shards": 1, "knn.algo_param.ef_search": 100}
+        },
+        "mappings": {
+            "_meta": {"quantization": None},
+            "properties": {
+                "vector_field": {
+                    "type": "knn_vector",
+                    "dimension": 1536,
+                    "method": {
+                        "name": "hnsw",
+                        "engine": "nmslib",
+                        "space_type": "cosinesimil",
+                        "parameters": {"m": 16, "ef_construction": 100},
+                    },
+                },
+                "text": {"type": "keyword"},
+            },
+        },
+    }
+
+
+def test_lucene_has_no_index_level_ef_search():
+    settings = IndexSpec(engine="lucene", number_of_replicas=0).settings()["index"]
+    assert "knn.algo_param.ef_search" not in settings
+    assert settings["number_of_replicas"] == 0
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"engine": "annoy"},
+        {"space_type": "hamming"},
+        {"quantization": "int4"},
+        {"quantization": "fp16", "engine": "nmslib"},
+        {"quantization": "byte", "engine": "nmslib"},
+        {"quantization": "byte", "engine": "lucene", "space_type": "l2"},
+        {"text_analyzer": "ik_smart"},
+    ],
+)
+def test_invalid_combinations_are_rejected(overrides):
+    with pytest.raises(ValueError):
+        IndexSpec(**overrides)
+
+
+def test_overrides_skip_none():
+    spec = IndexSpec().with_overrides(m=32, ef_search=None)
+    assert (spec.m, spec.ef_search) == (32, 100)
+
+
+def test_memory_estimate():
+    assert IndexSpec().estimated_memory_bytes(1000) == int(1.1 * (4 * 1536 + 8 * 16) * 1000)
+
+
+def test_arguments_round_trip():
+    parser = argparse.ArgumentParser()
+    add_index_arguments(parser)
+    args = parser.parse_args(["--engine", "faiss", "--m", "24", "--ef-search", "256"])
+    assert index_spec_from_args(args) == IndexSpec(engine="faiss", m=24, ef_search=256)
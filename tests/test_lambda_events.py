@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+data = pytest.importorskip("data")
+
+
+def sqs_record(message_id, body):
+    return {"eventSource": "aws:sqs", "messageId": message_id, "body": body}
+
+
+def s3_body(key, etag="etag"):
+    return json.dumps({"Records": [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": key, "eTag": etag}}}]})
+
+
+def test_malformed_messages_fail_alone():
+    event = {"Records": [
+        sqs_record("good", s3_body("manuals/a+b.pdf")),
+        sqs_record("not-json", "not json"),
+        sqs_record("no-key", json.dumps({"Records": [{"s3": {"bucket": {}}}]})),
+        sqs_record("test-event", json.dumps({"Event": "s3:TestEvent"})),
+    ]}
+    objects, failed = data.parse_event(event)
+    assert objects == [("good", "bucket", "manuals/a b.pdf", "etag")]
+    assert [item_id for item_id, _ in failed] == ["not-json", "no-key"]
+
+
+def test_handler_reports_malformed_messages(monkeypatch):
+    processed = []
+    monkeypatch.setattr(data, "already_processed", lambda filename, etag: False)
+    monkeypatch.setattr(data, "ExtractPool", FakePool)
+    monkeypatch.setattr(data, "process_document", lambda bucket, key, *args: processed.append(key) or {})
+    event = {"Records": [sqs_record("good", s3_body("a.pdf")), sqs_record("bad", "not json")]}
+
+    response = data.lambda_handler(event, None)
+
+    assert processed == ["a.pdf"]
+    assert response["batchItemFailures"] == [{"itemIdentifier": "bad"}]
+
+
+def test_no_fork_when_everything_is_processed(monkeypatch):
+    monkeypatch.setattr(data, "already_processed", lambda filename, etag: True)
+
+    def fork(size):
+        raise AssertionError("forked without pending documents")
+
+    monkeypatch.setattr(data, "ExtractPool", fork)
+    event = {"Records": [sqs_record("a", s3_body("a.pdf")), sqs_record("b", s3_body("b.pdf"))]}
+
+    response = data.lambda_handler(event, None)
+
+    assert response["batchItemFailures"] == []
+
+
+def test_pool_sized_to_pending_documents(monkeypatch):
+    monkeypatch.setattr(data, "RECORD_CONCURRENCY", 4)
+    monkeypatch.setattr(data, "EXTRACT_WORKERS", 8)
+    monkeypatch.setattr(data, "already_processed", lambda filename, etag: filename != "new")
+    monkeypatch.setattr(data, "ExtractPool", FakePool)
+    monkeypatch.setattr(data, "process_document", lambda bucket, key, etag, workers, pool: {})
+    event = {"Records": [sqs_record(name, s3_body(f"{name}.pdf")) for name in ("old-1", "new", "old-2")]}
+
+    data.lambda_handler(event, None)
+
+    # One pending document gets every worker to itself
+    assert FakePool.sizes[-1] == 8
+
+
+class FakePool:
+    sizes = []
+
+    def __init__(self, size):
+        FakePool.sizes.append(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
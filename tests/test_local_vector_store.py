@@ -0,0 +1,67 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+from local_vector_store import LocalVectorStore, opensearch_score
+from utils.artifact import EmbeddingArtifact
+
+MODEL = "amazon.titan-embed-text-v1"
+TEXTS = ["battery range", "brake light", "seat lock", "tire pressure"]
+
+
+class OneHotEmbeddings(Embeddings):
+    """Text i of TEXTS embeds to the i-th unit vector."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += len(texts)
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(8, np.float32)
+        vector[TEXTS.index(text) if text in TEXTS else 7] = 1
+        return vector.tolist()
+
+
+def test_from_texts_then_search(tmp_path):
+    embedding = OneHotEmbeddings()
+    store = LocalVectorStore.from_texts(TEXTS[:3], embedding, artifact_path=str(tmp_path), dim=8)
+    docs = store.similarity_search_with_score("brake light", k=2)
+    assert docs[0][0].page_content == "brake light"
+    assert docs[0][1] == pytest.approx(opensearch_score(1.0))
+
+    ids = store.add_texts(["brake light", "tire pressure"])
+    assert embedding.calls == 4
+    assert len(set(ids)) == 2
+    assert store.count == 4
+    assert store.similarity_search("tire pressure", k=1)[0].page_content == "tire pressure"
+
+
+def test_read_only_store_cannot_add(tmp_path):
+    EmbeddingArtifact(str(tmp_path), MODEL, dim=8).close()
+    store = LocalVectorStore(EmbeddingArtifact(str(tmp_path), MODEL), OneHotEmbeddings())
+    with pytest.raises(RuntimeError):
+        store.add_texts(["seat lock"])
+
+
+def test_rebuilt_artifact_of_the_same_size_is_a_new_generation(tmp_path):
+    def build():
+        store = LocalVectorStore.from_texts(
+            TEXTS, OneHotEmbeddings(), artifact_path=str(tmp_path), dim=8, index_type="ivf"
+        )
+        store.artifact.close()
+        return store
+
+    first = build()
+    shutil.rmtree(first.artifact.directory)
+    second = build()
+    assert first.count == second.count
+    assert first.generation() != second.generation()
+    # The old IVF index is not picked up by the rebuilt artifact
+    cached = [name for name in os.listdir(second.artifact.directory) if name.startswith("ivf.")]
+    assert cached == [f"ivf.{second.artifact.uuid}.4.npz"]
@@ -0,0 +1,74 @@
+import time
+from types import SimpleNamespace
+
+from rag_pipeline import StreamingAnswer
+
+
+def slow_chunks(chunks, delay):
+    # Mimics ChatBedrock: an empty message_start chunk right away, text later
+    yield chunks[0]
+    for chunk in chunks[1:]:
+        time.sleep(delay)
+        yield chunk
+
+
+def make_pipeline(chunks, delay=0.05):
+    stored = []
+    chain = SimpleNamespace(stream=lambda inputs: slow_chunks(chunks, delay))
+    pipeline = SimpleNamespace(
+        answer_chain=lambda docs: chain,
+        semantic_cache=SimpleNamespace(store=lambda *args: stored.append(args)),
+    )
+    return pipeline, stored
+
+
+def test_time_to_first_token_skips_empty_chunk():
+    pipeline, stored = make_pipeline(["", "80 ", "km"])
+    answer = StreamingAnswer(
+        pipeline, "range?", [0.1], [], [], None, time.perf_counter()
+    )
+
+    assert list(answer) == ["", "80 ", "km"]
+    assert answer.time_to_first_token >= 0.05
+    assert answer.total_latency >= 0.1
+    assert answer.answer == "80 km"
+    assert len(stored) == 1
+
+
+def test_cached_answer_is_first_token():
+    pipeline, stored = make_pipeline([""])
+    answer = StreamingAnswer(
+        pipeline, "range?", [0.1], [], [], "80 km", time.perf_counter()
+    )
+
+    assert list(answer) == ["80 km"]
+    assert answer.time_to_first_token < 0.05
+    assert stored == []
+
+
+def test_llm_first_token_span_skips_empty_chunk():
+    import tracing
+    from rag_pipeline import traced_chunks
+
+    records = []
+    tracer = tracing.Tracer([SimpleNamespace(export=records.append)])
+    trace = tracer.start("chat_turn")
+
+    assert "".join(traced_chunks(slow_chunks(["", "80 ", "km"], 0.05), trace)) == "80 km"
+    trace.finish()
+
+    spans = {span["name"]: span for span in records[0]["spans"]}
+    assert spans["llm_first_token"]["duration_ms"] >= 50
+    assert spans["generation"]["duration_ms"] >= 100
+
+
+def test_pop_vectors_leaves_documents_without_vectors():
+    from langchain_core.documents import Document
+
+    from rag_pipeline import pop_vectors
+    from semantic_cache import document_id
+
+    doc = Document(page_content="3.1 Charging", metadata={"text": "3.1 Charging", "vector_field": [0.1, 0.2]})
+    vectors = pop_vectors([(doc, 0.9)])
+    assert vectors == {document_id("3.1 Charging"): [0.1, 0.2]}
+    assert doc.metadata == {"text": "3.1 Charging"}
@@ -0,0 +1,38 @@
+from langchain_core.documents import Document
+
+from relevance_gate import RelevanceGate
+
+
+def scored(*scores):
+    return [(Document(page_content=f"chunk {i}"), score) for i, score in enumerate(scores)]
+
+
+def contents(docs):
+    return [doc.page_content for doc in docs]
+
+
+def test_threshold_drops_weak_chunks():
+    gate = RelevanceGate(threshold=0.5)
+    assert contents(gate.select(scored(0.9, 0.6, 0.4))) == ["chunk 0", "chunk 1"]
+    assert gate.select(scored(0.3, 0.2)) == []
+    assert contents(gate.select(scored(0.3), apply_threshold=False)) == ["chunk 0"]
+    stats = gate.stats()
+    assert (stats["trimmed_context"], stats["no_context"], stats["full_context"]) == (1, 1, 1)
+    assert stats["dropped_chunks"] == 3
+
+
+def test_max_gap_cuts_after_a_clear_winner():
+    gate = RelevanceGate(max_gap=0.1)
+    assert contents(gate.select(scored(0.95, 0.7, 0.68))) == ["chunk 0"]
+    # Gaps up to max_gap keep the list whole
+    assert contents(gate.select(scored(0.8, 0.75, 0.7))) == ["chunk 0", "chunk 1", "chunk 2"]
+
+
+def test_max_gap_keeps_min_k():
+    gate = RelevanceGate(max_gap=0.1, min_k=2)
+    assert contents(gate.select(scored(0.95, 0.7, 0.4))) == ["chunk 0", "chunk 1"]
+
+
+def test_zero_max_gap_disables_the_cut():
+    gate = RelevanceGate(max_gap=0)
+    assert len(gate.select(scored(0.95, 0.1))) == 2
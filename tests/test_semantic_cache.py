@@ -0,0 +1,54 @@
+import itertools
+
+import semantic_cache
+from semantic_cache import SemanticAnswerCache
+
+
+def test_similar_query_with_same_documents_hits():
+    cache = SemanticAnswerCache(threshold=0.95)
+    cache.store([1.0, 0.0, 0.0], ["a", "b"], "80 km")
+    assert cache.lookup([0.99, 0.05, 0.0], ["a", "b"]) == "80 km"
+    assert cache.stats()["hits"] == 1
+
+
+def test_query_below_threshold_misses():
+    cache = SemanticAnswerCache(threshold=0.95)
+    cache.store([1.0, 0.0, 0.0], ["a"], "80 km")
+    assert cache.lookup([0.7, 0.7, 0.0], ["a"]) is None
+    assert cache.stats()["context_changed"] == 0
+
+
+def test_changed_documents_miss():
+    cache = SemanticAnswerCache(threshold=0.95)
+    cache.store([1.0, 0.0, 0.0], ["a", "b"], "80 km")
+    assert cache.lookup([1.0, 0.0, 0.0], ["a", "c"]) is None
+    assert cache.lookup([1.0, 0.0, 0.0], ["b", "a"]) is None
+    assert cache.stats()["context_changed"] == 2
+
+
+def test_new_generation_drops_entries(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    cache = SemanticAnswerCache(path=path)
+    assert cache.set_generation("index@1")
+    cache.store([1.0, 0.0], ["a"], "80 km")
+    assert not cache.set_generation("index@1")
+    assert cache.lookup([1.0, 0.0], ["a"]) == "80 km"
+
+    reopened = SemanticAnswerCache(path=path)
+    assert reopened.generation == "index@1"
+    assert reopened.lookup([1.0, 0.0], ["a"]) == "80 km"
+    assert reopened.set_generation("index@2")
+    assert reopened.lookup([1.0, 0.0], ["a"]) is None
+    assert len(SemanticAnswerCache(path=path)) == 0
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(semantic_cache.time, "time", lambda: next(clock))
+    cache = SemanticAnswerCache(max_entries=2)
+    cache.store([1.0, 0.0, 0.0], ["a"], "first")
+    cache.store([0.0, 1.0, 0.0], ["b"], "second")
+    assert cache.lookup([1.0, 0.0, 0.0], ["a"]) == "first"
+    cache.store([0.0, 0.0, 1.0], ["c"], "third")
+    assert cache.lookup([0.0, 1.0, 0.0], ["b"]) is None
+    assert cache.lookup([1.0, 0.0, 0.0], ["a"]) == "first"
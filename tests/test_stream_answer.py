@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+
+import is_question_relevant as flow
+import tracing
+
+
+class Collector:
+    def __init__(self):
+        self.records = []
+
+    def export(self, record):
+        self.records.append(record)
+
+
+class Answer:
+    def __init__(self, chunks):
+        self.context = []
+        self.chunks = chunks
+        self.cached = False
+        self.time_to_first_token = None
+        self.total_latency = None
+
+    def __iter__(self):
+        yield from self.chunks
+        self.total_latency = 0.1
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    collector = Collector()
+    monkeypatch.setattr(flow, "TRACER", tracing.Tracer([collector]))
+    pipeline = SimpleNamespace(
+        stream=lambda query, chat_history: Answer(["80 ", "km"]),
+        embeddings=SimpleNamespace(log_stats=lambda: None),
+        relevance_gate=SimpleNamespace(stats=lambda: {}),
+    )
+    monkeypatch.setattr(flow, "get_pipeline", lambda config: pipeline)
+    return collector
+
+
+def test_unread_stream_starts_no_trace(collector):
+    stream = flow.stream_answer(None, "range?")
+    stream.close()
+    del stream
+    assert collector.records == []
+    assert tracing.current_trace() is None
+
+
+def test_read_stream_finishes_its_trace(collector):
+    assert "".join(flow.stream_answer(None, "range?")) == "80 km"
+    assert len(collector.records) == 1
+    assert "error" not in collector.records[0]
+    assert [span["name"] for span in collector.records[0]["spans"]] == ["client_setup"]
+    assert tracing.current_trace() is None
+
+
+def test_stream_closed_half_way_finishes_its_trace(collector):
+    stream = flow.stream_answer(None, "range?")
+    assert next(stream) == "80 "
+    stream.close()
+    assert collector.records[0]["error"] == "stream not consumed"
+    assert tracing.current_trace() is None
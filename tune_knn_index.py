@@ -0,0 +1,302 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from loguru import logger
+from opensearchpy import OpenSearch
+
+from utils import artifact, opensearch, quantization
+from utils.index_spec import IndexSpec
+
+# logger
+logger.remove()
+logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
+
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Sweep k-NN index parameters and report recall@k and query latency"
+    )
+    parser.add_argument("--opensearch-url", type=str, default="http://localhost:9200")
+    parser.add_argument(
+        "--artifact",
+        type=str,
+        default=None,
+        help="Embedding artifact directory to take the corpus from",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=20000,
+        help="Number of random vectors to index when no artifact is given",
+    )
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--engines", type=str, default="nmslib,faiss,lucene")
+    parser.add_argument("--space-type", type=str, default="cosinesimil")
+    parser.add_argument("--m", type=str, default="8,16,32")
+    parser.add_argument("--ef-construction", type=str, default="100,256")
+    parser.add_argument("--ef-search", type=str, default="50,100,256")
+    parser.add_argument("--shards", type=str, default="1")
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default="none",
+        help="Comma separated vector formats to compare: none, fp16, byte",
+    )
+    parser.add_argument(
+        "--rescore-oversample",
+        type=int,
+        default=4,
+        help="Fetch k times this many candidates and re-rank them on float32 vectors, 0 to skip",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON")
+
+    return parser.parse_known_args()
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def load_corpus(args, rng):
+    if args.artifact:
+        embedding_artifact = artifact.EmbeddingArtifact(args.artifact, EMBEDDING_MODEL_ID)
+        vectors = np.asarray(embedding_artifact.vectors(), dtype=np.float32)
+        logger.info(f"Loaded {len(vectors)} vectors from {args.artifact}")
+    else:
+        vectors = rng.standard_normal((args.synthetic, args.dimension), np.float32)
+        logger.info(f"Generated {len(vectors)} random {args.dimension}-dim vectors")
+    return vectors
+
+
+def make_queries(corpus, count, rng):
+    # Perturbed corpus vectors look like paraphrased questions, pure noise
+    # would make every neighbour equally far away
+    rows = rng.choice(len(corpus), size=min(count, len(corpus)), replace=False)
+    noise = rng.standard_normal((len(rows), corpus.shape[1]), np.float32)
+    scale = np.linalg.norm(corpus[rows], axis=1, keepdims=True) * 0.1
+    noise *= scale / np.linalg.norm(noise, axis=1, keepdims=True)
+    return corpus[rows] + noise
+
+
+def exact_neighbours(corpus, queries, k, space_type, block_size=100000):
+    # Brute force over corpus blocks, keeps memory at queries x block_size
+    if space_type == "cosinesimil":
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_rows = np.zeros((len(queries), k), dtype=np.int64)
+    for start in range(0, len(corpus), block_size):
+        block = corpus[start : start + block_size]
+        if space_type == "cosinesimil":
+            block = block / np.linalg.norm(block, axis=1, keepdims=True)
+        if space_type == "l2":
+            scores = 2 * queries @ block.T - (block**2).sum(1)
+        else:
+            scores = queries @ block.T
+        scores = np.concatenate([best_scores, scores], axis=1)
+        block_rows = np.arange(start, start + len(block))
+        rows = np.concatenate(
+            [best_rows, np.broadcast_to(block_rows, scores[:, k:].shape)], axis=1
+        )
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_rows = np.take_along_axis(rows, top, axis=1)
+    return [set(row) for row in best_rows.tolist()]
+
+
+def load_index(client, index_name, spec, corpus):
+    opensearch.delete_opensearch_index(client, index_name)
+    opensearch.create_index(client, index_name, spec)
+    batches = (
+        [
+            {
+                "_index": index_name,
+                "_id": str(row),
+                spec.text_field: str(row),
+                spec.vector_field: quantization.quantize_vector(
+                    corpus[row], spec.quantization
+                ),
+            }
+            for row in range(start, min(start + 500, len(corpus)))
+        ]
+        for start in range(0, len(corpus), 500)
+    )
+    writer = opensearch.BulkWriter(client)
+    started = time.perf_counter()
+    with opensearch.bulk_load_settings(client, index_name):
+        for _ in writer.write(batches):
+            pass
+    return time.perf_counter() - started
+
+
+def run_queries(client, index_name, spec, queries, k, corpus=None, oversample=1):
+    # With a corpus the candidates are re-ranked on its float32 vectors, the
+    # same way the chat flow rescores with the embedding artifact
+    latencies, results = [], []
+    size = k * oversample
+    for query in queries:
+        vector = quantization.quantize_vector(query, spec.quantization)
+        body = {
+            "size": size,
+            "_source": False,
+            "query": {"knn": {spec.vector_field: {"vector": vector, "k": size}}},
+        }
+        started = time.perf_counter()
+        response = client.search(index=index_name, body=body)
+        rows = [int(hit["_id"]) for hit in response["hits"]["hits"]]
+        if corpus is not None and rows:
+            order, _ = quantization.rescore(query, corpus[rows], k)
+            rows = [rows[i] for i in order]
+        latencies.append(time.perf_counter() - started)
+        results.append(set(rows[:k]))
+    return np.asarray(latencies), results
+
+
+def recall(found, truth, k):
+    return round(float(np.mean([len(f & t) / k for f, t in zip(found, truth)])), 4)
+
+
+def native_memory_kb(client):
+    # Graph memory reported by the k-NN plugin, lucene graphs live on the heap
+    try:
+        stats = client.transport.perform_request("GET", "/_plugins/_knn/stats")
+    except Exception as e:
+        logger.debug(f"Could not read k-NN stats: {e}")
+        return None
+    return sum(node.get("graph_memory_usage", 0) for node in stats["nodes"].values())
+
+
+def main():
+    args, _ = parse_args()
+    rng = np.random.default_rng(args.seed)
+    client = OpenSearch(hosts=[args.opensearch_url], timeout=120)
+
+    corpus = load_corpus(args, rng)
+    queries = make_queries(corpus, args.queries, rng)
+    logger.info(f"Computing exact top-{args.k} neighbours for {len(queries)} queries")
+    truth = exact_neighbours(corpus, queries, args.k, args.space_type)
+
+    results = []
+    # Recall of the full-precision build with the same parameters, to report
+    # what each quantized build loses against it
+    baseline_recall = {}
+    builds = itertools.product(
+        args.engines.split(","),
+        int_list(args.m),
+        int_list(args.ef_construction),
+        int_list(args.shards),
+        [None if q == "none" else q for q in args.quantization.split(",")],
+    )
+    for engine, m, ef_construction, shards, quantization_type in builds:
+        try:
+            spec = IndexSpec(
+                dimension=corpus.shape[1],
+                engine=engine,
+                space_type=args.space_type,
+                m=m,
+                ef_construction=ef_construction,
+                number_of_shards=shards,
+                quantization=quantization_type,
+            )
+        except ValueError as e:
+            logger.info(f"Skipping {engine} {quantization_type}: {e}")
+            continue
+        index_name = f"knn-tune-{engine}-m{m}-efc{ef_construction}-s{shards}-{quantization_type or 'float'}"
+        logger.info(f"Building {index_name}")
+        memory_before = native_memory_kb(client)
+        try:
+            build_seconds = load_index(client, index_name, spec, corpus)
+        except Exception as e:
+            logger.error(f"Could not build {index_name}: {e}")
+            continue
+        estimated_mb = spec.estimated_memory_bytes(len(corpus)) / 2**20
+        full_precision = IndexSpec(**{**spec.to_dict(), "quantization": None})
+        full_mb = full_precision.estimated_memory_bytes(len(corpus)) / 2**20
+        memory_after = None
+
+        # ef_search is a dynamic setting, no rebuild needed to sweep it
+        for ef_search in int_list(args.ef_search) if engine != "lucene" else [None]:
+            if ef_search is not None:
+                client.indices.put_settings(
+                    index=index_name,
+                    body={"index": {"knn.algo_param.ef_search": ef_search}},
+                )
+            # Warm the graph into native memory before timing
+            run_queries(client, index_name, spec, queries[:10], args.k)
+            if memory_after is None:
+                memory_after = native_memory_kb(client)
+            latencies, found = run_queries(client, index_name, spec, queries, args.k)
+            key = (engine, m, ef_construction, shards, ef_search)
+            result = {
+                **spec.to_dict(),
+                "ef_search": ef_search,
+                "build_seconds": round(build_seconds, 2),
+                f"recall@{args.k}": recall(found, truth, args.k),
+                "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+                "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 2),
+                "estimated_mb": round(estimated_mb, 1),
+                "memory_saved_pct": round(100 * (1 - estimated_mb / full_mb), 1),
+                "native_mb": None,
+            }
+            if memory_before is not None and memory_after is not None:
+                result["native_mb"] = round((memory_after - memory_before) / 1024, 1)
+            if quantization_type is None:
+                baseline_recall[key] = result[f"recall@{args.k}"]
+            if key in baseline_recall:
+                result["recall_lost"] = round(
+                    baseline_recall[key] - result[f"recall@{args.k}"], 4
+                )
+            if args.rescore_oversample:
+                rescored_latencies, rescored = run_queries(
+                    client,
+                    index_name,
+                    spec,
+                    queries,
+                    args.k,
+                    corpus=corpus,
+                    oversample=args.rescore_oversample,
+                )
+                result[f"rescored_recall@{args.k}"] = recall(rescored, truth, args.k)
+                result["rescored_p50_ms"] = round(
+                    float(np.percentile(rescored_latencies, 50)) * 1000, 2
+                )
+            results.append(result)
+            logger.info(
+                f"{engine} {quantization_type or 'float32'} m={m} ef_construction={ef_construction} ef_search={ef_search} shards={shards}: "
+                f"recall@{args.k}={result[f'recall@{args.k}']} p50={result['p50_ms']}ms p99={result['p99_ms']}ms "
+                f"~{result['estimated_mb']}MB"
+            )
+
+        opensearch.delete_opensearch_index(client, index_name)
+
+    print("")
+    print(
+        f"{'engine':8} {'quant':>5} {'m':>4} {'ef_con':>6} {'ef_s':>5} {'shards':>6} "
+        f"{'recall':>7} {'lost':>7} {'rescored':>8} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'est MB':>8} {'saved %':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['engine']:8} {str(r['quantization'] or '-'):>5} {r['m']:>4} {r['ef_construction']:>6} "
+            f"{str(r['ef_search']):>5} {r['number_of_shards']:>6} {r[f'recall@{args.k}']:>7} "
+            f"{str(r.get('recall_lost', '-')):>7} {str(r.get(f'rescored_recall@{args.k}', '-')):>8} "
+            f"{r['p50_ms']:>8} {r['p99_ms']:>8} {r['estimated_mb']:>8} {r['memory_saved_pct']:>7}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import uuid
+
+import numpy as np
+from loguru import logger
+
+# logger
+logger.remove()
+logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
+
+DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+class EmbeddingArtifact:
+    """Append-only local copy of every embedding paid for.
+
+    One directory per embedding model holds:
+
+    - `vectors.<dtype>`: a raw row-major array of `dim` floats per document,
+      readable with `np.memmap`
+    - `records.sqlite3`: the sidecar mapping content hash -> row and text
+    - `meta.json`: model id, dimension, dtype and a uuid, a rebuilt artifact
+      gets a new uuid even when it ends up with as many rows as the old one
+
+    Rows are written before the sidecar is committed, so the vector file may
+    hold rows past the sidecar's count while a writer is appending or after it
+    crashed. Readers only ever read the committed rows. Only a `writable`
+    artifact may append, it holds an exclusive lock on the directory for its
+    lifetime and cuts a crashed writer's uncommitted tail on open.
+    """
+
+    def __init__(self, root, model_id, dim=1536, dtype="float32", writable=False):
+        self.model_id = model_id
+        self.directory = os.path.join(root, re.sub(r"[^A-Za-z0-9_.-]", "_", model_id))
+        os.makedirs(self.directory, exist_ok=True)
+
+        meta_path = os.path.join(self.directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["model_id"] != model_id:
+                raise ValueError(
+                    f"Artifact {self.directory} holds {meta['model_id']}, not {model_id}"
+                )
+            dim, dtype = meta["dim"], meta["dtype"]
+        else:
+            meta = {"model_id": model_id, "dim": dim, "dtype": dtype}
+        if "uuid" not in meta:
+            # Also upgrades artifacts written before the uuid was added
+            meta["uuid"] = uuid.uuid4().hex
+            tmp_path = f"{meta_path}.{meta['uuid']}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+        self.uuid = meta["uuid"]
+
+        self.dim = dim
+        self.dtype = np.dtype(DTYPES[dtype])
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self.vectors_path = os.path.join(self.directory, f"vectors.{dtype}")
+        self.writable = writable
+
+        self._lock_file = None
+        if writable:
+            self._lock_file = open(os.path.join(self.directory, "writer.lock"), "w")
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock_file.close()
+                raise RuntimeError(f"Artifact {self.directory} is already open for writing")
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(self.directory, "records.sqlite3"), check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "id TEXT PRIMARY KEY, row INTEGER NOT NULL, text TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+        self.count = self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        if writable:
+            # No other writer can be appending, rows past the count are torn
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(self.count * self.row_bytes)
+        logger.info(
+            f"Embedding artifact {self.directory} has {self.count} {dtype} vectors"
+        )
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, doc_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM records WHERE id = ?", (doc_id,)
+            ).fetchone()
+        return row is not None
+
+    def get(self, doc_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT row FROM records WHERE id = ?", (doc_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        vector = np.fromfile(
+            self.vectors_path,
+            dtype=self.dtype,
+            count=self.dim,
+            offset=row[0] * self.row_bytes,
+        )
+        return vector.astype(np.float32).tolist()
+
+    def append(self, records):
+        """Store `records` (dicts with `_id`, `text`, `vector_field`).
+
+        Ids already in the artifact are ignored. Returns how many were added.
+        """
+        if not self.writable:
+            raise RuntimeError(f"Artifact {self.directory} was opened read-only")
+        with self._lock:
+            seen = set()
+            new = []
+            for record in records:
+                doc_id = record["_id"]
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                exists = self._conn.execute(
+                    "SELECT 1 FROM records WHERE id = ?", (doc_id,)
+                ).fetchone()
+                if exists is None:
+                    new.append(record)
+            if not new:
+                return 0
+
+            vectors = np.asarray([r["vector_field"] for r in new], dtype=self.dtype)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"Expected {self.dim}-dim vectors, got {vectors.shape[1]}"
+                )
+            with open(self.vectors_path, "ab") as f:
+                vectors.tofile(f)
+            self._conn.executemany(
+                "INSERT INTO records VALUES (?, ?, ?)",
+                [(r["_id"], self.count + i, r["text"]) for i, r in enumerate(new)],
+            )
+            self._conn.commit()
+            self.count += len(new)
+            return len(new)
+
+    def vectors(self):
+        if self.count == 0:
+            return np.zeros((0, self.dim), dtype=self.dtype)
+        return np.memmap(
+            self.vectors_path, dtype=self.dtype, mode="r", shape=(self.count, self.dim)
+        )
+
+    def refresh(self):
+        # Pick up rows appended by another process, e.g. a running loader
+        with self._lock:
+            self.count = self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        return self.count
+
+    def records(self, rows):
+        """Return {row: (doc_id, text)} for the given vector rows."""
+        rows = [int(row) for row in rows]
+        if not rows:
+            return {}
+        placeholders = ",".join("?" * len(rows))
+        with self._lock:
+            found = self._conn.execute(
+                f"SELECT row, id, text FROM records WHERE row IN ({placeholders})",
+                rows,
+            ).fetchall()
+        return {row: (doc_id, text) for row, doc_id, text in found}
+
+    def iter_records(self, batch_size=1000):
+        """Yield (doc_id, text, vector) in row order, reading at disk speed."""
+        vectors = self.vectors()
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT id, row, text FROM records ORDER BY row")
+        while rows := cursor.fetchmany(batch_size):
+            block = np.asarray(
+                vectors[rows[0][1] : rows[-1][1] + 1], dtype=np.float32
+            )
+            for doc_id, row, text in rows:
+                yield doc_id, text, block[row - rows[0][1]]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
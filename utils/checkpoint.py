@@ -0,0 +1,105 @@
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+from loguru import logger
+
+# logger
+logger.remove()
+logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
+
+
+def content_hash(text, model_id):
+    # The model id is part of the hash, switching models re-embeds everything
+    return hashlib.sha256(f"{model_id}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class CheckpointJournal:
+    """Local journal of the documents an ingestion run has already indexed.
+
+    Every bulk batch that made it into OpenSearch is appended with the ids of
+    its documents, so a restarted run can skip them without asking the
+    cluster. Backed by SQLite so lookups stay on disk for large corpora.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "batch INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "documents INTEGER NOT NULL, finished_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "id TEXT PRIMARY KEY, batch INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def index_uuid(self):
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'index_uuid'"
+        ).fetchone()
+        return row[0] if row else None
+
+    def bind(self, index_uuid, created=False):
+        """Tie the journal to one incarnation of the index, by its uuid.
+
+        The journal is reset when the index was just `created` or when its
+        uuid changed, i.e. it was deleted and recreated outside the loader or
+        the endpoint now points at another cluster. Returns True on reset.
+        """
+        previous = self.index_uuid()
+        stale = created or (previous is not None and previous != index_uuid)
+        if stale:
+            self.reset()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('index_uuid', ?)", (index_uuid,)
+        )
+        self._conn.commit()
+        return stale
+
+    def filter_new(self, ids):
+        ids = list(ids)
+        if not ids:
+            return set()
+        placeholders = ",".join("?" * len(ids))
+        done = self._conn.execute(
+            f"SELECT id FROM documents WHERE id IN ({placeholders})", ids
+        ).fetchall()
+        return set(ids) - {row[0] for row in done}
+
+    def mark_done(self, ids):
+        ids = list(ids)
+        cursor = self._conn.execute(
+            "INSERT INTO batches (documents, finished_at) VALUES (?, ?)",
+            (len(ids), time.time()),
+        )
+        batch = cursor.lastrowid
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?)",
+            [(doc_id, batch) for doc_id in ids],
+        )
+        self._conn.commit()
+        return batch
+
+    def reset(self):
+        logger.info(f"Resetting checkpoint journal {self.path}")
+        self._conn.execute("DELETE FROM documents")
+        self._conn.execute("DELETE FROM batches")
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
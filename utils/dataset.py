@@ -1,8 +1,10 @@
+import contextlib
 import gzip
+import io
+import itertools
 import json
 import os
 import sys
-import tempfile
 
 import requests
 from loguru import logger
@@ -12,53 +14,58 @@ logger.remove()
 logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
 
 
-def download_dataset(url):
-    # download the dataset and store it to tmp dir
-    try:
-        logger.info("Downloading dataset")
-        response = requests.get(url)
-        if response.status_code == 200:
-            temp = tempfile.NamedTemporaryFile(delete=False)
-            temp.write(response.content)
-            temp.close()
-            return temp.name
+def format_record(row):
+    # Chunks written by the PDF pipeline carry their text, dataset rows are
+    # [question, answer] pairs
+    if isinstance(row, dict):
+        return row["text"]
+    return f"question: {row[0]}, answer: {row[1]}"
+
+
+def is_url(source):
+    return source.startswith(("http://", "https://"))
+
+
+@contextlib.contextmanager
+def open_dataset(source):
+    """Open a JSONL dataset from a URL or a local path as a text stream.
+
+    Gzip is decompressed on the fly and an HTTP body is read straight from
+    the socket, so nothing is buffered beyond the current chunk.
+    """
+    with contextlib.ExitStack() as stack:
+        if is_url(source):
+            response = stack.enter_context(
+                requests.get(source, stream=True, timeout=60)
+            )
+            response.raise_for_status()
+            response.raw.decode_content = True
+            raw = response.raw
+            # urllib3 already undoes a Content-Encoding: gzip, a .gz served
+            # that way must not be decompressed a second time
+            compressed = source.endswith(".gz") and "gzip" not in response.headers.get(
+                "Content-Encoding", ""
+            )
         else:
-            logger.error("Failed to download dataset")
-            return None
-    except Exception as e:
-        logger.error(e)
-        return None
-
-
-def decompress_dataset(file_path):
-    # decompress the dataset
-    temp_fd, temp_path = tempfile.mkstemp()
-    logger.info(f"Decompressing dataset {file_path} to new file {temp_path}")
-    try:
-        with gzip.open(file_path, "rb") as compressed:
-            with open(temp_path, "wb") as decompressed:
-                decompressed.write(compressed.read())
-        logger.info("Decompression complete")
-        return temp_path
-    except Exception as e:
-        logger.error(e)
-        return None
-
-
-def prep_for_put(file_path):
-    logger.info(f"Loading file {file_path}")
-    all_records = []
-    with open(file_path, "r") as f:
+            raw = stack.enter_context(open(source, "rb"))
+            compressed = source.endswith(".gz")
+
+        if compressed:
+            raw = stack.enter_context(gzip.GzipFile(fileobj=raw, mode="rb"))
+
+        yield stack.enter_context(io.TextIOWrapper(raw, encoding="utf-8"))
+
+
+def stream_records(source):
+    logger.info(f"Streaming dataset {source}")
+    with open_dataset(source) as f:
         for line in f:
-            row = json.loads(line)
-            text = f"question: {row[0]}, answer: {row[1]}"
-            all_records.append(text)
-        return all_records
-
-
-def delete_file(file_path):
-    logger.info(f"Deleting file {file_path}")
-    try:
-        os.remove(file_path)
-    except Exception as e:
-        logger.error(e)
+            if line.strip():
+                yield format_record(json.loads(line))
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
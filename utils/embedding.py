@@ -0,0 +1,179 @@
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+from loguru import logger
+
+# logger
+logger.remove()
+logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+}
+# Worth another try, but not a sign of sending too fast
+TRANSIENT_ERROR_CODES = {
+    "InternalServerException",
+    "ModelTimeoutException",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+
+_END = object()
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting calls to `rate` per second.
+
+    The rate adapts to throttling: `throttled()` halves it, at most once a
+    second so a burst of concurrent throttles counts as one, and every
+    `succeeded()` call grows it back towards the configured maximum
+    (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.5):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.throttled_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+    def throttled(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self.throttled_at < 1:
+                return
+            self.throttled_at = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+        logger.warning(f"Throttled by Bedrock, rate lowered to {self.rate:.2f}/s")
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+def is_throttling_error(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    return False
+
+
+def is_transient_error(error):
+    """5xx responses, timeouts and dropped connections."""
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        code = error.response.get("Error", {}).get("Code")
+        return status >= 500 or code in TRANSIENT_ERROR_CODES
+    return False
+
+
+def call_with_backoff(fn, limiter=None, max_retries=8, base_delay=0.5, max_delay=30):
+    """Call `fn`, retrying throttles and transient errors with jittered backoff.
+
+    Clients are built without botocore's own retries, so this is the only
+    retry loop. Only throttles slow down the `limiter`.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            if not (throttled or is_transient_error(e)) or attempt >= max_retries:
+                raise
+            if throttled and limiter is not None:
+                limiter.throttled()
+            # Full jitter keeps the workers from retrying in lockstep
+            delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+            attempt += 1
+            logger.debug(f"Retry {attempt} in {delay:.2f}s after {e}")
+            time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.succeeded()
+        return result
+
+
+def embed_concurrently(
+    records, embed_fn, limiter=None, concurrency=8, max_retries=8
+):
+    """Yield `embed_fn(record)` for every record, in completion order.
+
+    At most `concurrency` requests are in flight, and only about twice that
+    many records are pulled from `records` ahead of time, so a lazy record
+    source is never read into memory. With a `limiter` every call goes
+    through `call_with_backoff`, without one `embed_fn` is expected to do its
+    own rate limiting. Records that still fail are logged and skipped.
+    """
+    records = iter(records)
+    max_pending = concurrency * 2
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+
+        def submit_next():
+            record = next(records, _END)
+            if record is _END:
+                return False
+            if limiter is None:
+                pending.add(executor.submit(embed_fn, record))
+            else:
+                pending.add(
+                    executor.submit(
+                        call_with_backoff,
+                        lambda: embed_fn(record),
+                        limiter,
+                        max_retries,
+                    )
+                )
+            return True
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Embedding failed: {e}")
+                submit_next()
+
+    if failed:
+        logger.warning(f"{failed} records could not be embedded")
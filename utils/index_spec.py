@@ -0,0 +1,161 @@
+from dataclasses import asdict, dataclass, replace
+from typing import Optional
+
+ENGINES = ("nmslib", "faiss", "lucene")
+SPACE_TYPES = ("cosinesimil", "l2", "innerproduct")
+QUANTIZATIONS = ("fp16", "byte")
+# Built-in analyzers, cjk indexes Chinese as overlapping bigrams and needs no
+# plugin, smartcn needs the analysis-smartcn plugin on the cluster
+TEXT_ANALYZERS = ("standard", "cjk", "smartcn")
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """Single definition of the k-NN index used by the loader and the chat flow.
+
+    Defaults match the OpenSearch k-NN plugin defaults, so an index created
+    from `IndexSpec()` behaves like the bare `knn_vector` mapping it replaces,
+    but with the HNSW method spelled out and tunable.
+    """
+
+    dimension: int = 1536
+    engine: str = "nmslib"
+    space_type: str = "cosinesimil"
+    m: int = 16
+    ef_construction: int = 100
+    ef_search: int = 100
+    number_of_shards: int = 1
+    number_of_replicas: Optional[int] = None
+    # None stores full float32 vectors, "fp16" uses the faiss scalar quantizer
+    # and "byte" stores int8 vectors quantized by utils.quantization
+    quantization: Optional[str] = None
+    # None keeps `text` as an exact keyword, an analyzer makes it full-text
+    # searchable for hybrid BM25 + k-NN queries
+    text_analyzer: Optional[str] = None
+    vector_field: str = "vector_field"
+    text_field: str = "text"
+
+    def __post_init__(self):
+        if self.engine not in ENGINES:
+            raise ValueError(f"Unknown k-NN engine {self.engine}, use one of {ENGINES}")
+        if self.space_type not in SPACE_TYPES:
+            raise ValueError(
+                f"Unknown space type {self.space_type}, use one of {SPACE_TYPES}"
+            )
+        if self.quantization not in (None,) + QUANTIZATIONS:
+            raise ValueError(
+                f"Unknown quantization {self.quantization}, use one of {QUANTIZATIONS}"
+            )
+        if self.text_analyzer not in (None,) + TEXT_ANALYZERS:
+            raise ValueError(
+                f"Unknown text analyzer {self.text_analyzer}, use one of {TEXT_ANALYZERS}"
+            )
+        if self.quantization == "fp16" and self.engine != "faiss":
+            raise ValueError("fp16 quantization needs the faiss engine")
+        if self.quantization == "byte":
+            if self.engine == "nmslib":
+                raise ValueError("byte vectors need the lucene or faiss engine")
+            if self.space_type != "cosinesimil":
+                # Vectors are scaled one by one, which only preserves angles
+                raise ValueError("byte quantization needs the cosinesimil space")
+
+    def settings(self):
+        index = {
+            "knn": True,
+            "number_of_shards": self.number_of_shards,
+        }
+        if self.engine != "lucene":
+            # Lucene derives its search queue from k, the others read this
+            index["knn.algo_param.ef_search"] = self.ef_search
+        if self.number_of_replicas is not None:
+            index["number_of_replicas"] = self.number_of_replicas
+        return {"index": index}
+
+    def method(self):
+        parameters = {"m": self.m, "ef_construction": self.ef_construction}
+        if self.quantization == "fp16":
+            parameters["encoder"] = {"name": "sq", "parameters": {"type": "fp16"}}
+        return {
+            "name": "hnsw",
+            "engine": self.engine,
+            "space_type": self.space_type,
+            "parameters": parameters,
+        }
+
+    def mappings(self):
+        vector = {
+            "type": "knn_vector",
+            "dimension": self.dimension,
+            "method": self.method(),
+        }
+        if self.quantization == "byte":
+            vector["data_type"] = "byte"
+        text = {"type": "keyword"}
+        if self.text_analyzer:
+            text = {
+                "type": "text",
+                "analyzer": self.text_analyzer,
+                "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+            }
+        return {
+            "_meta": {"quantization": self.quantization},
+            "properties": {
+                self.vector_field: vector,
+                self.text_field: text,
+            },
+        }
+
+    def bytes_per_dimension(self):
+        return {None: 4, "fp16": 2, "byte": 1}[self.quantization]
+
+    def estimated_memory_bytes(self, num_vectors):
+        # HNSW native memory estimate from the OpenSearch k-NN docs:
+        # 1.1 * (bytes_per_dimension * dimension + 8 * m) per vector
+        per_vector = self.bytes_per_dimension() * self.dimension + 8 * self.m
+        return int(1.1 * per_vector * num_vectors)
+
+    def body(self):
+        return {"settings": self.settings(), "mappings": self.mappings()}
+
+    def with_overrides(self, **overrides):
+        return replace(self, **{k: v for k, v in overrides.items() if v is not None})
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def add_index_arguments(parser):
+    default = IndexSpec()
+    group = parser.add_argument_group("k-NN index")
+    group.add_argument("--engine", type=str, default=default.engine, choices=ENGINES)
+    group.add_argument(
+        "--space-type", type=str, default=default.space_type, choices=SPACE_TYPES
+    )
+    group.add_argument("--m", type=int, default=default.m)
+    group.add_argument("--ef-construction", type=int, default=default.ef_construction)
+    group.add_argument("--ef-search", type=int, default=default.ef_search)
+    group.add_argument("--shards", type=int, default=default.number_of_shards)
+    group.add_argument(
+        "--quantization", type=str, default=None, choices=QUANTIZATIONS
+    )
+    group.add_argument(
+        "--text-analyzer",
+        type=str,
+        default=None,
+        choices=TEXT_ANALYZERS,
+        help="Analyze the text field for hybrid search, cjk suits the Traditional Chinese manuals",
+    )
+    return group
+
+
+def index_spec_from_args(args):
+    return IndexSpec(
+        engine=args.engine,
+        space_type=args.space_type,
+        m=args.m,
+        ef_construction=args.ef_construction,
+        ef_search=args.ef_search,
+        number_of_shards=args.shards,
+        quantization=args.quantization,
+        text_analyzer=args.text_analyzer,
+    )
@@ -1,11 +1,17 @@
+import contextlib
 import os
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import boto3
 from dotenv import load_dotenv
 from loguru import logger
 from opensearchpy import OpenSearch, RequestsHttpConnection
-from opensearchpy.helpers import bulk
+from opensearchpy.helpers import bulk, streaming_bulk
+
+from utils.index_spec import IndexSpec
 
 load_dotenv()
 
@@ -17,7 +23,7 @@ logger.add(sys.stdout, level=os.getenv("LOG_LEVEL", "INFO"))
 OPENSEARCH_ENDPOINT = os.environ.get("OPENSEARCH_ENDPOINT")
 
 
-def get_opensearch_cluster_client(name, password, region):
+def get_opensearch_cluster_client(name, password, region, pool_maxsize=10):
     opensearch_endpoint = OPENSEARCH_ENDPOINT
     opensearch_client = OpenSearch(
         hosts=[opensearch_endpoint],
@@ -25,6 +31,9 @@ def get_opensearch_cluster_client(name, password, region):
         use_ssl=True,
         verify_certs=True,
         connection_class=RequestsHttpConnection,
+        # gzip request bodies, 1536-float vectors compress well as JSON text
+        http_compress=True,
+        pool_maxsize=pool_maxsize,
         timeout=30,
     )
     return opensearch_client
@@ -36,29 +45,244 @@ def put_bulk_in_opensearch(list, client):
     return success, failed
 
 
+class BulkWriter:
+    """Parallel bulk indexing with retries for rejected documents.
+
+    Each submitted batch is sent with `streaming_bulk`, which splits it into
+    requests of at most `chunk_size` documents / `max_chunk_bytes` bytes and
+    retries documents rejected with 429 using exponential backoff. Up to
+    `thread_count` batches are in flight at once.
+    """
+
+    def __init__(
+        self,
+        client,
+        thread_count=4,
+        chunk_size=500,
+        max_chunk_bytes=10 * 1024 * 1024,
+        max_retries=5,
+        initial_backoff=2,
+        max_backoff=60,
+    ):
+        self.client = client
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.success = 0
+        self.failed = 0
+        self.started_at = None
+        self._lock = threading.Lock()
+
+    def _write_batch(self, actions):
+        errors = []
+        for ok, item in streaming_bulk(
+            self.client,
+            actions,
+            chunk_size=self.chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            max_retries=self.max_retries,
+            initial_backoff=self.initial_backoff,
+            max_backoff=self.max_backoff,
+            raise_on_error=False,
+            raise_on_exception=False,
+            yield_ok=False,
+        ):
+            if not ok:
+                errors.append(item)
+        success = len(actions) - len(errors)
+        with self._lock:
+            self.success += success
+            self.failed += len(errors)
+        return success, errors
+
+    def write(self, batches):
+        """Index every batch, yielding (batch, success, errors) as each finishes."""
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        batches = iter(batches)
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            pending = {}
+
+            def submit_next():
+                batch = next(batches, None)
+                if batch is None:
+                    return False
+                pending[executor.submit(self._write_batch, batch)] = batch
+                return True
+
+            while len(pending) < self.thread_count and submit_next():
+                pass
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    success, errors = future.result()
+                    yield batch, success, errors
+                    submit_next()
+
+    def docs_per_second(self):
+        if self.started_at is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.started_at
+        return self.success / elapsed if elapsed else 0.0
+
+
+def get_index_settings(opensearch_client, index_name, *names):
+    response = opensearch_client.indices.get_settings(
+        index=index_name, include_defaults=True, flat_settings=True
+    )
+    index_settings = next(iter(response.values()))
+    merged = {**index_settings.get("defaults", {}), **index_settings["settings"]}
+    return {name: merged.get(f"index.{name}") for name in names}
+
+
+def get_index_uuid(opensearch_client, index_name):
+    # A recreated index gets a new uuid even when it keeps its name
+    response = opensearch_client.indices.get_settings(index=index_name)
+    return next(iter(response.values()))["settings"]["index"]["uuid"]
+
+
+def get_index_quantization(opensearch_client, index_name):
+    # Written into the mapping `_meta` by IndexSpec, absent on older indexes
+    response = opensearch_client.indices.get_mapping(index=index_name)
+    mappings = next(iter(response.values()))["mappings"]
+    return mappings.get("_meta", {}).get("quantization")
+
+
+@contextlib.contextmanager
+def bulk_load_settings(opensearch_client, index_name, force_merge=True):
+    """Disable refresh and replicas while bulk loading, restore them after.
+
+    Ends with a force merge so the k-NN graphs are built over few large
+    segments instead of many small ones. The yielded dict takes the number of
+    `documents` written, the force merge is skipped when it is 0.
+    """
+    previous = get_index_settings(
+        opensearch_client, index_name, "refresh_interval", "number_of_replicas"
+    )
+    logger.info(f"Bulk load settings for {index_name}, restoring {previous} afterwards")
+    opensearch_client.indices.put_settings(
+        index=index_name,
+        body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+    )
+    load = {"documents": None}
+    try:
+        yield load
+    finally:
+        opensearch_client.indices.put_settings(
+            index=index_name,
+            body={"index": {k: v for k, v in previous.items() if v is not None}},
+        )
+        opensearch_client.indices.refresh(index=index_name)
+        if force_merge and load["documents"] != 0:
+            logger.info(f"Force merging {index_name}")
+            try:
+                opensearch_client.indices.forcemerge(
+                    index=index_name, max_num_segments=1, request_timeout=3600
+                )
+            except Exception as e:
+                logger.warning(f"Force merge of {index_name} did not finish: {e}")
+
+
+def get_existing_ids(opensearch_client, index_name, ids):
+    ids = list(ids)
+    if not ids:
+        return set()
+    response = opensearch_client.mget(
+        index=index_name, body={"ids": ids}, _source=False
+    )
+    return {doc["_id"] for doc in response["docs"] if doc.get("found")}
+
+
 def check_opensearch_index(opensearch_client, index_name):
     return opensearch_client.indices.exists(index=index_name)
 
 
-def create_index(opensearch_client, index_name):
-    settings = {"settings": {"index": {"knn": True, "knn.space_type": "cosinesimil"}}}
-    response = opensearch_client.indices.create(index=index_name, body=settings)
+def create_index(opensearch_client, index_name, spec=None):
+    # Settings and mappings go in one request so the k-NN method is set
+    # before any document can create a default mapping
+    spec = spec or IndexSpec()
+    response = opensearch_client.indices.create(index=index_name, body=spec.body())
     return bool(response["acknowledged"])
 
 
-def create_index_mapping(opensearch_client, index_name):
+def create_index_mapping(opensearch_client, index_name, spec=None):
+    spec = spec or IndexSpec()
     response = opensearch_client.indices.put_mapping(
-        index=index_name,
-        body={
-            "properties": {
-                "vector_field": {"type": "knn_vector", "dimension": 1536},
-                "text": {"type": "keyword"},
+        index=index_name, body=spec.mappings()
+    )
+    return bool(response["acknowledged"])
+
+
+def put_hybrid_search_pipeline(
+    opensearch_client,
+    name,
+    lexical_weight=0.3,
+    normalization="min_max",
+    combination="arithmetic_mean",
+):
+    """Create or update the search pipeline that fuses hybrid query scores.
+
+    BM25 and k-NN scores live on different scales, the normalization
+    processor rescales each sub-query's scores on the coordinating node and
+    combines them with `lexical_weight` for BM25 and the rest for k-NN.
+    Needs OpenSearch 2.10+ with the neural-search plugin.
+    """
+    body = {
+        "description": "Fuse BM25 and k-NN scores of hybrid queries",
+        "phase_results_processors": [
+            {
+                "normalization-processor": {
+                    "normalization": {"technique": normalization},
+                    "combination": {
+                        "technique": combination,
+                        "parameters": {
+                            "weights": [lexical_weight, round(1 - lexical_weight, 6)]
+                        },
+                    },
+                }
             }
-        },
+        ],
+    }
+    response = opensearch_client.transport.perform_request(
+        "PUT", f"/_search/pipeline/{name}", body=body
     )
     return bool(response["acknowledged"])
 
 
+def hybrid_search(
+    opensearch_client,
+    index_name,
+    search_pipeline,
+    text,
+    vector,
+    k,
+    spec=None,
+    include_vector=False,
+):
+    # One round trip, the search pipeline fuses the two result lists
+    spec = spec or IndexSpec()
+    body = {
+        "size": k,
+        "_source": True if include_vector else {"excludes": [spec.vector_field]},
+        "query": {
+            "hybrid": {
+                "queries": [
+                    {"match": {spec.text_field: {"query": text}}},
+                    {"knn": {spec.vector_field: {"vector": vector, "k": k}}},
+                ]
+            }
+        },
+    }
+    response = opensearch_client.search(
+        index=index_name, body=body, params={"search_pipeline": search_pipeline}
+    )
+    return response["hits"]["hits"]
+
+
 def delete_opensearch_index(opensearch_client, index_name):
     logger.info(f"Trying to delete index {index_name}")
     try:
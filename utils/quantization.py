@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def quantize_to_byte(vectors):
+    """Scale each vector so its largest component is 127 and round to int8.
+
+    Every vector gets its own positive scale factor, which leaves cosine
+    similarity untouched apart from rounding, so no corpus-wide scale has to
+    be stored with the index. Works on one vector or a 2-D batch.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    peak = np.abs(vectors).max(axis=-1, keepdims=True)
+    peak[peak == 0] = 1
+    return np.rint(vectors / peak * 127).astype(np.int8)
+
+
+def quantize_vector(vector, quantization):
+    # What the index expects as vector_field / query vector for a quantization
+    if quantization == "byte":
+        return quantize_to_byte(vector).tolist()
+    return list(vector)
+
+
+def cosine_scores(query, vectors):
+    query = np.asarray(query, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    norms[norms == 0] = 1
+    return vectors @ query / norms
+
+
+def rescore(query, candidate_vectors, k):
+    """Return (order, scores) of the top `k` candidates by exact cosine.
+
+    `candidate_vectors` are the full-precision vectors of the candidates the
+    quantized index returned, `order` indexes into them.
+    """
+    scores = cosine_scores(query, candidate_vectors)
+    order = np.argsort(-scores)[:k]
+    return order, scores[order]